@@ -1,9 +1,33 @@
 import os
+import importlib
 
 _root = os.path.dirname(os.path.abspath(__file__))
 
-from stonks.record import Record
-from stonks.mailbox import Mailbox
-from stonks.parser import EmailParser, StatementParser
-from stonks.processor import Processor
+# the classes are imported on first access, so importing
+# stonks does not import imapclient, pdfminer or pandas
+_lazy = {
+    'Record': 'stonks.record',
+    'CompactRecord': 'stonks.record',
+    'RecordColumns': 'stonks.record',
+    'Mailbox': 'stonks.mailbox',
+    'AsyncMailbox': 'stonks.aiomailbox',
+    'EmailParser': 'stonks.parser',
+    'StatementParser': 'stonks.parser',
+    'Processor': 'stonks.processor',
+    'LotMatcher': 'stonks.lots',
+    'RecordStore': 'stonks.store',
+}
 
+__all__ = list(_lazy)
+
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError(f"module 'stonks' has no attribute '{name}'")
+    value = getattr(importlib.import_module(_lazy[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
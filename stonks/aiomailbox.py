@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+"""An asyncio Mailbox. AsyncIMAP speaks just enough IMAP4rev1
+on asyncio streams for the Mailbox (LOGIN, EXAMINE, UID
+SEARCH, UID FETCH, IDLE, LOGOUT) and lets several commands
+be in flight on one connection. FETCH responses are parsed
+with imapclient's parser so the data looks the same as on
+the synchronous path.
+"""
+import re
+import ssl
+import asyncio
+import datetime as dt
+from itertools import count
+from collections import OrderedDict, defaultdict
+
+from traitlets import Int, Float
+
+from imapclient.response_parser import parse_fetch_response
+
+from .mailbox import Mailbox
+from .mime import pick_part, part_text
+
+
+class IMAPError(Exception):
+    """A command answered with NO or BAD."""
+
+
+_literal = re.compile(rb'\{(\d+)\}\r\n$')
+_atom = re.compile(r'[A-Za-z0-9.:*@_/+-]+$')
+_months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+           'Oct', 'Nov', 'Dec']
+
+
+def _arg(val):
+    """An IMAP command argument: dates, atoms or quoted strings."""
+    if isinstance(val, bytes):
+        return val
+    if isinstance(val, dt.date):
+        return f'{val.day:02d}-{_months[val.month - 1]}-{val.year}'.encode()
+    val = str(val)
+    if _atom.match(val):
+        return val.encode()
+    return ('"' + val.replace('\\', '\\\\').replace('"', '\\"') +
+            '"').encode('utf-8')
+
+
+class AsyncIMAP:
+    """One IMAP connection. A single reader task reads every
+    response: tagged ones complete their command. Untagged
+    FETCH responses go to the fetch that asked for their
+    UID, so pipelined fetches never see each other's
+    messages; the other untagged responses are handed to
+    the oldest command still in flight.
+    """
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.tags = count(1)
+        self.pending = OrderedDict()
+        self.routes = {}
+        self.waiting = None
+        self.exists = asyncio.Event()
+
+    async def connect(self, host, port=0, use_ssl=True):
+        ctx = ssl.create_default_context() if use_ssl else None
+        self.reader, self.writer = await asyncio.open_connection(
+            host, port or (993 if use_ssl else 143), ssl=ctx)
+        greeting = await self.reader.readline()
+        if not greeting.startswith(b'* OK'):
+            raise IMAPError(f'bad greeting {greeting!r}')
+        self.task = asyncio.create_task(self.read_loop())
+        return self
+
+    async def read_response(self):
+        """One response the way imaplib lists it, literals as
+        (line, literal) followed by the rest of the line.
+
+        Returns:
+            [(line, literal), ..., line]
+        """
+        parts = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError('connection closed by server')
+            match = _literal.search(line)
+            if match is None:
+                parts.append(line.rstrip(b'\r\n'))
+                return parts
+            literal = await self.reader.readexactly(int(match.group(1)))
+            parts.append((line.rstrip(b'\r\n'), literal))
+
+    async def read_loop(self):
+        try:
+            while True:
+                parts = await self.read_response()
+                head = parts[0][0] if isinstance(parts[0], tuple) else parts[0]
+                if head.startswith(b'* '):
+                    await self.untagged(head, parts)
+                elif head.startswith(b'+'):
+                    if self.waiting is not None and not self.waiting.done():
+                        self.waiting.set_result(head)
+                else:
+                    tag, status, text = (head.split(b' ', 2) + [b''])[:3]
+                    fut, _ = self.pending.pop(tag.decode(), (None, None))
+                    if fut is not None and not fut.done():
+                        fut.set_result((status, text))
+        except Exception as e:
+            for fut, _ in self.pending.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            if self.waiting is not None and not self.waiting.done():
+                self.waiting.set_exception(e)
+
+    async def untagged(self, head, parts):
+        """Split '* [n] TYPE rest' and pass (TYPE, parts) with
+        the '* ' and TYPE taken off the first part on."""
+        words = head[2:].split(b' ', 2)
+        if words[0].isdigit() and len(words) > 1:
+            kind = words[1].upper()
+            data = b' '.join([words[0]] + words[2:])
+        else:
+            kind = words[0].upper()
+            data = b' '.join(words[1:])
+        if kind in (b'EXISTS', b'RECENT'):
+            self.exists.set()
+        first = (data, parts[0][1]) if isinstance(parts[0], tuple) else data
+        parts = [first] + parts[1:]
+        if kind == b'FETCH' and self.routes:
+            # keyed by UID in answer to UID FETCH, unsolicited
+            # ones (flag changes) match no fetch and are dropped
+            for uid, msg in parse_fetch_response(parts).items():
+                handler = self.routes.get(uid)
+                if handler is not None:
+                    await handler(uid, msg)
+            return
+        if self.pending:
+            _, handler = next(iter(self.pending.values()))
+            await handler(kind, parts)
+
+    def send(self, *args, handler=None):
+        """Write a command without waiting for it.
+
+        Returns:
+            (future of (status, text), untagged responses)
+        """
+        tag = f'A{next(self.tags):04d}'
+        fut = asyncio.get_running_loop().create_future()
+        collected = []
+
+        async def collect(kind, parts):
+            collected.append((kind, parts))
+
+        self.pending[tag] = (fut, handler or collect)
+        self.writer.write(b' '.join([tag.encode()] + [_arg(a) for a in args])
+                          + b'\r\n')
+        return fut, collected
+
+    async def command(self, *args, handler=None):
+        """Send a command and wait for its completion.
+
+        Returns:
+            [(TYPE, parts), ...] untagged responses
+        """
+        fut, collected = self.send(*args, handler=handler)
+        await self.writer.drain()
+        status, text = await fut
+        if status.upper() != b'OK':
+            raise IMAPError(f'{args[0]} failed: {text.decode()}')
+        return collected
+
+    async def login(self, user, pwd):
+        await self.command('LOGIN', user, pwd)
+
+    async def examine(self, folder):
+        """Select folder read-only.
+
+        Returns:
+            {b'UIDVALIDITY': int, b'EXISTS': int, ...}
+        """
+        info = {}
+        for kind, parts in await self.command('EXAMINE', folder):
+            if kind == b'EXISTS':
+                info[kind] = int(parts[0].split()[0])
+            match = re.search(rb'\[(UIDVALIDITY|UIDNEXT) (\d+)\]', parts[0])
+            if match:
+                info[match.group(1)] = int(match.group(2))
+        return info
+
+    async def search(self, criteria):
+        """Returns:
+            [uid, ...]
+        """
+        uids = []
+        for kind, parts in await self.command('UID', 'SEARCH', *criteria):
+            if kind == b'SEARCH':
+                uids.extend(int(uid) for uid in parts[0].split())
+        return uids
+
+    async def fetch(self, uids, items, handler):
+        """UID FETCH items of uids, awaiting handler(uid, data)
+        as each message's response lands, data being what
+        imapclient's fetch returns per message. Fetches in
+        flight at once must ask for disjoint uids.
+        """
+        async def ignore(kind, parts):
+            pass
+
+        for uid in uids:
+            self.routes[uid] = handler
+        seqset = ','.join(map(str, uids)).encode()
+        items = b'(' + b' '.join(item.encode() for item in items) + b')'
+        try:
+            await self.command('UID', 'FETCH', seqset, items, handler=ignore)
+        finally:
+            for uid in uids:
+                self.routes.pop(uid, None)
+
+    async def idle(self, timeout):
+        """IDLE until the server reports new messages or for
+        timeout seconds.
+
+        Returns:
+            whether new messages were reported
+        """
+        self.exists.clear()
+        self.waiting = asyncio.get_running_loop().create_future()
+        fut, _ = self.send('IDLE')
+        await self.writer.drain()
+        await self.waiting
+        try:
+            await asyncio.wait_for(self.exists.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.writer.write(b'DONE\r\n')
+        await self.writer.drain()
+        await fut
+        return self.exists.is_set()
+
+    async def logout(self):
+        try:
+            await self.command('LOGOUT')
+        except (IMAPError, ConnectionError):
+            pass
+        self.close()
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+
+class AsyncMailbox(Mailbox):
+    """The Mailbox on asyncio. Search, envelope and body
+    fetches are issued asynchronously, at most in_flight
+    FETCH commands at a time spread over connections
+    connections, and every body is put on an asyncio.Queue
+    as soon as its FETCH response lands, so a parser can
+    work on it while the next ones are on the wire.
+
+    With idle_for, the connection then IDLEs for that many
+    seconds and new order emails are fetched as the server
+    reports them.
+
+    The synchronous fetch_orders and iter_orders are still
+    available. cache_file is not used here.
+    """
+    in_flight = Int(4, help='FETCH commands in flight at once').tag(
+        config=True)
+    queue_size = Int(1000, help='bodies waiting for the parser').tag(
+        config=True)
+    idle_for = Float(0, help='seconds to IDLE for new emails after '
+                             'fetching, 0 does not idle').tag(config=True)
+
+    async def aconnect(self):
+        c = await AsyncIMAP().connect(self.hostname, self.port, self.ssl)
+        try:
+            await c.login(self.user, self.pwd)
+            info = await c.examine(self.folder)
+        except BaseException:
+            c.close()
+            raise
+        return c, info
+
+    async def afetch_subjects(self, c, uids):
+        """Same as fetch_subjects.
+
+        Returns:
+            {idx: subject}
+        """
+        subjects = {}
+
+        async def keep(idx, data):
+            if b'BODYSTRUCTURE' in data:
+                self.parts[idx] = pick_part(data[b'BODYSTRUCTURE'],
+                                            self.prefer_part,
+                                            self.min_part_size)
+            subjects[idx] = data[b'ENVELOPE'].subject.decode('utf-8')
+
+        if uids:
+            await c.fetch(uids, ['ENVELOPE', 'BODYSTRUCTURE'], keep)
+        return subjects
+
+    async def afetch_envelopes(self, c, *extra, seen=()):
+        """Same as fetch_envelopes, uids above a mark with
+        extra = ('UID', 'mark:*'), subjects in seen are kept
+        even with a single new email.
+
+        Returns:
+            {subject: [idx, ...]}
+        """
+        uids = await c.search(self.search_criteria(*extra))
+        emails_by_name = defaultdict(list)
+        for idx, subject in (await self.afetch_subjects(c, uids)).items():
+            emails_by_name[subject].append(idx)
+        return (self.filter_subjects(emails_by_name, seen),
+                max(uids, default=0))
+
+    async def afetch_bodies(self, conns, emails_by_name, queue):
+        """Fetch the planned batches, one FETCH per section of
+        each batch, over conns with at most in_flight at once,
+        putting (subject, idx, body) on queue as they land."""
+        subjects = {idx: subject for subject, idxs in emails_by_name.items()
+                    for idx in idxs}
+        parts = self.take_parts(subjects)
+        limit = asyncio.Semaphore(max(self.in_flight, 1))
+
+        # every FETCH response of a uid lands here, whichever
+        # BODY[section] was asked for it
+        async def land(idx, data):
+            for key, raw in data.items():
+                if key.startswith(b'BODY[') and idx in subjects:
+                    body = part_text(parts[idx], raw)
+                    await queue.put((subjects[idx], idx, body))
+
+        async def fetch(c, section, idxs):
+            async with limit:
+                await c.fetch(idxs, [f'BODY[{section}]'], land)
+
+        fetches = []
+        for i, idxs in enumerate(self.plan_fetch(emails_by_name)):
+            by_section = defaultdict(list)
+            for idx in idxs:
+                by_section[parts[idx].section].append(idx)
+            for section, ids in by_section.items():
+                fetches.append(fetch(conns[i % len(conns)], section, ids))
+        await asyncio.gather(*fetches)
+
+    async def produce(self, queue):
+        """Put every order email on queue as (subject, idx,
+        body) as it is fetched, then None. If fetching fails
+        or is cancelled the connections are closed and the
+        None is put without waiting, the consumer may be gone
+        (see end_queue)."""
+        print("fetching orders:", self.hostname)
+        conns = []
+        try:
+            c, info = await self.aconnect()
+            conns.append(c)
+            self.source = f'imap:{self.folder}:{info[b"UIDVALIDITY"]}'
+            emails_by_name, mark = await self.afetch_envelopes(c)
+            nbatch = len(self.plan_fetch(emails_by_name))
+            extra = max(min(self.connections, nbatch), 1) - 1
+            conns.extend(c for c, _ in await asyncio.gather(
+                *(self.aconnect() for _ in range(extra))))
+            print(f'fetching bodies in {nbatch} batches over '
+                  f'{len(conns)} connections')
+            await self.afetch_bodies(conns, emails_by_name, queue)
+            if self.idle_for > 0:
+                await self.watch(c, conns, mark, queue, set(emails_by_name))
+        except BaseException:
+            # a body landing on the full queue holds up the read
+            # loop, a LOGOUT would never be answered
+            for c in conns:
+                c.close()
+            self.end_queue(queue)
+            raise
+        await asyncio.gather(*(c.logout() for c in conns))
+        await queue.put(None)
+
+    @staticmethod
+    def end_queue(queue):
+        """Put the None that ends queue without waiting for
+        room, dropping the oldest item of a full queue: its
+        consumer has stopped, or will stop on the error."""
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    async def watch(self, c, conns, mark, queue, seen):
+        """IDLE for idle_for seconds, fetching the order
+        emails above mark whenever new ones arrive. New
+        emails usually come one at a time, their subjects
+        are matched against the order subjects seen."""
+        loop = asyncio.get_running_loop()
+        end = loop.time() + self.idle_for
+        while loop.time() < end:
+            if not await c.idle(end - loop.time()):
+                continue
+            emails_by_name, top = await self.afetch_envelopes(
+                c, 'UID', f'{mark + 1}:*', seen=seen)
+            # n:* always matches the newest message so filter again
+            emails_by_name = {
+                subject: [idx for idx in idxs if idx > mark]
+                for subject, idxs in emails_by_name.items()}
+            mark = max(mark, top)
+            seen.update(emails_by_name)
+            print(f'fetching {sum(map(len, emails_by_name.values()))} '
+                  f'new emails')
+            await self.afetch_bodies(conns, emails_by_name, queue)
+
+    async def iter_queue(self, queue):
+        """Yields:
+            (subject, idx, body) from queue until None
+        """
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            yield item
+
+    async def afetch_orders(self):
+        """Same as fetch_orders.
+
+        Returns:
+            {subject: [(idx, body), ...]}
+        """
+        queue = asyncio.Queue(self.queue_size)
+        fetch = asyncio.create_task(self.produce(queue))
+        items = [item async for item in self.iter_queue(queue)]
+        await fetch
+        return self.collect(items)
@@ -5,15 +5,12 @@
 """
 import os
 import sys
-from functools import partial
+from functools import partial, cached_property
 
 from traitlets.config.application import Application
-from traitlets import Unicode, default, validate
+from traitlets import Unicode, Bool, default, validate
 
 from stonks import _root
-from stonks.mailbox import Mailbox
-from stonks.parser import EmailParser, StatementParser
-from stonks.processor import Processor
 
 
 _here = partial(os.path.join, _root, 'conf')
@@ -23,6 +20,20 @@ class App(Application):
     cfg_file = Unicode(_here('cfg.py')).tag(config=True)
     sec_file = Unicode().tag(config=True)
     mode = Unicode('email').tag(config=True)
+    stream = Bool(False, help='parse emails as they are fetched').tag(
+        config=True)
+    columnar = Bool(False, help='parse straight into columns').tag(
+        config=True)
+    aio = Bool(False, help='fetch with the AsyncMailbox, parsing emails '
+                           'as they land').tag(config=True)
+    from_store = Bool(False, help='analyze the record store only').tag(
+        config=True)
+    instrument = Bool(False, help='time the stages of the run').tag(
+        config=True)
+    stats_file = Unicode('', help='write the stage stats here as json').tag(
+        config=True)
+    profile_dir = Unicode('', help='dump a cProfile per stage here').tag(
+        config=True)
 
     @default('sec_file')
     def _default_sec_file(self):
@@ -40,21 +51,87 @@ class App(Application):
             self.load_config_file(self.cfg_file)
         if self.sec_file:
             self.load_config_file(self.sec_file)
-        if self.mode == 'email':
-            self.parser = EmailParser(config=self.config,
-                                      mailbox=Mailbox(config=self.config))
+        self.stages = None
+        if self.instrument or self.stats_file or self.profile_dir:
+            from stonks.instrument import Stages
+            self.stages = Stages(profile_dir=self.profile_dir)
+        # only the backends of the mode are imported, pandas
+        # not before there is something to analyze
+        if self.from_store:
+            self.parser = None
+        elif self.mode == 'email':
+            if self.aio:
+                from stonks.aiomailbox import AsyncMailbox as Mailbox
+            else:
+                from stonks.mailbox import Mailbox
+            from stonks.parser import EmailParser
+            mailbox = self.instrumented(Mailbox(config=self.config))
+            self.parser = self.instrumented(
+                EmailParser(config=self.config, mailbox=mailbox))
         else:
-            self.parser = StatementParser(config=self.config)
-        self.processor = Processor(config=self.config)
+            from stonks.parser import StatementParser
+            self.parser = self.instrumented(
+                StatementParser(config=self.config))
+
+    def instrumented(self, obj):
+        """obj with its stages timed if instrumented."""
+        return self.stages.wrap(obj) if self.stages else obj
+
+    @cached_property
+    def processor(self):
+        from stonks.processor import Processor
+        return self.instrumented(Processor(config=self.config))
+
+    @cached_property
+    def store(self):
+        from stonks.store import RecordStore
+        return self.instrumented(RecordStore(config=self.config))
+
+    def analyze(self, df):
+        """Keep the records if there is a store, then analyze."""
+        if self.store.path:
+            self.store.append(df)
+        self.processor.analyze(df)
 
     def run(self):
-        records, not_parsed = self.parser.parse_orders()
-        if self.mode == 'email':
-            df = self.processor.records_to_df(records)
+        try:
+            self.run_mode()
+        finally:
+            if self.stages:
+                self.stages.show()
+                self.stages.dump(self.stats_file)
+
+    def run_mode(self):
+        if self.from_store:
+            df = self.store.load(columns=self.processor.columns)
             self.processor.analyze(df)
-        else:
-            print(records, not_parsed)
-            #records, not_parsed = self.parser.parse_orders()
+            return
+        if self.mode == 'email' and self.columnar:
+            df = self.processor.columns_to_df(self.parser.parse_columns())
+            self.analyze(df)
+            return
+        if self.mode == 'email' and self.aio:
+            import asyncio
+            records, not_parsed = asyncio.run(
+                self.parser.parse_orders_async())
+            df = self.processor.records_to_df(records)
+            self.analyze(df)
+            return
+        if self.mode == 'email' and self.stream:
+            records = self.parser.iter_records()
+            df = self.processor.stream_to_df(records)
+            self.analyze(df)
+            return
+        if self.mode == 'dumps':
+            records, holdings, not_parsed = self.parser.parse_statements()
+            if records:
+                df = self.processor.records_to_df(records)
+                self.analyze(df)
+            print(self.processor.holdings_to_df(holdings))
+            return
+        records, not_parsed = self.parser.parse_orders()
+        df = self.processor.records_to_df(records)
+        self.analyze(df)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Benchmarks over the synthetic corpus in stonks.synth.
+Run them all or by name:
+
+    python -m stonks.bench [name ...] [--n=100000]
+
+With --history=FILE every result is appended to FILE as
+a json line, with the time, commit and parameters, and
+compared to the last result of the same benchmark with
+the same parameters.
+"""
+import os
+import sys
+import json
+import time
+import contextlib
+import subprocess
+import tracemalloc
+
+from stonks.synth import corpus
+
+
+def best_of(func, *args, repeat=3):
+    """Best wall time of repeat calls, and the last result."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def email_parser():
+    from traitlets.config import Config
+    from stonks.parser import EmailParser
+    cfg = Config()
+    cfg.EmailParser.stop_chars = ['=0D', '=']
+    cfg.EmailParser.stop_phrases = [
+        '[', 'If you have any', 'Your trade confirmation']
+    return EmailParser(config=cfg)
+
+
+def legacy_normalize(parser, bod):
+    """The per-phrase, per-line normalization that
+    EmailParser.tokenize replaced."""
+    for stop in parser.stop_chars:
+        bod = bod.replace(stop, '')
+    for stop_phrase in parser.stop_phrases:
+        bod = bod.split(stop_phrase)[0]
+    bod = ' '.join((
+        ' '.join(ln.split()) for ln in bod.splitlines()
+    ))
+    return bod.split()
+
+
+def bench_normalize(n=100000):
+    """Body normalization down to the token list."""
+    parser = email_parser()
+    bodies = [bod for _, _, bod in corpus(n)]
+    old, want = best_of(
+        lambda: [legacy_normalize(parser, bod) for bod in bodies])
+    new, got = best_of(
+        lambda: [parser.tokenize(bod) for bod in bodies])
+    assert got == want
+    return {'bodies': n, 'legacy_s': old, 'tokenize_s': new,
+            'speedup': old / new}
+
+
+def held_bytes(func):
+    """Bytes still allocated by the result of func."""
+    tracemalloc.start()
+    result = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_records(n=1000000):
+    """Construction time and memory of n Record vs
+    CompactRecord built from parsed dicts. A million
+    Records take minutes, pass a smaller n for a quick
+    run."""
+    from stonks.record import Record, CompactRecord
+    parser = email_parser()
+    dicts = []
+    for subject, idx, bod in corpus(1000):
+        try:
+            dicts.append(parser.parse_order_to_dict(
+                subject, idx, parser.tokenize(bod)))
+        except Exception:
+            pass
+    dicts = (dicts * (n // len(dicts) + 1))[:n]
+    build = {
+        'record': lambda: [Record(**r) for r in dicts],
+        'compact': lambda: [CompactRecord(**r) for r in dicts],
+        'compact_bulk': lambda: CompactRecord.from_dicts(dicts),
+    }
+    result = {'records': n}
+    for name, func in build.items():
+        result[f'{name}_s'] = best_of(func, repeat=1)[0]
+        result[f'{name}_mb'] = held_bytes(func) / 1e6
+    return result
+
+
+def legacy_positions(df):
+    """The per-group loop that Processor.compute_positions
+    replaced."""
+    import pandas as pd
+    import datetime as dt
+    inputs = ['ticker', 'strike', 'order', 'expiration']
+    outputs = ['sells', 'buys', 'count', 'amount']
+    pos = []
+    for tup, grp in df.groupby(inputs, observed=True):
+        sub = grp.groupby('direction', observed=True)
+        buy_cnt, sel_cnt, buy_amt, sel_amt = 0, 0, 0, 0
+        try:
+            buy = sub.get_group('buy')
+            buy_cnt = buy['count'].sum()
+            buy_amt = buy['total_amount'].sum()
+        except KeyError:
+            pass
+        try:
+            sel = sub.get_group('sell')
+            sel_cnt = sel['count'].sum()
+            sel_amt = sel['total_amount'].sum()
+        except KeyError:
+            pass
+        count = sel_cnt - buy_cnt
+        amount = sel_amt - buy_amt
+        if count < 0 and tup[-1]:
+            if pd.Timestamp(tup[-1]) < dt.datetime.today():
+                count = 0
+        pos.append((*tup, *(sel_cnt, buy_cnt, count, amount)))
+    return pd.DataFrame(pos, columns=inputs + outputs)
+
+
+def position_frame(n, seed=0):
+    """Executions over n distinct positions, 1 to 4 legs
+    each, a third of them options some of them expired."""
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    legs = rng.integers(1, 5, n)
+    pos = np.repeat(np.arange(n), legs)
+    option = pos % 3 == 0
+    expir = np.where(
+        option, np.char.add(
+            np.char.add((pos % 12 + 1).astype(str), '/'),
+            np.char.add((pos % 28 + 1).astype(str),
+                        np.where(pos % 2, '/19', '/29'))), '')
+    return pd.DataFrame({
+        'ticker': np.char.add('T', pos.astype(str)),
+        'strike': np.where(option,
+                           np.char.add('$', (pos % 7).astype(str)), ''),
+        'order': np.where(option, 'Call', ''),
+        'expiration': expir,
+        'direction': rng.choice(['buy', 'sell'], len(pos)),
+        'count': rng.integers(1, 100, len(pos)).astype(float),
+        'total_amount': rng.uniform(1, 1000, len(pos)),
+    })
+
+
+def bench_positions(n=100000, legacy_n=5000):
+    """compute_positions over n positions, checked
+    against the legacy loop on legacy_n of them."""
+    import pandas as pd
+    from stonks.processor import Processor
+    proc = Processor()
+    small = position_frame(legacy_n)
+    old, want = best_of(legacy_positions, small, repeat=1)
+    new_small, got = best_of(proc.compute_positions, small)
+    pd.testing.assert_frame_equal(got, want, check_dtype=False)
+    new, got = best_of(proc.compute_positions, position_frame(n))
+    assert len(got) == n
+    return {'positions': n, 'legacy_n': legacy_n, 'legacy_s': old,
+            'vectorized_small_s': new_small, 'vectorized_s': new,
+            'speedup_at_legacy_n': old / new_small}
+
+
+def legacy_activity(split, tokens):
+    """parse_activity before the single pass cursor,
+    slicing the rest of the list per line item."""
+    good = []
+    while True:
+        try:
+            cnt = 0
+            while cnt < len(split) and split[cnt] in tokens:
+                cnt += 1
+            split = split[cnt:]
+            if '/' in split[1] and split[3].startswith('$'):
+                good.append(('contract', *split[:4]))
+                split = split[4:]
+            else:
+                cnt = 0
+                while 'CUSIP' not in split[cnt]:
+                    cnt += 1
+                good.append(('share', ' '.join(split[:cnt + 2])))
+                split = split[cnt + 2:]
+        except IndexError:
+            break
+    return good
+
+
+def bench_activity(n=10000, legacy_n=2000):
+    """parse_activity over an n line item section, the
+    legacy scan on legacy_n of them."""
+    from traitlets.config import Config
+    from stonks.parser import StatementParser
+    from stonks.synth import activity_section
+    cfg = Config()
+    cfg.StatementParser.activity_tokens = [
+        'DESCRIPTION', 'SYMBOL', 'ACCT TYPE', 'TRANSACTION', 'DATE', 'QTY',
+        'PRICE', 'DEBIT', 'CREDIT']
+    parser = StatementParser(config=cfg)
+    small = ' '.join(activity_section(legacy_n).split())
+    old, _ = best_of(legacy_activity, small.split(),
+                     parser.activity_tokens, repeat=1)
+    new_small, _ = best_of(parser.parse_activity, small)
+    page = ' '.join(activity_section(n).split())
+    new, items = best_of(parser.parse_activity, page)
+    assert len(items) == n
+    return {'line_items': n, 'legacy_n': legacy_n, 'legacy_s': old,
+            'cursor_small_s': new_small, 'cursor_s': new,
+            'speedup_at_legacy_n': old / new_small}
+
+
+def fill_frame(n, positions, seed=0):
+    """n Record-like executions spread over positions,
+    every fifth a partial fill and every third position
+    an option."""
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    pos = rng.integers(0, positions, n)
+    option = pos % 3 == 0
+    count = rng.integers(1, 100, n).astype(float)
+    partial = np.arange(n) % 5 == 0
+    return pd.DataFrame({
+        'email_id': np.arange(n),
+        'ticker': np.char.add('T', pos.astype(str)),
+        'kind': np.where(option, 'contract', 'share'),
+        'strike': np.where(option, (pos % 7).astype(float), 0.),
+        'order': np.where(option, 'Call', ''),
+        'expiration': np.where(option, '06/19/20', ''),
+        'direction': rng.choice(['buy', 'sell'], n),
+        'count': count,
+        'avg_price': rng.uniform(1, 100, n),
+        'total_amount': 0.,
+        'partial': partial,
+        'partial_amount': np.where(partial, np.ceil(count / 2), 0.),
+        'partial_price': 0.,
+        'year': 2020, 'month': rng.integers(1, 13, n),
+        'day': rng.integers(1, 29, n), 'hour': rng.integers(1, 13, n),
+        'minute': rng.integers(0, 60, n),
+        'meridiem': rng.choice(['AM', 'PM'], n),
+    })
+
+
+def legacy_datetimes(df):
+    """Per-row string formatting then parsing."""
+    import pandas as pd
+    text = (df['year'].apply('{:04d}'.format) + '-'
+            + df['month'].apply('{:02d}'.format) + '-'
+            + df['day'].apply('{:02d}'.format) + ' '
+            + df['hour'].apply('{:02d}'.format) + ':'
+            + df['minute'].apply('{:02d}'.format) + ' ' + df['meridiem'])
+    return pd.to_datetime(text, format='%Y-%m-%d %I:%M %p').dt.tz_localize(
+        'America/New_York', ambiguous=True, nonexistent='shift_forward')
+
+
+def bench_datetimes(n=300000):
+    """execution_ts and expiration_ts from the integer
+    columns against formatting strings per row."""
+    from stonks.processor import Processor
+    df = fill_frame(n, 5000)
+    old, want = best_of(legacy_datetimes, df, repeat=1)
+    new, got = best_of(Processor().normalize_datetimes, df)
+    assert (got['execution_ts'] == want).all()
+    return {'rows': n, 'legacy_s': old, 'vectorized_s': new,
+            'speedup': old / new}
+
+
+def bench_lots(n=300000, positions=5000):
+    """FIFO and LIFO lot matching over n fills."""
+    from stonks.lots import LotMatcher
+    from stonks.processor import Processor
+    df = Processor().normalize_datetimes(fill_frame(n, positions))
+    fifo, (lots, _) = best_of(LotMatcher(method='fifo').match, df,
+                              repeat=1)
+    lifo, _ = best_of(LotMatcher(method='lifo').match, df, repeat=1)
+    return {'fills': n, 'lots': len(lots), 'fifo_s': fifo,
+            'lifo_s': lifo, 'fills_per_s': n / fifo}
+
+
+def bench_parse_cache(n=20000):
+    """Parsing n bodies without the parse cache, with an
+    empty one and with every body already in it."""
+    import os
+    import tempfile
+    parser = email_parser()
+    bodies = corpus(n)
+    run = lambda: list(parser.iter_dicts(bodies))
+    plain, _ = best_of(run)
+    with tempfile.TemporaryDirectory() as tmp:
+        parser.parse_cache = os.path.join(tmp, 'parses.sqlite')
+        cold, _ = best_of(run, repeat=1)
+        warm, _ = best_of(run)
+    return {'bodies': n, 'plain_s': plain, 'cold_s': cold, 'warm_s': warm,
+            'speedup': plain / warm}
+
+
+STARTUP = {
+    'import': 'import stonks',
+    'eager': ('import stonks.record, stonks.mailbox, stonks.parser, '
+              'stonks.processor, stonks.lots, stonks.store, pdfminer.pdfpage, '
+              'pdfminer.pdfinterp, pdfminer.converter, pdfminer.layout'),
+    'email': ('from stonks.app import App; '
+              "App().initialize(['--App.sec_file='])"),
+    'dumps': ('from stonks.app import App; '
+              "App().initialize(['--App.mode=dumps', '--App.sec_file='])"),
+}
+
+
+def bench_startup(runs=5, n=None):
+    """Wall time of a fresh interpreter importing stonks,
+    importing every backend up front as it used to, and
+    initializing the App in each mode. n is not used."""
+    import os
+    import subprocess
+    from stonks import _root
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(_root), os.environ.get('PYTHONPATH', '')]))
+    run = lambda code: subprocess.run([sys.executable, '-c', code],
+                                      env=env, check=True)
+    result = {}
+    base, _ = best_of(run, 'pass', repeat=runs)
+    for name, code in STARTUP.items():
+        result[f'{name}_s'] = best_of(run, code, repeat=runs)[0] - base
+    return result
+
+
+def shipped_config():
+    """The config of stonks/conf/cfg.py with debug output
+    off and no statements."""
+    from traitlets.config.loader import PyFileConfigLoader
+    from stonks import _root
+    cfg = PyFileConfigLoader('cfg.py', path=os.path.join(
+        _root, 'conf')).load_config()
+    for name in ['EmailParser', 'StatementParser', 'Processor']:
+        cfg[name].debug = 0
+    cfg.StatementParser.statements = []
+    return cfg
+
+
+def quiet(func, *args):
+    """Call func with its progress output discarded."""
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        return func(*args)
+
+
+def bench_pipeline(n=20000):
+    """The email path end to end with the shipped config:
+    fetch n emails from a fake IMAP server, parse them,
+    build the dataframe and compute positions and lots."""
+    from stonks.fakeimap import FakeIMAPServer, make_message
+    from stonks.mailbox import Mailbox
+    from stonks.parser import EmailParser
+    from stonks.processor import Processor
+    cfg = shipped_config()
+    msgs = [make_message(idx, subject, bod)
+            for subject, idx, bod in corpus(n)]
+    with FakeIMAPServer(msgs, user='user', pwd='pwd') as srv:
+        mailbox = Mailbox(config=cfg, hostname=srv.host, port=srv.port,
+                          ssl=False, user='user', pwd='pwd', cache_file='')
+        fetch, orders = best_of(quiet, mailbox.fetch_orders, repeat=1)
+    stream = [(subject, idx, bod) for subject, bods in orders.items()
+              for idx, bod in bods]
+    parser = EmailParser(config=cfg, mailbox=mailbox)
+    parse, records = best_of(
+        quiet, lambda: list(parser.iter_records(stream)))
+    proc = Processor(config=cfg)
+    frame, df = best_of(quiet, lambda: proc.add_date_and_fix_expir_year(
+        proc.normalize_datetimes(proc.records_to_df(records))))
+    positions, _ = best_of(quiet, proc.compute_positions, df)
+    lots, _ = best_of(quiet, proc.match_lots, df)
+    return {'emails': len(stream), 'records': len(records),
+            'fetch_s': fetch, 'parse_s': parse, 'frame_s': frame,
+            'positions_s': positions, 'lots_s': lots,
+            'emails_per_s': len(stream) / (fetch + parse + frame)}
+
+
+def bench_aio(n=5000, latency_ms=2, batch_size=100):
+    """Fetch and parse n emails from a fake IMAP server
+    answering every command after latency_ms, streaming
+    with the Mailbox and with the AsyncMailbox."""
+    import asyncio
+    from stonks.fakeimap import FakeIMAPServer, make_message
+    from stonks.mailbox import Mailbox
+    from stonks.aiomailbox import AsyncMailbox
+    from stonks.parser import EmailParser
+    cfg = shipped_config()
+    msgs = [make_message(idx, subject, bod)
+            for subject, idx, bod in corpus(n)]
+    kws = dict(config=cfg, ssl=False, user='user', pwd='pwd',
+               cache_file='', batch_size=batch_size)
+    with FakeIMAPServer(msgs, user='user', pwd='pwd',
+                        latency=latency_ms / 1000) as srv:
+        kws.update(hostname=srv.host, port=srv.port)
+        parser = EmailParser(config=cfg, mailbox=Mailbox(**kws))
+        sync, records = best_of(
+            quiet, lambda: list(parser.iter_records()), repeat=1)
+        parser = EmailParser(config=cfg, mailbox=AsyncMailbox(**kws))
+        aio, (arecords, _) = best_of(
+            quiet, lambda: asyncio.run(parser.parse_orders_async()), repeat=1)
+    return {'emails': n, 'records': len(records), 'aio_records': len(arecords),
+            'sync_s': sync, 'aio_s': aio, 'speedup': sync / aio}
+
+
+def bench_statements(n=20, pages=10, items=40):
+    """Parse n statement text dumps of pages pages with
+    items account activity line items each."""
+    import tempfile
+    from stonks.parser import StatementParser
+    from stonks.synth import statements
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = statements(tmp, n, pages, items)
+        parser = StatementParser(config=shipped_config(), statements=paths)
+        parse, (records, holdings, _) = best_of(
+            quiet, parser.parse_statements)
+    return {'statements': n, 'pages': n * pages, 'records': len(records),
+            'holdings': len(holdings), 'parse_s': parse,
+            'pages_per_s': n * pages / parse}
+
+
+BENCHES = {
+    'normalize': bench_normalize,
+    'records': bench_records,
+    'positions': bench_positions,
+    'datetimes': bench_datetimes,
+    'lots': bench_lots,
+    'activity': bench_activity,
+    'parse_cache': bench_parse_cache,
+    'startup': bench_startup,
+    'pipeline': bench_pipeline,
+    'statements': bench_statements,
+    'aio': bench_aio,
+}
+
+
+def commit():
+    """Short hash of the checked out commit, with -dirty
+    if there are local changes, '' outside of git."""
+    from stonks import _root
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=_root,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def track(path, name, kws, result):
+    """Append a result to the history in path and print
+    how its timings moved since the last comparable run."""
+    last = None
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry['bench'] == name and entry['params'] == kws:
+                    last = entry
+    entry = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit(),
+             'bench': name, 'params': kws, 'result': result}
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    if last is None:
+        return
+    for key, val in result.items():
+        old = last['result'].get(key)
+        if key.endswith('_s') and '_per_' not in key and old:
+            print(f'  {key} {old:.4g} -> {val:.4g} ({val / old - 1:+.0%} '
+                  f'since {last["commit"] or last["time"]})')
+
+
+def main(argv):
+    kws = dict(arg[2:].split('=') for arg in argv if arg.startswith('--'))
+    history = kws.pop('history', '')
+    kws = {key: int(val) for key, val in kws.items()}
+    names = [arg for arg in argv if not arg.startswith('--')] or BENCHES
+    for name in names:
+        result = BENCHES[name](**kws)
+        print(name, ' '.join(
+            f'{key}={val:.4g}' if isinstance(val, float) else f'{key}={val}'
+            for key, val in result.items()))
+        if history:
+            track(history, name, kws, result)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
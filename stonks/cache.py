@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+import os
+import json
+import pickle
+import sqlite3
+import hashlib
+from collections import defaultdict, OrderedDict
+
+
+class MessageCache:
+    """A sqlite backed store of every broker email seen
+    so far, keyed by (folder, uidvalidity, uid). Subjects
+    are stored for every message the Mailbox's SEARCH
+    criteria matched, bodies only for the ones that were
+    fetched. The criteria are stored with them: while they
+    do not change only uids above the watermark are new,
+    when they do the Mailbox matches them against the whole
+    history again and keeps only what they match.
+    The body part chosen from each message's structure is
+    kept with its subject, for bodies fetched in a later run.
+
+    The watermark is the highest uid stored for the
+    folder's current uidvalidity. If the server reports
+    a new uidvalidity the old uids are meaningless and
+    are dropped.
+    """
+    schema = """
+    CREATE TABLE IF NOT EXISTS messages (
+        folder TEXT NOT NULL,
+        uidvalidity INTEGER NOT NULL,
+        uid INTEGER NOT NULL,
+        subject TEXT NOT NULL,
+        part TEXT,
+        body TEXT,
+        PRIMARY KEY (folder, uidvalidity, uid)
+    );
+    CREATE TABLE IF NOT EXISTS searches (
+        folder TEXT NOT NULL,
+        uidvalidity INTEGER NOT NULL,
+        criteria TEXT NOT NULL,
+        PRIMARY KEY (folder, uidvalidity)
+    );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.executescript(self.schema)
+        # files written before parts were kept
+        if 'part' not in {row[1] for row in self.con.execute(
+                'PRAGMA table_info(messages)')}:
+            self.con.execute('ALTER TABLE messages ADD COLUMN part TEXT')
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def validate(self, folder, uidvalidity):
+        """Drop anything cached under a stale uidvalidity."""
+        with self.con:
+            for table in ('messages', 'searches'):
+                self.con.execute(
+                    f'DELETE FROM {table} WHERE folder = ? '
+                    f'AND uidvalidity != ?', (folder, uidvalidity))
+
+    def criteria(self, folder, uidvalidity):
+        """Returns:
+            the criteria the cached subjects matched or None
+        """
+        row = self.con.execute(
+            'SELECT criteria FROM searches '
+            'WHERE folder = ? AND uidvalidity = ?',
+            (folder, uidvalidity)).fetchone()
+        return row[0] if row else None
+
+    def set_criteria(self, folder, uidvalidity, criteria):
+        with self.con:
+            self.con.execute(
+                'INSERT OR REPLACE INTO searches '
+                '(folder, uidvalidity, criteria) VALUES (?, ?, ?)',
+                (folder, uidvalidity, criteria))
+
+    def uids(self, folder, uidvalidity):
+        return {uid for uid, in self.con.execute(
+            'SELECT uid FROM messages WHERE folder = ? AND uidvalidity = ?',
+            (folder, uidvalidity))}
+
+    def keep(self, folder, uidvalidity, uids):
+        """Drop the messages whose uid is not in uids."""
+        drop = self.uids(folder, uidvalidity) - set(uids)
+        with self.con:
+            self.con.executemany(
+                'DELETE FROM messages '
+                'WHERE folder = ? AND uidvalidity = ? AND uid = ?',
+                ((folder, uidvalidity, uid) for uid in drop))
+
+    def watermark(self, folder, uidvalidity):
+        row = self.con.execute(
+            'SELECT MAX(uid) FROM messages '
+            'WHERE folder = ? AND uidvalidity = ?',
+            (folder, uidvalidity)).fetchone()
+        return row[0] or 0
+
+    def add_subjects(self, folder, uidvalidity, subjects, parts=None):
+        """Store {uid: subject} for newly seen messages, with
+        the {uid: part tuple} to fetch their bodies from."""
+        parts = parts or {}
+        with self.con:
+            self.con.executemany(
+                'INSERT OR IGNORE INTO messages '
+                '(folder, uidvalidity, uid, subject, part) '
+                'VALUES (?, ?, ?, ?, ?)',
+                ((folder, uidvalidity, uid, subject,
+                  json.dumps(parts[uid]) if uid in parts else None)
+                 for uid, subject in subjects.items()))
+
+    def add_bodies(self, folder, uidvalidity, bodies):
+        """Store {uid: body} for previously seen messages."""
+        with self.con:
+            self.con.executemany(
+                'UPDATE messages SET body = ? '
+                'WHERE folder = ? AND uidvalidity = ? AND uid = ?',
+                ((body, folder, uidvalidity, uid)
+                 for uid, body in bodies.items()))
+
+    def subjects(self, folder, uidvalidity):
+        """Returns:
+            {subject: [uid, ...]}
+        """
+        emails_by_name = defaultdict(list)
+        for uid, subject in self.con.execute(
+                'SELECT uid, subject FROM messages '
+                'WHERE folder = ? AND uidvalidity = ? ORDER BY uid',
+                (folder, uidvalidity)):
+            emails_by_name[subject].append(uid)
+        return emails_by_name
+
+    def parts(self, folder, uidvalidity, uids):
+        """Returns:
+            {uid: [part fields]} for the uids that have a part
+        """
+        parts = {}
+        uids = list(uids)
+        for i in range(0, len(uids), 500):
+            chunk = uids[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            parts.update((uid, json.loads(part)) for uid, part in
+                         self.con.execute(
+                             f'SELECT uid, part FROM messages '
+                             f'WHERE folder = ? AND uidvalidity = ? '
+                             f'AND part IS NOT NULL AND uid IN ({marks})',
+                             (folder, uidvalidity, *chunk)))
+        return parts
+
+    def bodies(self, folder, uidvalidity, uids):
+        """Returns:
+            {uid: body} for the uids that have a cached body
+        """
+        bodies = {}
+        uids = list(uids)
+        # stay under sqlite's bound parameter limit
+        for i in range(0, len(uids), 500):
+            chunk = uids[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            bodies.update(self.con.execute(
+                f'SELECT uid, body FROM messages '
+                f'WHERE folder = ? AND uidvalidity = ? '
+                f'AND body IS NOT NULL AND uid IN ({marks})',
+                (folder, uidvalidity, *chunk)))
+        return bodies
+
+
+class TextCache:
+    """Text extracted from statement documents, kept in a
+    directory as one file per sha256 of the document's
+    bytes so a statement is only ever analyzed once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def digest(path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def get(self, digest):
+        """Returns:
+            the cached text or None
+        """
+        try:
+            with open(os.path.join(self.path, f'{digest}.txt'), 'r',
+                      encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def find(self, digest):
+        """Returns:
+            the path of the cached text or None
+        """
+        path = os.path.join(self.path, f'{digest}.txt')
+        return path if os.path.isfile(path) else None
+
+    def put(self, digest, text):
+        path = os.path.join(self.path, f'{digest}.txt')
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(f'{path}.tmp', path)
+
+    def tee(self, digest, pieces):
+        """Yield pieces of text while writing them to the
+        cache, only committed once all of them were seen.
+        A consumer that stops early leaves nothing behind."""
+        path = os.path.join(self.path, f'{digest}.txt')
+        try:
+            with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+                for piece in pieces:
+                    f.write(piece)
+                    yield piece
+            os.replace(f'{path}.tmp', path)
+        finally:
+            if os.path.exists(f'{path}.tmp'):
+                os.remove(f'{path}.tmp')
+
+
+class ParseCache:
+    """Email parse results in a sqlite file, keyed by a
+    digest of the body as fetched prefixed with the parser
+    fingerprint. Entries live in memory as an LRU of at
+    most size entries; the least recently used are dropped
+    from the file as well on close. The recency of hits is
+    saved in steps of 500 uses.
+
+    The bodies that failed to parse in the last run are
+    kept too, so they can be looked at without a run.
+    """
+    schema = """
+    CREATE TABLE IF NOT EXISTS parses (
+        key TEXT PRIMARY KEY,
+        result BLOB NOT NULL,
+        used INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS misses (
+        subject TEXT,
+        idx INTEGER,
+        body TEXT,
+        error TEXT
+    );
+    """
+
+    def __init__(self, path, size=100000):
+        self.path = path
+        self.size = size
+        self.con = sqlite3.connect(path)
+        self.con.executescript(self.schema)
+        # only the size most recently used are read, the rest
+        # would be evicted right away
+        self.entries = OrderedDict(self.con.execute(
+            'SELECT key, result FROM (SELECT key, result, used FROM parses '
+            'ORDER BY used DESC LIMIT ?) ORDER BY used', (size,)))
+        if len(self.entries) == size:
+            with self.con:
+                self.con.execute(
+                    'DELETE FROM parses WHERE key NOT IN (SELECT key FROM '
+                    'parses ORDER BY used DESC LIMIT ?)', (size,))
+        self.clock = self.con.execute(
+            'SELECT MAX(used) FROM parses').fetchone()[0] or 0
+        self.used, self.added, self.evicted = {}, set(), set()
+        self.missed, self.hits = [], 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def touch(self, key):
+        self.clock += 1
+        self.used[key] = self.clock
+        self.entries.move_to_end(key)
+
+    def get(self, key):
+        """Returns:
+            (dict or None, error or None) or None if unseen
+        """
+        result = self.entries.get(key)
+        if result is None:
+            return None
+        self.touch(key)
+        self.hits += 1
+        return pickle.loads(result)
+
+    def put(self, key, r, err):
+        self.entries[key] = pickle.dumps((r, err), protocol=-1)
+        self.touch(key)
+        self.added.add(key)
+        self.evicted.discard(key)
+        while len(self.entries) > self.size:
+            old, _ = self.entries.popitem(last=False)
+            self.used.pop(old, None)
+            self.added.discard(old)
+            self.evicted.add(old)
+
+    def miss(self, subject, idx, body, err):
+        self.missed.append((subject, idx, body, err))
+
+    def misses(self):
+        """Returns:
+            [(subject, idx, normalized body, error), ...] of
+            the last run
+        """
+        return self.con.execute(
+            'SELECT subject, idx, body, error FROM misses').fetchall()
+
+    def save(self):
+        with self.con:
+            self.con.executemany(
+                'INSERT OR REPLACE INTO parses (key, result, used) '
+                'VALUES (?, ?, ?)',
+                ((key, self.entries[key], self.used[key])
+                 for key in self.added))
+            # hits only move up in recency, 500 at a time to the
+            # last use among them, an UPDATE per hit cost about as
+            # much as parsing it again
+            hits = sorted((used, key) for key, used in self.used.items()
+                          if key not in self.added)
+            for i in range(0, len(hits), 500):
+                chunk = hits[i:i + 500]
+                self.con.execute(
+                    f'UPDATE parses SET used = ? WHERE key IN '
+                    f'({", ".join("?" * len(chunk))})',
+                    [chunk[-1][0], *(key for _, key in chunk)])
+            self.con.executemany('DELETE FROM parses WHERE key = ?',
+                                 ((key,) for key in self.evicted))
+            if self.used:
+                self.con.execute('DELETE FROM misses')
+                self.con.executemany(
+                    'INSERT INTO misses (subject, idx, body, error) '
+                    'VALUES (?, ?, ?, ?)', self.missed)
+        self.used, self.added, self.evicted = {}, set(), set()
+
+    def close(self):
+        self.save()
+        self.con.close()
@@ -1,6 +1,20 @@
 c = get_config()
 
 c.App.mode = 'email'
+# parse emails while they are still being fetched
+c.App.stream = False
+# parse straight into typed columns, implies streaming
+c.App.columnar = False
+# fetch with the asyncio AsyncMailbox and parse every email
+# as it lands, while the next ones are on the wire
+c.App.aio = False
+# analyze the records in RecordStore.path without fetching or parsing
+c.App.from_store = False
+# time the stages of the run (imap, parsing steps, dataframes,
+# positions), a stats_file or profile_dir also turns it on
+c.App.instrument = False
+c.App.stats_file = ''
+c.App.profile_dir = ''
 
 c.Mailbox.user = ''
 c.Mailbox.pwd = ''
@@ -9,8 +23,37 @@ c.Mailbox.folder = 'inbox'
 c.Mailbox.broker = 'robinhood.com'
 # key words to filter by in email subject
 c.Mailbox.filters = ['Executed',] # 'Placed', 'Canceled']
+# key words excluded from email subject, matched anywhere in it
+# like IMAP SEARCH does, e.g. 'account' also excludes 'accounts'
+c.Mailbox.stop_words = ['login', 'account', 'statement', 'expiring']
+# only search emails on or after this date, YYYY-MM-DD
+c.Mailbox.since = ''
+# sqlite file to cache emails between runs, empty to disable
+c.Mailbox.cache_file = ''
+# number of email ids requested per body fetch
+c.Mailbox.batch_size = 500
+# parallel read-only connections used to fetch bodies
+c.Mailbox.connections = 1
+# body part used when an email has text/plain and text/html,
+# the other one is used if it is missing or too small
+c.Mailbox.prefer_part = 'plain'
+c.Mailbox.min_part_size = 1
+# AsyncMailbox only (App.aio): FETCH commands in flight at once
+# over the connections, bodies waiting for the parser, and
+# seconds to IDLE for new emails after fetching (0 to stop)
+c.AsyncMailbox.in_flight = 4
+c.AsyncMailbox.queue_size = 1000
+c.AsyncMailbox.idle_for = 0
 
 c.EmailParser.debug = 1
+# parse in this many processes, 0 or 1 parses serially
+c.EmailParser.workers = 0
+c.EmailParser.chunk_size = 1000
+# keep parse results in this sqlite file, bodies already
+# parsed with the same stop configs and parser code are not
+# parsed again
+c.EmailParser.parse_cache = ''
+c.EmailParser.parse_cache_size = 100000
 # delete these strings from email body
 c.EmailParser.stop_chars = ['=0D', '=']
 # chop email body after each of these phrases
@@ -32,6 +75,9 @@ c.StatementParser.portfolio_tokens = [
     '% OF TOTAL PORTFOLIO'
 ]
 c.StatementParser.activity_token = 'ACCOUNT ACTIVITY'
+# the account activity ends at this text, repeated table headers
+# before it are skipped
+c.StatementParser.activity_end = 'Total Funds Paid and Received'
 c.StatementParser.activity_tokens = [
     'DESCRIPTION',
     'SYMBOL',
@@ -53,6 +99,35 @@ c.StatementParser.statements = [
 #    '2019_11.txt',
 #    '2019_12.txt',
 ]
+# processes extracting pdfs, 0 or 1 extracts serially
+c.StatementParser.workers = 0
+# split each pdf into tasks of this many pages, 0 for whole files
+c.StatementParser.pages_per_task = 0
+# directory of extracted text keyed by pdf content, empty disables
+c.StatementParser.text_cache = ''
+# ACCT TYPE column values that anchor each statement line item
+c.StatementParser.acct_types = ['Margin', 'Cash']
+# TRANSACTION codes turned into records, everything else is skipped
+c.StatementParser.buy_codes = ['Buy', 'BTO', 'BTC']
+c.StatementParser.sell_codes = ['Sell', 'STO', 'STC']
+
+# directory of parsed records, empty keeps nothing
+c.RecordStore.path = ''
+# partition stored records by execution "month" or by "ticker"
+c.RecordStore.partition_by = 'month'
 
 c.Processor.debug = 1
+# records per dataframe chunk when streaming
+c.Processor.chunk_size = 10000
+# timezone the broker reports execution times in
+c.Processor.timezone = 'America/New_York'
+# json file of running position sums and the (source, email_id)
+# of the records applied to them, empty recomputes every run
+c.Processor.ledger_file = ''
+# match lots for realized PnL, this reads the whole history, None
+# skips it when the ledger is updated incrementally so those runs
+# only prepare the records they have not seen
+c.Processor.lot_matching = None
+# lot matching for realized PnL, one of fifo, lifo, specific
+c.LotMatcher.method = 'fifo'
 
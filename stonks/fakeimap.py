@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+"""A tiny in-memory IMAP4rev1 server to run the Mailbox
+against without a real inbox. Only understands what the
+Mailbox and IMAPClient actually send: LOGIN, SELECT/EXAMINE,
+SEARCH, FETCH (and their UID forms), NOOP, IDLE and LOGOUT.
+
+The server is asyncio based. Use it as an async context
+manager from a running loop or as a plain context manager,
+which serves it from a background thread:
+
+    with FakeIMAPServer(messages) as srv:
+        IMAPClient(srv.host, port=srv.port, ssl=False)
+
+add delivers a message while it runs, clients in IDLE
+are told with an EXISTS response.
+"""
+import re
+import asyncio
+import threading
+import datetime as dt
+from collections import namedtuple
+
+
+FakeMessage = namedtuple('FakeMessage', [
+    'uid', 'subject', 'sender', 'date', 'parts'])
+FakeMessage.__doc__ = """A stored email. parts is a list of
+(maintype, subtype, payload) tuples, BODY[n] is parts[n - 1]."""
+
+
+def make_message(uid, subject, body, html=None,
+                 sender='notifications@robinhood.com', date=None):
+    """Build a FakeMessage with a text/plain part unless
+    body is None and optionally a text/html part."""
+    parts = [('text', 'plain', body)] if body is not None else []
+    if html is not None:
+        parts.append(('text', 'html', html))
+    return FakeMessage(uid, subject, sender,
+                       date or dt.datetime(2020, 1, 1), parts)
+
+
+def quote(s):
+    if s is None:
+        return 'NIL'
+    return '"' + str(s).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def tokenize(text):
+    """Split command arguments into atoms, quoted strings
+    and nested parenthesized lists."""
+    stack = [[]]
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if ch.isspace():
+            i += 1
+        elif ch == '(':
+            stack.append([])
+            i += 1
+        elif ch == ')':
+            group = stack.pop()
+            stack[-1].append(group)
+            i += 1
+        elif ch == '"':
+            j, buf = i + 1, []
+            while text[j] != '"':
+                if text[j] == '\\':
+                    j += 1
+                buf.append(text[j])
+                j += 1
+            stack[-1].append(''.join(buf))
+            i = j + 1
+        else:
+            j = i
+            depth = 0
+            while j < len(text):
+                if text[j] == '[':
+                    depth += 1
+                elif text[j] == ']':
+                    depth -= 1
+                elif depth == 0 and (text[j].isspace() or text[j] in '()'):
+                    break
+                j += 1
+            stack[-1].append(text[i:j])
+            i = j
+    return stack[0]
+
+
+def expand_set(seqset, largest):
+    """Turn '1:3,7,9:*' into a set of ints."""
+    out = set()
+    if not largest:
+        return out
+    for part in seqset.split(','):
+        lo, _, hi = part.partition(':')
+        lo = largest if lo == '*' else int(lo)
+        hi = lo if not hi else largest if hi == '*' else int(hi)
+        lo, hi = min(lo, hi), max(lo, hi)
+        out.update(range(lo, min(hi, largest) + 1))
+        if lo > largest:
+            out.add(largest)
+    return out
+
+
+class FakeIMAPServer:
+    """Serves a list of FakeMessage from a single folder.
+
+    Args:
+        messages (list): FakeMessage in uid order
+        folder (str): the only selectable folder
+        uidvalidity (int): reported on select
+        latency (float): seconds slept before every response,
+            to make round-trips visible in benchmarks
+        max_connections (int): refuse clients above this
+            many concurrent connections, 0 is unlimited
+    """
+
+    def __init__(self, messages=(), user='', pwd='', folder='inbox',
+                 uidvalidity=1, host='127.0.0.1', port=0, latency=0.0,
+                 max_connections=0):
+        self.messages = sorted(messages, key=lambda m: m.uid)
+        self.user = user
+        self.pwd = pwd
+        self.folder = folder
+        self.uidvalidity = uidvalidity
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.max_connections = max_connections
+        self.active = 0
+        self.commands = []
+        self.idlers = set()
+        self.server = None
+        self._thread = None
+        self._loop = None
+
+    # serving
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def __enter__(self):
+        ready = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            ready.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self.close())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=serve, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def __exit__(self, *exc):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def add(self, msg):
+        """Deliver a new FakeMessage, telling idling clients
+        about it with an EXISTS response."""
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._deliver, msg)
+        else:
+            self._deliver(msg)
+
+    def _deliver(self, msg):
+        self.messages.append(msg)
+        self.messages.sort(key=lambda m: m.uid)
+        for writer in self.idlers:
+            writer.write(f'* {len(self.messages)} EXISTS\r\n'.encode())
+
+    # protocol
+
+    async def handle(self, reader, writer):
+        if self.max_connections and self.active >= self.max_connections:
+            writer.write(b'* BYE too many connections\r\n')
+            await writer.drain()
+            writer.close()
+            return
+        self.active += 1
+        session = {'selected': False}
+        try:
+            writer.write(b'* OK [CAPABILITY IMAP4rev1 IDLE] fake ready\r\n')
+            await writer.drain()
+            while True:
+                line = await self.read_command(reader, writer)
+                if line is None:
+                    break
+                tag, _, rest = line.partition(' ')
+                cmd, _, args = rest.partition(' ')
+                cmd = cmd.upper()
+                self.commands.append((cmd, args))
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if cmd == 'UID':
+                    cmd, _, args = args.partition(' ')
+                    done = await self.dispatch(
+                        tag, cmd.upper(), args, True, session, reader, writer)
+                else:
+                    done = await self.dispatch(
+                        tag, cmd, args, False, session, reader, writer)
+                await writer.drain()
+                if done:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.active -= 1
+            writer.close()
+
+    async def read_command(self, reader, writer):
+        """Read a full command line, following client literals."""
+        buf = b''
+        while True:
+            line = await reader.readline()
+            if not line:
+                return None
+            line = line.rstrip(b'\r\n')
+            match = re.search(rb'\{(\d+)\+?\}$', line)
+            if not match:
+                return (buf + line).decode('utf-8')
+            size = int(match.group(1))
+            if not line.endswith(b'+}'):
+                writer.write(b'+ go ahead\r\n')
+                await writer.drain()
+            data = await reader.readexactly(size)
+            buf += line[:match.start()] + quote(
+                data.decode('utf-8')).encode('utf-8')
+
+    async def dispatch(self, tag, cmd, args, uid, session, reader, writer):
+        ok = f'{tag} OK {cmd} completed\r\n'.encode()
+        if cmd == 'CAPABILITY':
+            writer.write(b'* CAPABILITY IMAP4rev1 IDLE\r\n' + ok)
+        elif cmd == 'LOGIN':
+            user, pwd = tokenize(args)[:2]
+            if (user, pwd) != (self.user, self.pwd):
+                writer.write(f'{tag} NO bad credentials\r\n'.encode())
+            else:
+                writer.write(ok)
+        elif cmd in ('SELECT', 'EXAMINE'):
+            folder = tokenize(args)[0]
+            if folder.lower() != self.folder.lower():
+                writer.write(f'{tag} NO no such folder\r\n'.encode())
+                return False
+            session['selected'] = True
+            nxt = self.messages[-1].uid + 1 if self.messages else 1
+            writer.write((
+                f'* {len(self.messages)} EXISTS\r\n'
+                f'* 0 RECENT\r\n'
+                f'* FLAGS (\\Seen)\r\n'
+                f'* OK [UIDVALIDITY {self.uidvalidity}] uids valid\r\n'
+                f'* OK [UIDNEXT {nxt}] next uid\r\n'
+                f'{tag} OK [READ-ONLY] {cmd} completed\r\n').encode())
+        elif cmd == 'SEARCH':
+            hits = self.search(tokenize(args), uid)
+            writer.write(f'* SEARCH {" ".join(map(str, hits))}\r\n'.encode()
+                         .replace(b' \r\n', b'\r\n') + ok)
+        elif cmd == 'FETCH':
+            seqset, _, items = args.partition(' ')
+            for seq, msg in self.select(seqset, uid):
+                writer.write(self.fetch(seq, msg, items, uid))
+            writer.write(ok)
+        elif cmd == 'NOOP':
+            writer.write(ok)
+        elif cmd == 'IDLE':
+            writer.write(b'+ idling\r\n')
+            await writer.drain()
+            self.idlers.add(writer)
+            try:
+                await reader.readline()
+            finally:
+                self.idlers.discard(writer)
+            writer.write(ok)
+        elif cmd == 'LOGOUT':
+            writer.write(b'* BYE logging out\r\n' + ok)
+            return True
+        else:
+            writer.write(f'{tag} BAD unknown command {cmd}\r\n'.encode())
+        return False
+
+    def select(self, seqset, uid):
+        """Returns [(seqno, FakeMessage), ...] matching seqset."""
+        if uid:
+            largest = self.messages[-1].uid if self.messages else 0
+            want = expand_set(seqset, largest)
+            return [(i + 1, m) for i, m in enumerate(self.messages)
+                    if m.uid in want]
+        want = expand_set(seqset, len(self.messages))
+        return [(i + 1, m) for i, m in enumerate(self.messages)
+                if i + 1 in want]
+
+    def search(self, criteria, uid):
+        hits = []
+        for seq, msg in enumerate(self.messages, 1):
+            if self.matches(msg, seq, list(criteria)):
+                hits.append(msg.uid if uid else seq)
+        return hits
+
+    def matches(self, msg, seq, crit):
+        """All keys in crit must match (implicit AND)."""
+        while crit:
+            if not self.match_one(msg, seq, crit):
+                return False
+        return True
+
+    def match_one(self, msg, seq, crit):
+        key = crit.pop(0)
+        if isinstance(key, list):
+            return self.matches(msg, seq, key)
+        key = key.upper()
+        if key == 'ALL':
+            return True
+        if key == 'NOT':
+            return not self.match_one(msg, seq, crit)
+        if key == 'OR':
+            left = self.match_one(msg, seq, crit)
+            right = self.match_one(msg, seq, crit)
+            return left or right
+        if key == 'FROM':
+            return crit.pop(0).lower() in msg.sender.lower()
+        if key == 'SUBJECT':
+            return crit.pop(0).lower() in msg.subject.lower()
+        if key in ('SINCE', 'BEFORE', 'ON'):
+            day = dt.datetime.strptime(crit.pop(0), '%d-%b-%Y').date()
+            date = msg.date.date()
+            return {'SINCE': date >= day, 'BEFORE': date < day,
+                    'ON': date == day}[key]
+        if key == 'UID':
+            largest = self.messages[-1].uid if self.messages else 0
+            return msg.uid in expand_set(crit.pop(0), largest)
+        if re.match(r'^[\d*:,]+$', key):
+            return seq in expand_set(key, len(self.messages))
+        raise ValueError(f'unsupported search key {key}')
+
+    def envelope(self, msg):
+        mbox, _, host = msg.sender.partition('@')
+        addr = f'((NIL NIL {quote(mbox)} {quote(host)}))'
+        date = msg.date.strftime('%a, %d %b %Y %H:%M:%S +0000')
+        return (f'({quote(date)} {quote(msg.subject)} {addr} {addr} {addr} '
+                f'((NIL NIL "me" "example.com")) NIL NIL NIL '
+                f'"<{msg.uid}@fake>")')
+
+    def fetch(self, seq, msg, items, uid):
+        wanted = re.findall(
+            r'BODY(?:\.PEEK)?\[[^\]]*\]|ENVELOPE|BODYSTRUCTURE|UID|FLAGS'
+            r'|RFC822\.SIZE|INTERNALDATE', items.upper())
+        if uid and 'UID' not in wanted:
+            wanted.insert(0, 'UID')
+        out = [f'* {seq} FETCH ('.encode()]
+        for i, item in enumerate(wanted):
+            if i:
+                out.append(b' ')
+            if item == 'UID':
+                out.append(f'UID {msg.uid}'.encode())
+            elif item == 'FLAGS':
+                out.append(b'FLAGS (\\Seen)')
+            elif item == 'ENVELOPE':
+                out.append(f'ENVELOPE {self.envelope(msg)}'.encode())
+            elif item == 'INTERNALDATE':
+                date = msg.date.strftime('%d-%b-%Y %H:%M:%S +0000')
+                out.append(f'INTERNALDATE "{date}"'.encode())
+            elif item == 'RFC822.SIZE':
+                size = sum(len(p[2].encode('utf-8')) for p in msg.parts)
+                out.append(f'RFC822.SIZE {size}'.encode())
+            elif item == 'BODYSTRUCTURE':
+                out.append(b'BODYSTRUCTURE ' + self.bodystructure(msg))
+            else:
+                section = item[item.index('['):]
+                data = self.section(msg, section[1:-1])
+                out.append(f'BODY{section} {{{len(data)}}}\r\n'.encode())
+                out.append(data)
+        out.append(b')\r\n')
+        return b''.join(out)
+
+    def bodystructure(self, msg):
+        parts = [
+            f'({quote(main)} {quote(sub)} ("charset" "utf-8") NIL NIL '
+            f'"7bit" {len(data.encode("utf-8"))} '
+            f'{len(data.splitlines())} NIL NIL NIL NIL)'
+            for main, sub, data in msg.parts
+        ]
+        if len(parts) == 1:
+            return parts[0].encode()
+        return f'({"".join(parts)} "alternative")'.encode()
+
+    def section(self, msg, section):
+        if section.isdigit():
+            idx = int(section) - 1
+            return msg.parts[idx][2].encode('utf-8') \
+                if idx < len(msg.parts) else b''
+        header = f'Subject: {msg.subject}\r\nFrom: {msg.sender}\r\n\r\n'
+        if section.startswith('HEADER'):
+            return header.encode('utf-8')
+        body = '\r\n'.join(p[2] for p in msg.parts)
+        return (header + body).encode('utf-8')
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Stage timing for App.run. STAGES names the stages of
+every class on the hot path:
+
+    {'class name': {'method name': measure or None}}
+
+and Stages.wrap replaces those methods on an instance with
+timed versions, so nothing is paid when it is not used and
+the classes themselves know nothing about it.
+"""
+import os
+import json
+import time
+import cProfile
+import threading
+import inspect
+from collections import Counter
+
+STAGES = {
+    'Mailbox': {'connect': None, 'search': None, 'fetch_subjects': 'items',
+                'fetch_batch': 'bodies'},
+    'EmailParser': {'iter_dicts': 'failures', 'tokenize': None,
+                    'parse_order_to_dict': None, 'split_order': None,
+                    'determine_order_type': None, 'parse_prices': None,
+                    'consume_datetime': None,
+                    'consume_partial_order': None},
+    'StatementParser': {'extract': None, 'iter_source': None,
+                        'parse_activity': None, 'parse_portfolio': None,
+                        'activity_to_dict': None},
+    'Processor': {'records_to_df': None, 'stream_to_df': None,
+                  'columns_to_df': None, 'normalize_datetimes': None,
+                  'add_date_and_fix_expir_year': None, 'match_lots': None,
+                  'compute_positions': None, 'update_ledger': None,
+                  'rebuild_ledger': None, 'analyze': None},
+    'RecordStore': {'append': None, 'load': None},
+}
+
+
+class Stages:
+    """Wall and cpu time, calls, items and bytes of the
+    stages of a run, with failure counts by failure point.
+
+    Time is exclusive: a stage called from another stage
+    (or consumed by it, for generators) pauses the outer
+    one, so the stages of a run add up to its wall time.
+    Each thread keeps its own stack, cpu time is per
+    thread. With profile_dir, every stage run in the main
+    thread also gets its own cProfile dump.
+
+    Measures:
+        'items': len of the result
+        'bodies': items and bytes of (subject, idx, body)
+        'failures': count the errors of yielded
+            (subject, idx, body, dict, error) by the
+            failure point in front of the error message
+    """
+
+    def __init__(self, profile_dir=''):
+        self.profile_dir = profile_dir
+        self.stats = {}
+        self.profiles = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def stage(self, name):
+        with self.lock:
+            if name not in self.stats:
+                self.stats[name] = {'calls': 0, 'wall_s': 0., 'cpu_s': 0.,
+                                    'items': 0, 'bytes': 0,
+                                    'failures': Counter()}
+            return self.stats[name]
+
+    def switch(self):
+        """Charge the time since the last switch of this
+        thread to the stage on top of its stack."""
+        local = self.local
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            stack = local.stack
+        except AttributeError:
+            stack = local.stack = []
+        if stack:
+            stat = stack[-1]
+            stat['wall_s'] += wall - local.wall
+            stat['cpu_s'] += cpu - local.cpu
+        local.wall, local.cpu = wall, cpu
+        return stack
+
+    def push(self, stat, call=True):
+        stack = self.switch()
+        if self.profile_dir and stack:
+            self.profile(stack[-1], False)
+        stack.append(stat)
+        stat['calls'] += call
+        if self.profile_dir:
+            self.profile(stat, True)
+
+    def pop(self):
+        stack = self.switch()
+        stat = stack.pop()
+        if self.profile_dir:
+            self.profile(stat, False)
+            if stack:
+                self.profile(stack[-1], True)
+
+    def profile(self, stat, on):
+        if threading.current_thread() is not threading.main_thread():
+            return
+        prof = self.profiles.setdefault(id(stat), cProfile.Profile())
+        if on:
+            prof.enable()
+        else:
+            prof.disable()
+
+    def measure(self, name, how, result):
+        stat = self.stats[name]
+        if how == 'items':
+            stat['items'] += len(result)
+        elif how == 'bodies':
+            stat['items'] += len(result)
+            stat['bytes'] += sum(len(bod.encode('utf-8'))
+                                 for _, _, bod in result)
+
+    def timed(self, name, func, how=None):
+        stat = self.stage(name)
+
+        def _timed(*args, **kws):
+            self.push(stat)
+            try:
+                result = func(*args, **kws)
+            finally:
+                self.pop()
+            if inspect.isgenerator(result):
+                return self.iter(name, result, how)
+            if how is not None:
+                self.measure(name, how, result)
+            return result
+        return _timed
+
+    def iter(self, name, gen, how=None):
+        """Time every step of a generator as name, counting
+        what it yields as items. If the consumer stops early
+        the generator is closed, so its cleanup runs then."""
+        stat = self.stage(name)
+        try:
+            while True:
+                self.push(stat, call=False)
+                try:
+                    item = next(gen)
+                except StopIteration:
+                    return
+                finally:
+                    self.pop()
+                stat['items'] += 1
+                if how == 'failures' and item[4] is not None:
+                    stat['failures'][item[4].split(':', 1)[0]] += 1
+                yield item
+        finally:
+            self.push(stat, call=False)
+            try:
+                gen.close()
+            finally:
+                self.pop()
+
+    def wrap(self, obj):
+        """Time the methods STAGES names for the class of obj,
+        or the closest base class it has stages for.
+
+        Returns:
+            obj
+        """
+        cls = type(obj).__name__
+        stages = next((STAGES[kls.__name__] for kls in type(obj).__mro__
+                       if kls.__name__ in STAGES), {})
+        for method, how in stages.items():
+            setattr(obj, method, self.timed(
+                f'{cls}.{method}', getattr(obj, method), how))
+        return obj
+
+    def report(self):
+        """Returns:
+            {'wall_s': run time, 'stages': {name: stats}}
+        """
+        stages = {}
+        for name, stat in self.stats.items():
+            stat = dict(stat, failures=dict(stat['failures']))
+            count = stat['items'] or stat['calls']
+            stat['per_s'] = count / stat['wall_s'] if stat['wall_s'] else 0.
+            stages[name] = stat
+        return {'wall_s': time.perf_counter() - self.start,
+                'stages': stages}
+
+    def show(self):
+        report = self.report()
+        print(f"{'stage':<42}{'calls':>8}{'wall_s':>9}{'cpu_s':>9}"
+              f"{'items':>9}{'MB':>8}{'per_s':>11}{'failures':>9}")
+        for name, stat in sorted(report['stages'].items(),
+                                 key=lambda kv: -kv[1]['wall_s']):
+            print(f"{name:<42}{stat['calls']:>8}{stat['wall_s']:>9.3f}"
+                  f"{stat['cpu_s']:>9.3f}{stat['items']:>9}"
+                  f"{stat['bytes'] / 1e6:>8.2f}"
+                  f"{stat['per_s']:>11.0f}"
+                  f"{sum(stat['failures'].values()):>9}")
+        print(f"run took {report['wall_s']:.3f}s")
+
+    def dump(self, path=''):
+        """Write the report as json to path and the stage
+        profiles to profile_dir as <stage>.prof."""
+        if path:
+            with open(path, 'w') as f:
+                json.dump(self.report(), f, indent=2)
+            print(f'wrote stage stats to {path}')
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            for name, stat in self.stats.items():
+                prof = self.profiles.get(id(stat))
+                if prof is not None:
+                    prof.dump_stats(os.path.join(
+                        self.profile_dir, f'{name}.prof'))
+            print(f'wrote stage profiles to {self.profile_dir}')
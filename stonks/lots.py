@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+import datetime as dt
+from collections import deque
+
+import numpy as np
+import pandas as pd
+from traitlets.config.configurable import Configurable
+from traitlets import Unicode, Float, Dict, validate
+
+
+CLOSED, EXPIRED, OPEN = range(3)
+REASONS = ['closed', 'expired', 'open']
+
+
+class LotMatcher(Configurable):
+    """Match sells against the buy lots they close (or
+    buys against short lots) per position and compute
+    realized and unrealized PnL.
+
+    Fills are taken from a dataframe conforming to the
+    Record spec with the execution_ts and expiration_ts
+    of Processor.normalize_datetimes. Partial fills only
+    count what was filled, crypto quantities are dollars over average price and
+    contracts are scaled by multiplier. Options still open
+    after their expiration are closed at zero.
+
+    All fills are sorted once by position and execution
+    time, then each position is walked with a deque of
+    open lots, so matching is O(n log n) overall.
+    """
+    method = Unicode('fifo', help='"fifo", "lifo" or "specific"').tag(
+        config=True)
+    multiplier = Float(100, help='units per option contract').tag(
+        config=True)
+    specific = Dict(help='{closing email_id: [opening email_id, ...]} '
+                         'for method "specific", others fall back to fifo'
+                    ).tag(config=True)
+    position_keys = ['ticker', 'strike', 'order', 'expiration']
+
+    @validate('method')
+    def _is_valid_method(self, change):
+        if change.value not in ['fifo', 'lifo', 'specific']:
+            raise Exception(f"validation error {change.value}")
+        return change.value
+
+    def fills(self, df):
+        """Quantity, unit price and multiplier per execution.
+
+        Returns:
+            DataFrame of position_keys, email_id, time,
+            side (+1 buy, -1 sell), qty, price, mult, expires
+        """
+        partial = df['partial'].fillna(False).astype(bool).to_numpy()
+        crypto = (df['kind'] == 'crypto').to_numpy()
+        avg = df['avg_price'].fillna(0).to_numpy(float)
+        part_amt = df['partial_amount'].fillna(0).to_numpy(float)
+        part_prc = df['partial_price'].fillna(0).to_numpy(float)
+        count = df['count'].fillna(0).to_numpy(float)
+        total = df['total_amount'].fillna(0).to_numpy(float)
+        # only the filled part of a partial execution is a lot,
+        # unfilled_amount never changed hands
+        use_part = partial & (part_amt > 0)
+        price = np.where(use_part & (part_prc > 0), part_prc, avg)
+        dollars = np.where(use_part, part_amt, total)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            qty = np.where(crypto, np.where(avg > 0, dollars / avg, 0),
+                           np.where(use_part, part_amt, count))
+        direction = df['direction'].astype(object).to_numpy()
+        side = np.where(direction == 'sell', -1,
+                        np.where(direction == 'buy', 1, 0))
+        mult = np.where((df['kind'] == 'contract').to_numpy(),
+                        self.multiplier, 1.0)
+        fills = pd.DataFrame({
+            key: df[key].astype(object).to_numpy()
+            for key in self.position_keys})
+        fills['email_id'] = df['email_id'].to_numpy()
+        fills['time'] = self.utc_minutes(df['execution_ts'])
+        fills['side'] = side
+        fills['qty'] = qty
+        fills['price'] = price
+        fills['mult'] = mult
+        fills['expires'] = self.utc_minutes(df['expiration_ts'])
+        return fills[(fills['side'] != 0) & (fills['qty'] > 0)]
+
+    @staticmethod
+    def utc_minutes(stamps):
+        """Naive UTC datetime64[m] of a tz-aware column."""
+        return stamps.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy(
+            'datetime64[m]')
+
+    def match(self, df, marks=None, as_of=None):
+        """Match every fill in df into lots.
+
+        Args:
+            df (DataFrame): conforming to the Record spec,
+                with normalized datetimes
+            marks (dict): {ticker: price} for unrealized PnL
+            as_of (datetime): options expiring before are
+                closed at zero, defaults to now
+
+        Returns:
+            (lots, positions) DataFrames, one row per matched,
+            expired or still open lot and one row per position
+        """
+        marks = marks or {}
+        tz = df['execution_ts'].dt.tz
+        now = pd.Timestamp(as_of or dt.datetime.now(tz))
+        if now.tzinfo is None:
+            now = now.tz_localize(tz)
+        now = np.datetime64(now.tz_convert('UTC').tz_localize(None), 'm')
+        fills = self.fills(df)
+        codes, keys = pd.factorize(pd.MultiIndex.from_frame(
+            fills[self.position_keys].fillna('')))
+        keys = pd.MultiIndex.from_tuples(keys, names=self.position_keys)
+        order = np.lexsort((fills['email_id'].to_numpy(),
+                            fills['time'].to_numpy(), codes))
+        codes = codes[order]
+        cols = {name: fills[name].to_numpy()[order] for name in
+                ['email_id', 'time', 'side', 'qty', 'price', 'mult',
+                 'expires']}
+        # each position is the run of fills between two bounds,
+        # none when there are no fills at all
+        bounds = np.flatnonzero(np.diff(codes)) + 1
+        starts = np.r_[0, bounds] if len(codes) else []
+        opens, closes, qtys, reasons = [], [], [], []
+        # {closing email_id: {opening email_id: preference}}
+        ranks = {close: {want: rank for rank, want in
+                         reversed(list(enumerate(wanted)))}
+                 for close, wanted in self.specific.items()}
+        for start, end in zip(starts, np.r_[bounds, len(codes)]):
+            self.match_position(start, end, cols, now, ranks,
+                                (opens, closes, qtys, reasons))
+        return self.tables(keys, codes, cols, marks, tz, opens, closes,
+                           qtys, reasons)
+
+    def match_position(self, start, end, cols, now, ranks, out):
+        """Walk the fills of one position in time order.
+
+        Open lots are [fill index, remaining qty] in a deque,
+        all on the same side. Each matched piece is appended
+        to out as (open index, close index, qty, reason)
+        with close index -1 for expired and open lots.
+        ranks are the specific lots wanted per closing email_id.
+        """
+        opens, closes, qtys, reasons = out
+        ids, sides, fill_qty = cols['email_id'], cols['side'], cols['qty']
+        lifo = self.method == 'lifo'
+        specific = ranks if self.method == 'specific' else None
+        book = deque()
+        for i in range(start, end):
+            side, qty = sides[i], fill_qty[i]
+            while qty > 1e-12 and book and sides[book[0][0]] != side:
+                j = -1 if lifo else 0
+                if specific and ids[i] in specific:
+                    j = self.pick(book, ids, specific[ids[i]])
+                lot = book[j]
+                used = min(qty, lot[1])
+                opens.append(lot[0])
+                closes.append(i)
+                qtys.append(used)
+                reasons.append(CLOSED)
+                lot[1] -= used
+                qty -= used
+                if lot[1] <= 1e-12:
+                    del book[j]
+            if qty > 1e-12:
+                book.append([i, qty])
+        expires = cols['expires'][start]
+        reason = EXPIRED if expires < now else OPEN
+        for idx, qty in book:
+            opens.append(idx)
+            closes.append(-1)
+            qtys.append(qty)
+            reasons.append(reason)
+
+    @staticmethod
+    def pick(book, ids, rank):
+        """Index in book of the most wanted opening email_id
+        in rank, the oldest lot if none is open. One pass
+        over the book, O(len(book))."""
+        best, pick = len(rank), 0
+        for j, (idx, _) in enumerate(book):
+            r = rank.get(ids[idx], best)
+            if r < best:
+                best, pick = r, j
+        return pick
+
+    def tables(self, keys, codes, cols, marks, tz, opens, closes, qtys,
+               reasons):
+        """Per-lot and per-position frames from the matched
+        fill indices."""
+        opens = np.asarray(opens, dtype=np.int64)
+        closes = np.asarray(closes, dtype=np.int64)
+        qty = np.asarray(qtys, dtype=float)
+        reason = np.asarray(reasons, dtype=np.int8)
+        closed = closes >= 0
+        lots = keys[codes[opens]].to_frame(index=False)
+        side = cols['side'][opens]
+        mult = cols['mult'][opens]
+        open_price = cols['price'][opens]
+        close_price = np.where(closed, cols['price'][closes], np.nan)
+        close_price[reason == EXPIRED] = 0.
+        close_id = pd.array(np.where(closed, cols['email_id'][closes], 0),
+                            dtype='Int64')
+        close_id[~closed] = pd.NA
+        close_time = np.where(closed, cols['time'][closes],
+                              np.datetime64('NaT'))
+        expired = reason == EXPIRED
+        close_time[expired] = cols['expires'][opens][expired]
+        lots['side'] = side
+        lots['qty'] = qty
+        lots['mult'] = mult
+        lots['open_id'] = cols['email_id'][opens]
+        lots['open_time'] = self.local(cols['time'][opens], tz)
+        lots['open_price'] = open_price
+        lots['close_id'] = close_id
+        lots['close_time'] = self.local(close_time, tz)
+        lots['close_price'] = close_price
+        lots['reason'] = pd.Categorical.from_codes(reason, REASONS)
+        held = reason == OPEN
+        notional = qty * mult * side
+        lots['realized'] = np.where(
+            held, 0., (close_price - open_price) * notional)
+        mark = lots['ticker'].map(marks).to_numpy(float)
+        lots['unrealized'] = np.where(
+            held, (mark - open_price) * notional, 0.)
+        position = codes[opens]
+        by = pd.DataFrame({
+            'open_qty': np.where(held, qty * side, 0.),
+            'cost': np.where(held, open_price * notional, 0.),
+            'realized': lots['realized'].to_numpy(),
+            'unrealized': lots['unrealized'].to_numpy(),
+        }).groupby(position, sort=False)
+        positions = by.sum(min_count=1)
+        positions[['open_qty', 'cost', 'realized']] = positions[
+            ['open_qty', 'cost', 'realized']].fillna(0.)
+        positions.index = keys[positions.index]
+        positions = positions.sort_index().reset_index()
+        return lots, positions
+
+    @staticmethod
+    def local(minutes, tz):
+        return pd.Series(minutes.astype('datetime64[ns]')).dt.tz_localize(
+            'UTC').dt.tz_convert(tz)
+
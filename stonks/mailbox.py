@@ -2,13 +2,20 @@
 # Copyright 2020, Stonks Development Team
 # Distributed under the terms of the Apache License 2.0
 
+import json
+import threading
+import datetime as dt
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from traitlets.config.configurable import Configurable
-from traitlets import Unicode, List
+from traitlets import Unicode, List, Int, Bool, Dict, validate
 
 from imapclient import IMAPClient
 
+from .cache import MessageCache
+from .mime import PLAIN, Part, pick_part, part_text
+
 
 class Mailbox(Configurable):
     """Configurable IMAP client wrapper.
@@ -18,70 +25,349 @@ class Mailbox(Configurable):
     of fetches is made to get the plain text body of
     the email.
 
+    The filters, stop_words and since configs are sent
+    to the server as SEARCH criteria so that envelopes
+    of marketing emails and statements are never
+    transferred, and are applied again locally.
+
+    If cache_file is set, every subject and body is
+    kept in a local sqlite file and only uids above
+    the highest cached uid are requested from the
+    server on subsequent runs, unless the search
+    criteria changed since.
+
+    If connections is more than one, the body fetches
+    are spread over that many read-only connections
+    each running in its own thread.
+
+    The BODYSTRUCTURE of every email comes with its
+    envelope and decides which part is fetched: text/plain
+    unless it is missing or smaller than min_part_size,
+    then text/html, stripped down to its text (see
+    prefer_part). Bodies are always plain text.
+
     The main entry point is the fetch_orders method
     and returns a dictionary of the following structure:
         {subject: [(idx, body), ...]}
+
+    iter_orders yields the same data one email at a
+    time as (subject, idx, body) while it is fetched.
     """
     user = Unicode().tag(config=True)
     pwd = Unicode().tag(config=True)
     hostname = Unicode().tag(config=True)
+    port = Int(0, help='0 uses the default for ssl').tag(config=True)
+    ssl = Bool(True).tag(config=True)
     folder = Unicode().tag(config=True)
     broker = Unicode().tag(config=True)
-    filters = List().tag(config=True)
+    filters = List(help='subject must contain one of these').tag(
+        config=True)
+    stop_words = List(
+        ['login', 'account', 'statement', 'expiring'],
+        help='subject must not contain any of these').tag(config=True)
+    since = Unicode(help='only emails on or after YYYY-MM-DD').tag(
+        config=True)
+    cache_file = Unicode().tag(config=True)
+    batch_size = Int(500).tag(config=True)
+    connections = Int(1).tag(config=True)
+    prefer_part = Unicode('plain', help='"plain" or "html" when an email '
+                                        'has both').tag(config=True)
+    min_part_size = Int(1, help='bytes a preferred part needs to be used'
+                        ).tag(config=True)
+    parts = Dict(help='{idx: Part} to fetch, from BODYSTRUCTURE, until '
+                      'the bodies are fetched')
+    source = Unicode('', help='"imap:folder:uidvalidity" of the folder '
+                              'selected last, where uids are unique')
+
+    @validate('prefer_part')
+    def _is_valid_prefer_part(self, change):
+        if change.value not in ['plain', 'html']:
+            raise Exception(f"validation error {change.value}")
+        return change.value
+
+    def fetch_subjects(self, c, msgs):
+        """Get the subject lines of msgs, and keep the body
+        part to fetch for each in parts.
+
+        Returns:
+            {idx: subject}
+        """
+        envs = c.fetch(msgs, ['ENVELOPE', 'BODYSTRUCTURE'])
+        for idx, data in envs.items():
+            if b'BODYSTRUCTURE' in data:
+                self.parts[idx] = pick_part(data[b'BODYSTRUCTURE'],
+                                            self.prefer_part,
+                                            self.min_part_size)
+        return {
+            idx: data[b'ENVELOPE'].subject.decode('utf-8')
+            for idx, data in envs.items()
+        }
+
+    def search_criteria(self, *extra):
+        """Compile the subject filters into IMAP SEARCH
+        criteria, e.g.
+            FROM broker OR SUBJECT a SUBJECT b
+            NOT SUBJECT login SINCE 01-Jan-2020
+        """
+        crit = ['FROM', self.broker]
+        if self.filters:
+            crit.extend(['OR'] * (len(self.filters) - 1))
+            for word in self.filters:
+                crit.extend(['SUBJECT', word])
+        for word in self.stop_words:
+            crit.extend(['NOT', 'SUBJECT', word])
+        if self.since:
+            crit.extend(['SINCE', dt.date.fromisoformat(self.since)])
+        crit.extend(extra)
+        return crit
+
+    def search(self, c, *extra):
+        """Returns:
+            [idx, ...] matching search_criteria(*extra)
+        """
+        return c.search(self.search_criteria(*extra))
+
+    def filter_subjects(self, emails_by_name, seen=()):
+        """Drop subjects that are not order executions. Order
+        subjects recur, one seen only once is dropped unless
+        it is in seen."""
+        filters = [f.lower() for f in self.filters]
+        stops = [s.lower() for s in self.stop_words]
+        # substrings, case insensitive, as SUBJECT matches in SEARCH
+        return {
+            key: val for key, val in
+            emails_by_name.items()
+            if (len(val) > 1 or key in seen) and
+            not any((s in key.lower() for s in stops))
+            and (not filters or any(f in key.lower() for f in filters))
+        }
 
     def fetch_envelopes(self, c):
         """Get all email ids coming from the broker
         email address and filter them by key words
         in the subject of the email."""
         print('fetching envelopes')
-        msgs = c.search(['FROM', self.broker])
-        envs = c.fetch(msgs, ['ENVELOPE'])
+        msgs = self.search(c)
         emails_by_name = defaultdict(list)
-        for idx, data in envs.items():
-            env = data[b'ENVELOPE']
-            subject = env.subject.decode('utf-8')
-            # deprecate self.filters config
+        for idx, subject in self.fetch_subjects(c, msgs).items():
             emails_by_name[subject].append(idx)
-        stop = ['login', 'account', 'statement', 'expiring']
-        orders = {
-            key: val for key, val in
-            emails_by_name.items()
-            if len(val) > 1 and
-            not any((s in key.lower().split() for s in stop))
-        }
+        orders = self.filter_subjects(emails_by_name)
         print(f'fetched {len(emails_by_name)} subjects')
         return orders
 
+    def plan_fetch(self, emails_by_name):
+        """Merge the wanted ids of every subject into
+        sorted batches of at most batch_size ids.
+
+        Returns:
+            [[idx, ...], ...]
+        """
+        idxs = sorted({idx for ids in emails_by_name.values() for idx in ids})
+        size = max(self.batch_size, 1)
+        return [idxs[i:i + size] for i in range(0, len(idxs), size)]
+
+    def take_parts(self, idxs):
+        """The Part to fetch of each of idxs, BODY[1] for
+        emails without a known structure. parts only lives
+        from the envelope fetch to the body fetch after it,
+        so it is emptied.
+
+        Returns:
+            {idx: Part}
+        """
+        parts = {idx: self.parts.get(idx, PLAIN) for idx in idxs}
+        self.parts.clear()
+        return parts
+
+    def fetch_batch(self, c, idxs, subjects, parts):
+        """Fetch the bodies of one batch, with one FETCH
+        per distinct section of parts, usually only one.
+
+        Returns:
+            [(subject, idx, body), ...]
+        """
+        by_section = defaultdict(list)
+        for idx in idxs:
+            by_section[parts[idx].section].append(idx)
+        texts = {}
+        for section, ids in by_section.items():
+            key = f'BODY[{section}]'
+            bodies = c.fetch(ids, [key])
+            for idx in ids:
+                if idx in bodies:
+                    texts[idx] = part_text(parts[idx],
+                                           bodies[idx][key.encode()])
+        return [(subjects[idx], idx, texts[idx])
+                for idx in idxs if idx in texts]
+
+    def iter_bodies(self, c, emails_by_name):
+        """Fetch the plain text bodies of the previously
+        filtered emails a batch at a time, yielding each
+        one as soon as its batch arrives.
+
+        Yields:
+            (subject, idx, body)
+        """
+        plan = self.plan_fetch(emails_by_name)
+        subjects = {idx: subject for subject, idxs in emails_by_name.items()
+                    for idx in idxs}
+        parts = self.take_parts(subjects)
+        if self.connections > 1:
+            yield from self.iter_bodies_pooled(plan, subjects, parts)
+            return
+        print(f'fetching bodies in {len(plan)} batches')
+        for idxs in plan:
+            yield from self.fetch_batch(c, idxs, subjects, parts)
+
+    def iter_bodies_pooled(self, plan, subjects, parts):
+        """Spread the fetch plan over a pool of connections,
+        one per thread, yielding batches as they complete
+        (not in uid order).
+
+        Yields:
+            (subject, idx, body)
+        """
+        nconn = max(min(self.connections, len(plan)), 1)
+        print(f'fetching bodies in {len(plan)} batches '
+              f'over {nconn} connections')
+        local = threading.local()
+        conns = []
+
+        def work(idxs):
+            c = getattr(local, 'c', None)
+            if c is None:
+                c = local.c = self.connect()
+                conns.append(c)
+            return self.fetch_batch(c, idxs, subjects, parts)
+
+        try:
+            with ThreadPoolExecutor(nconn) as pool:
+                futs = [pool.submit(work, idxs) for idxs in plan]
+                for fut in as_completed(futs):
+                    yield from fut.result()
+        finally:
+            for c in conns:
+                c.logout()
+
+    @staticmethod
+    def collect(stream):
+        """Group a (subject, idx, body) stream by subject.
+
+        Returns:
+            {subject: [(idx, body), ...]}
+        """
+        orders = defaultdict(list)
+        for subject, idx, body in stream:
+            orders[subject].append((idx, body))
+        for bods in orders.values():
+            bods.sort(key=lambda bod: bod[0])
+        return orders
+
     def fetch_bodies(self, c, emails_by_name):
         """Get the plain text bodies of the previously
-        filtered emails. Chunks the fetch by unique
-        subject lines.
+        filtered emails in batches of batch_size ids
+        regardless of how many subjects there are.
 
         Returns:
             {subject: [(idx, body), ...]}
         """
-        print('fetching bodies in chunks')
-        orders = defaultdict(list)
+        return self.collect(self.iter_bodies(c, emails_by_name))
+
+    def connect(self, select=True):
+        """Open an authenticated connection, with the folder
+        selected read-only. Meant to be used as a context
+        manager."""
+        c = IMAPClient(host=self.hostname, port=self.port or None,
+                       ssl=self.ssl)
+        c.login(self.user, self.pwd)
+        if select:
+            c.select_folder(self.folder, readonly=True)
+        return c
+
+    def iter_cache(self, c, cache, uidvalidity):
+        """Pull only the messages above the cached
+        watermark and serve the rest of the history
+        from the cache. Cached bodies are yielded first,
+        then the rest as they are fetched and stored.
+
+        Yields:
+            (subject, idx, body)
+        """
+        cache.validate(self.folder, uidvalidity)
+        criteria = json.dumps(self.search_criteria(), default=str)
+        if cache.criteria(self.folder, uidvalidity) == criteria:
+            mark = cache.watermark(self.folder, uidvalidity)
+            print(f'fetching envelopes above uid {mark}')
+            # n:* always matches the newest message so filter again
+            msgs = [idx for idx in
+                    self.search(c, 'UID', f'{mark + 1}:*')
+                    if idx > mark]
+        else:
+            # the cached subjects matched other criteria, match
+            # the new ones against the whole history instead
+            print('search criteria changed, fetching missing envelopes')
+            hits = self.search(c)
+            cached = cache.uids(self.folder, uidvalidity)
+            cache.keep(self.folder, uidvalidity, hits)
+            msgs = [idx for idx in hits if idx not in cached]
+        if msgs:
+            subjects = self.fetch_subjects(c, msgs)
+            cache.add_subjects(self.folder, uidvalidity, subjects, self.parts)
+        cache.set_criteria(self.folder, uidvalidity, criteria)
+        emails_by_name = cache.subjects(self.folder, uidvalidity)
+        print(f'fetched {len(msgs)} new of {len(emails_by_name)} subjects')
+        emails_by_name = self.filter_subjects(emails_by_name)
+        wanted = [idx for idxs in emails_by_name.values() for idx in idxs]
+        cached = cache.bodies(self.folder, uidvalidity, wanted)
+        missing = defaultdict(list)
         for subject, idxs in emails_by_name.items():
-            # TODO : get body structure to
-            #        assert text/plain is BODY[1]
-            bodies = c.fetch(idxs, ['BODY[1]'])
-            for idx, data in bodies.items():
-                body = data[b'BODY[1]'].decode('utf-8')
-                orders[subject].append((idx, body))
-        return orders
+            for idx in idxs:
+                if idx in cached:
+                    yield subject, idx, cached[idx]
+                else:
+                    missing[subject].append(idx)
+        print(f'{len(cached)} bodies cached, '
+              f'{sum(map(len, missing.values()))} to fetch')
+        # the parts of envelopes fetched in an earlier run
+        unknown = [idx for idxs in missing.values() for idx in idxs
+                   if idx not in self.parts]
+        self.parts.update(
+            (idx, Part(*fields)) for idx, fields in
+            cache.parts(self.folder, uidvalidity, unknown).items())
+        fetched = {}
+        for subject, idx, body in self.iter_bodies(c, missing):
+            fetched[idx] = body
+            if len(fetched) >= self.batch_size:
+                cache.add_bodies(self.folder, uidvalidity, fetched)
+                fetched = {}
+            yield subject, idx, body
+        cache.add_bodies(self.folder, uidvalidity, fetched)
 
-    def fetch_orders(self):
+    def iter_orders(self):
         """Gets all broker emails from the email address
         according to the configurations set in the cfg.py
-        file."""
+        file, one at a time.
+
+        Yields:
+            (subject, idx, body)
+        """
         print("fetching orders:", self.hostname)
-        # TODO : make mailbox optionally accept a watermark
-        #        so that cached data need not be re-pulled
-        with IMAPClient(host=self.hostname) as c:
-            c.login(self.user, self.pwd)
-            c.select_folder(self.folder, readonly=True)
-            emails_by_name = self.fetch_envelopes(c)
-            orders = self.fetch_bodies(c, emails_by_name)
-        return orders
+        with self.connect(select=False) as c:
+            info = c.select_folder(self.folder, readonly=True)
+            self.source = f'imap:{self.folder}:{info[b"UIDVALIDITY"]}'
+            if not self.cache_file:
+                emails_by_name = self.fetch_envelopes(c)
+                yield from self.iter_bodies(c, emails_by_name)
+                return
+            with MessageCache(self.cache_file) as cache:
+                yield from self.iter_cache(c, cache, info[b'UIDVALIDITY'])
+
+    def fetch_orders(self):
+        """Gets all broker emails from the email address
+        according to the configurations set in the cfg.py
+        file.
 
+        Returns:
+            {subject: [(idx, body), ...]}
+        """
+        return self.collect(self.iter_orders())
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Choosing the body part of an email from its
+BODYSTRUCTURE and turning it into the plain text the
+EmailParser tokenizes.
+"""
+import base64
+import quopri
+from html.parser import HTMLParser
+from collections import namedtuple
+
+
+Part = namedtuple('Part', [
+    'section', 'maintype', 'subtype', 'charset', 'encoding', 'size'])
+Part.__doc__ = """A leaf of a BODYSTRUCTURE, section is what
+goes in BODY[section]."""
+
+PLAIN = Part('1', 'text', 'plain', 'utf-8', '7bit', 0)
+
+
+def _str(val):
+    return val.decode('ascii', 'replace').lower() if isinstance(
+        val, bytes) else (val or '').lower()
+
+
+def walk(structure, section=''):
+    """Yield every leaf Part of a BODYSTRUCTURE as parsed
+    by imapclient, multiparts are (children, subtype, ...).
+    """
+    if isinstance(structure[0], list):
+        for i, child in enumerate(structure[0], 1):
+            yield from walk(child, f'{section}.{i}' if section else str(i))
+        return
+    params = structure[2] or ()
+    params = dict(zip(map(_str, params[::2]), params[1::2]))
+    size = structure[6] if len(structure) > 6 else 0
+    yield Part(section or '1', _str(structure[0]), _str(structure[1]),
+               _str(params.get('charset')) or 'utf-8', _str(structure[5]),
+               size if isinstance(size, int) else 0)
+
+
+def pick_part(structure, prefer='plain', min_size=1):
+    """The text part to fetch: the preferred subtype if it
+    has at least min_size bytes, else the other one, else
+    the first part as text/plain."""
+    texts = [part for part in walk(structure) if part.maintype == 'text']
+    order = [prefer] + [sub for sub in ('plain', 'html') if sub != prefer]
+    for sub in order:
+        for part in texts:
+            if part.subtype == sub and part.size >= min_size:
+                return part
+    return PLAIN
+
+
+def part_text(part, raw):
+    """Text of a fetched part. Plain text keeps its
+    quoted-printable line breaks, EmailParser.stop_chars
+    take care of them, html is decoded and stripped of
+    its markup.
+    """
+    if part.encoding == 'base64':
+        raw = base64.b64decode(raw)
+    elif part.encoding == 'quoted-printable' and part.subtype == 'html':
+        raw = quopri.decodestring(raw)
+    try:
+        text = raw.decode(part.charset, 'replace')
+    except LookupError:
+        text = raw.decode('utf-8', 'replace')
+    if part.subtype == 'html':
+        return html_text(text)
+    return text
+
+
+class HTMLText(HTMLParser):
+    """Collect the text of an html document as it is fed,
+    without building a tree. Block level tags break words,
+    scripts, styles and the head are dropped."""
+    skip = {'head', 'script', 'style', 'title'}
+    blocks = {'br', 'p', 'div', 'table', 'tr', 'td', 'th', 'li', 'ul',
+              'ol', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'center'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.pieces = []
+        self.hidden = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skip:
+            self.hidden += 1
+        elif tag in self.blocks:
+            self.pieces.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in self.skip:
+            self.hidden = max(self.hidden - 1, 0)
+        elif tag in self.blocks:
+            self.pieces.append(' ')
+
+    def handle_data(self, data):
+        if not self.hidden:
+            self.pieces.append(data)
+
+    def text(self):
+        return ' '.join(''.join(self.pieces).split())
+
+
+def html_text(markup):
+    """The words of an html document on one line."""
+    parser = HTMLText()
+    parser.feed(markup)
+    parser.close()
+    return parser.text()
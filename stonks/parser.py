@@ -2,19 +2,74 @@
 # Copyright 2020, Stonks Development Team
 # Distributed under the terms of the Apache License 2.0
 import os
+import re
+import json
+import inspect
+import hashlib
 from io import StringIO
-from collections import defaultdict
+from itertools import islice
+from collections import deque, Counter
+from concurrent.futures import ProcessPoolExecutor
 
 from traitlets.config.configurable import Configurable
-from traitlets import List, Int, Instance, Unicode
+from traitlets import List, Int, Instance, Unicode, observe
 
-from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
-from pdfminer.converter import TextConverter
-from pdfminer.layout import LAParams
-from pdfminer.pdfpage import PDFPage
+from .record import Record, CompactRecord, RecordColumns
+from .cache import TextCache, ParseCache
 
-from .record import Record
-from .mailbox import Mailbox
+
+class Tokens:
+    """A cursor over a list of tokens so the consumers
+    can walk an email in one pass instead of copying
+    the rest of the list at every step.
+
+    Running out of tokens raises the same errors that
+    list unpacking and indexing did: take raises
+    ValueError, peek and next raise IndexError.
+    """
+    __slots__ = ('toks', 'pos')
+
+    def __init__(self, toks, pos=0):
+        self.toks = toks
+        self.pos = pos
+
+    def __len__(self):
+        return len(self.toks) - self.pos
+
+    def __repr__(self):
+        return f'Tokens({self.toks[self.pos:]!r})'
+
+    def peek(self, offset=0):
+        return self.toks[self.pos + offset]
+
+    def next(self):
+        tok = self.toks[self.pos]
+        self.pos += 1
+        return tok
+
+    def take(self, n):
+        if len(self.toks) - self.pos < n:
+            raise ValueError(f'need {n} tokens, have {len(self)}')
+        self.pos += n
+        return self.toks[self.pos - n:self.pos]
+
+    def advance(self, n=1):
+        self.pos = min(self.pos + n, len(self.toks))
+
+    def join(self, n, sep=''):
+        """Join the next n tokens without consuming them."""
+        return sep.join(self.toks[self.pos:self.pos + n])
+
+    def scan(self, match):
+        """Offset of the next token for which match is
+        true, or the number of tokens left."""
+        toks, cnt, end = self.toks, self.pos, len(self.toks)
+        while cnt < end and not match(toks[cnt]):
+            cnt += 1
+        return cnt - self.pos
+
+    def fork(self):
+        return Tokens(self.toks, self.pos)
 
 
 class EmailParser(Configurable):
@@ -26,16 +81,34 @@ class EmailParser(Configurable):
 
     The main entry point is the parse_orders method
     which expects a dictionary of the structure produced
-    by the Mailbox's fetch_orders method.
+    by the Mailbox's fetch_orders method. With an
+    AsyncMailbox, parse_orders_async parses the emails
+    as they land instead.
+
+    If workers is more than one, bodies are sent in
+    chunks of chunk_size to a pool of processes that
+    return plain dicts, and Records are built in the
+    original order.
+
+    Body normalization applies the stop_chars and
+    stop_phrases configs in order (see tokenize).
 
-    The keep variable that gets passed around would
-    be better suited as a deque based on copious
-    use of what amounts to popleft.
+    The keep variable that gets passed around is a
+    Tokens cursor that each consumer advances past
+    what it has parsed.
     """
     stop_phrases = List().tag(config=True)
     stop_chars = List().tag(config=True)
     debug = Int().tag(config=True)
-    mailbox = Instance(Mailbox)
+    workers = Int(0, help='processes to parse with, 0 or 1 is serial').tag(
+        config=True)
+    chunk_size = Int(1000, help='bodies sent to a worker at once').tag(
+        config=True)
+    parse_cache = Unicode('', help='sqlite file of parse results').tag(
+        config=True)
+    parse_cache_size = Int(100000, help='parse results kept').tag(
+        config=True)
+    mailbox = Instance('stonks.mailbox.Mailbox', allow_none=True)
     months = {
         'January': 1, 'February': 2,
         'March': 3, 'April': 4, 'May': 5,
@@ -44,6 +117,39 @@ class EmailParser(Configurable):
         'November': 11, 'December': 12
     }
 
+    _normalizer = None
+
+    @observe('stop_chars', 'stop_phrases')
+    def _reset_normalizer(self, change):
+        self._normalizer = None
+
+    def compile_normalizer(self):
+        """Collect the non-empty stop configs into a
+        (stop_chars, stop_phrases) pair of tuples."""
+        if self._normalizer is None:
+            self._normalizer = (tuple(c for c in self.stop_chars if c),
+                                tuple(p for p in self.stop_phrases if p))
+        return self._normalizer
+
+    def tokenize(self, bod):
+        """Strip the stop_chars, then chop the body at each
+        stop phrase, both in config order, and split on
+        whitespace. Applying them in order matters when one
+        stop config only appears once an earlier one is gone,
+        e.g. stop_chars ['c', 'ab'] leave nothing of 'acb'.
+
+        Returns:
+            [token, ...]
+        """
+        chars, phrases = self.compile_normalizer()
+        for c in chars:
+            bod = bod.replace(c, '')
+        for p in phrases:
+            end = bod.find(p)
+            if end >= 0:
+                bod = bod[:end]
+        return bod.split()
+
     def dollar_to_float(self, dollar):
         return float(dollar.strip('$').replace(',', ''))
 
@@ -54,6 +160,249 @@ class EmailParser(Configurable):
         print(fmtr.format(*fmt), end=' ')
         print(extra or '')
 
+    def header(self):
+        """Print the column names of the debug banner"""
+        self.banner(('order', 'dir', 'count', 'amount',
+                     'kind', 'ticker', 'strike', 'order',
+                     'expir', 'avg_price', 'month', 'day',
+                     'year', 'hour', 'minute', 'merid',
+                     'prt', 'prt_amt', 'prt_unit',
+                     'unfill', 'prt_prc'))
+
+    def normalize(self, bod):
+        """Strip the configured characters, chop the body
+        at the configured phrases and collapse whitespace."""
+        return ' '.join(self.tokenize(bod))
+
+    def parse_body(self, subject, idx, bod):
+        """Normalize and parse a single email body.
+
+        Returns:
+            (record, None) or (None, (subject, idx, bod))
+        """
+        tokens = self.tokenize(bod)
+        try:
+            r = self.parse_order_to_dict(subject, idx, tokens)
+            r['source'] = self.source()
+            return CompactRecord(**r), None
+        except Exception as e:
+            bod = ' '.join(tokens)
+            if self.debug > 1:
+                print(str(e), bod)
+            return None, (subject, idx, bod)
+
+    def source(self):
+        """Where the email ids are unique, see Mailbox.source."""
+        return self.mailbox.source if self.mailbox is not None else ''
+
+    def iter_dicts(self, stream):
+        """Parse a (subject, idx, body) stream serially
+        or with the process pool into dicts conforming
+        to the Record spec, with the mailbox's source.
+
+        Yields:
+            (subject, idx, body, dict or None, error or None)
+        """
+        for item in self.dispatch(stream):
+            if item[3] is not None:
+                # the mailbox knows it once the stream started
+                item[3]['source'] = self.source()
+            yield item
+
+    def dispatch(self, stream):
+        if self.parse_cache:
+            with ParseCache(self.parse_cache, self.parse_cache_size) as memo:
+                yield from self.iter_dicts_cached(stream, memo)
+            return
+        if self.workers > 1:
+            yield from self.iter_dicts_pool(stream)
+            return
+        yield from self.iter_dicts_serial(stream)
+
+    def iter_dicts_serial(self, stream):
+        for subject, idx, bod in stream:
+            try:
+                r = self.parse_order_to_dict(
+                    subject, idx, self.tokenize(bod))
+                yield subject, idx, bod, r, None
+            except Exception as e:
+                yield subject, idx, bod, None, _failure(e)
+
+    def fingerprint(self):
+        """Digest of PARSER_VERSION, the parser's code and its
+        stop configs. Results cached under another fingerprint
+        are never used again."""
+        cls = type(self)
+        if cls not in _fingerprints:
+            # the results also depend on how pool workers parse,
+            # how failures are told and what records are built of
+            _fingerprints[cls] = ''.join([_source(obj) for obj in (
+                Tokens, _parse_chunk, _failure, Record, CompactRecord)] + [
+                _source(kls) for kls in cls.__mro__
+                if issubclass(kls, EmailParser)])
+        config = json.dumps([PARSER_VERSION, list(self.stop_chars),
+                             list(self.stop_phrases)])
+        return hashlib.blake2b((config + _fingerprints[cls]).encode(),
+                               digest_size=6).hexdigest()
+
+    def iter_dicts_cached(self, stream, memo):
+        """Look each body up as it came from the mailbox and
+        only tokenize and parse (serially or in the pool) the
+        ones this parser has not seen, yielding both in stream
+        order."""
+        fp, debug = self.fingerprint(), self.debug
+
+        def lookup():
+            for subject, idx, bod in stream:
+                key = fp + hashlib.blake2b(
+                    bod.encode(), digest_size=16).hexdigest()
+                yield subject, idx, bod, key, memo.get(key)
+
+        def settle(entry, result=None):
+            """Cache a parse result or restore a hit."""
+            subject, idx, bod, key, hit = entry
+            if hit is None:
+                r, err = result
+                memo.put(key, r and {k: v for k, v in r.items()
+                                     if k not in ('subject', 'email_id',
+                                                  'source')},
+                         err)
+            else:
+                r, err = hit
+                if r is not None:
+                    r.update(subject=subject, email_id=idx)
+                    if debug:
+                        self.show(r)
+            if err is not None:
+                memo.miss(subject, idx, self.normalize(bod), err)
+            return subject, idx, bod, r, err
+
+        if self.workers <= 1:
+            for entry in lookup():
+                result = None
+                if entry[-1] is None:
+                    subject, idx, bod = entry[:3]
+                    try:
+                        result = (self.parse_order_to_dict(
+                            subject, idx, self.tokenize(bod)), None)
+                    except Exception as e:
+                        result = None, _failure(e)
+                yield settle(entry, result)
+        else:
+            pending = deque()
+
+            def misses():
+                for entry in lookup():
+                    pending.append(entry)
+                    if entry[-1] is None:
+                        yield entry[:3]
+
+            # the pool yields in stream order, so the hits queued
+            # ahead of a miss are ready once its result is
+            for *_, r, err in self.iter_dicts_pool(misses()):
+                while pending[0][-1] is not None:
+                    yield settle(pending.popleft())
+                yield settle(pending.popleft(), (r, err))
+            while pending:
+                yield settle(pending.popleft())
+        print(f'{memo.hits} bodies parsed before, {len(memo)} cached')
+
+    def cached_misses(self):
+        """The bodies that did not parse in the last run,
+        straight from the parse cache.
+
+        Returns:
+            [(subject, idx, normalized body, error), ...]
+        """
+        with ParseCache(self.parse_cache, self.parse_cache_size) as memo:
+            return memo.misses()
+
+    def iter_dicts_pool(self, stream):
+        """Fan chunks of the stream out to worker processes,
+        keeping at most two chunks per worker in flight,
+        and yield their dicts in the order of the stream."""
+        kws = {'stop_chars': list(self.stop_chars),
+               'stop_phrases': list(self.stop_phrases)}
+        stream = iter(stream)
+        pending = deque()
+        with ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                 initargs=(kws,)) as pool:
+            while True:
+                while len(pending) < 2 * self.workers:
+                    chunk = list(islice(stream, self.chunk_size))
+                    if not chunk:
+                        break
+                    pending.append((chunk, pool.submit(_parse_chunk, chunk)))
+                if not pending:
+                    break
+                chunk, fut = pending.popleft()
+                for (subject, idx, bod), (r, err) in zip(chunk, fut.result()):
+                    if r is not None and self.debug:
+                        self.show(r)
+                    yield subject, idx, bod, r, err
+
+    def missed(self, subject, idx, bod, err):
+        """The not_parsed entry of a body.
+
+        Returns:
+            (subject, idx, normalized body)
+        """
+        bod = self.normalize(bod)
+        if self.debug > 1:
+            print(err, bod)
+        return subject, idx, bod
+
+    def iter_parsed(self, stream):
+        """Parse a (subject, idx, body) stream serially
+        or with the process pool.
+
+        Yields:
+            (record, None) or (None, (subject, idx, bod))
+        """
+        for subject, idx, bod, r, err in self.iter_dicts(stream):
+            if r is not None:
+                try:
+                    yield CompactRecord(**r), None
+                    continue
+                except Exception as e:
+                    err = str(e)
+            yield None, self.missed(subject, idx, bod, err)
+
+    def parse_columns(self, stream=None, columns=None, not_parsed=None):
+        """Parse straight into a columnar accumulator without
+        building a record per email. Pass the same columns
+        again to append another chunk of a stream.
+
+        Args:
+            stream (iterable): (subject, idx, body) tuples,
+                defaults to the mailbox's iter_orders
+            columns (RecordColumns): appended to if given
+            not_parsed (list): bodies not parsed are appended
+                here as (subject, idx, body)
+
+        Returns:
+            RecordColumns
+        """
+        if stream is None:
+            stream = self.mailbox.iter_orders()
+        if columns is None:
+            columns = RecordColumns()
+        if not_parsed is None:
+            not_parsed = []
+        if self.debug:
+            self.header()
+        start = len(columns)
+        for subject, idx, bod, r, err in self.iter_dicts(stream):
+            if r is not None:
+                try:
+                    columns.append(r)
+                    continue
+                except Exception as e:
+                    err = str(e)
+            not_parsed.append(self.missed(subject, idx, bod, err))
+        self.summarize(range(len(columns) - start), not_parsed)
+        return columns
+
     def parse_orders(self):
         """Iterate over the emails, do some simple
         configurable text normalization and then
@@ -66,37 +415,103 @@ class EmailParser(Configurable):
         bodies = self.mailbox.fetch_orders()
         nrec = sum((len(bods) for bods in bodies.values()))
         print(f'parsing {nrec} orders')
+        if self.debug and self.workers > 1:
+            self.header()
+
+        def stream():
+            for subject, bods in bodies.items():
+                print(f'{len(bods)} with subject: {subject}')
+                if self.debug and self.workers <= 1:
+                    self.header()
+                for (idx, bod) in bods:
+                    yield subject, idx, bod
+
         records, not_parsed = [], []
-        for subject, bods in bodies.items():
-            print(f'{len(bods)} with subject: {subject}')
-            if self.debug:
-                self.banner(('order', 'dir', 'count', 'amount',
-                             'kind', 'ticker', 'strike', 'order',
-                             'expir', 'avg_price', 'month', 'day',
-                             'year', 'hour', 'minute', 'merid',
-                             'prt', 'prt_amt', 'prt_unit',
-                             'unfill', 'prt_prc'))
-            for (idx, bod) in bods:
-                for stop in self.stop_chars:
-                    bod = bod.replace(stop, '')
-                for stop_phrase in self.stop_phrases:
-                    bod = bod.split(stop_phrase)[0]
-                bod = ' '.join((
-                    ' '.join(ln.split()) for ln in bod.splitlines()
-                ))
-                try:
-                    records.append(
-                        self.parse_order_to_record(subject, idx, bod)
-                    )
-                except Exception as e:
-                    not_parsed.append((subject, idx, bod))
-                    if self.debug > 1:
-                        print(str(e), bod)
+        for rec, miss in self.iter_parsed(stream()):
+            if miss is None:
+                records.append(rec)
+            else:
+                not_parsed.append(miss)
+        self.summarize(records, not_parsed)
+        return records, not_parsed
+
+    def iter_records(self, stream=None, not_parsed=None):
+        """Streaming version of parse_orders. Parses each
+        email as soon as the mailbox yields it.
+
+        Args:
+            stream (iterable): (subject, idx, body) tuples,
+                defaults to the mailbox's iter_orders
+            not_parsed (list): bodies not parsed are appended
+                here as (subject, idx, body)
+
+        Yields:
+            Record
+        """
+        if stream is None:
+            stream = self.mailbox.iter_orders()
+        if not_parsed is None:
+            not_parsed = []
+        if self.debug:
+            self.header()
+        nrec = 0
+        for rec, miss in self.iter_parsed(stream):
+            if miss is None:
+                nrec += 1
+                yield rec
+            else:
+                not_parsed.append(miss)
+        self.summarize(range(nrec), not_parsed)
+
+    async def aiter_records(self, queue, not_parsed=None):
+        """iter_records for an AsyncMailbox, parses the
+        (subject, idx, body) put on an asyncio.Queue as they
+        land, until None. Parsing is serial here.
+
+        Yields:
+            Record
+        """
+        if not_parsed is None:
+            not_parsed = []
+        if self.debug:
+            self.header()
+        async for subject, idx, bod in self.mailbox.iter_queue(queue):
+            rec, miss = self.parse_body(subject, idx, bod)
+            if miss is None:
+                yield rec
+            else:
+                not_parsed.append(miss)
+
+    async def parse_orders_async(self):
+        """parse_orders with an AsyncMailbox, every email is
+        parsed while the next ones are still being fetched.
+
+        Returns:
+            (records, not_parsed)
+        """
+        import asyncio
+        queue = asyncio.Queue(self.mailbox.queue_size)
+        fetch = asyncio.create_task(self.mailbox.produce(queue))
+        records, not_parsed, done = [], [], False
+        try:
+            async for rec in self.aiter_records(queue, not_parsed):
+                records.append(rec)
+            done = True
+        finally:
+            # stopped early, nothing takes from the queue anymore
+            if not done:
+                fetch.cancel()
+            # the connections are logged out either way
+            await asyncio.gather(fetch, return_exceptions=True)
+        await fetch
+        self.summarize(records, not_parsed)
+        return records, not_parsed
+
+    def summarize(self, records, not_parsed):
         print(f'parsed {len(records)} records')
         print(f'missed {len(not_parsed)} emails')
         if len(not_parsed):
             print('make c.EmailParser.debug > 1 to see bodies not parsed')
-        return records, not_parsed
 
     def determine_order_type(self, r, keep):
         """Crypto is slightly different than equities, set
@@ -107,86 +522,88 @@ class EmailParser(Configurable):
         if r['direction'] == 'open':
             r['direction'] = 'buy'
             r['kind'] = 'contract'
-            count, r['ticker'], multi, _, *keep = keep
+            count, r['ticker'], multi, _ = keep.take(4)
             degen, r['strike'] = multi.split('-')
             r['count'] = int(count) * int(degen)
         else:
             if r['order_type'] == 'Your':
                 r['kind'] = 'crypto'
-                amt, _, *keep = keep
+                amt, _ = keep.take(2)
                 r['total_amount'] = self.dollar_to_float(amt)
                 r.pop('order_type')
             else:
-                cnt, r['kind'], _, *keep = keep
+                cnt, r['kind'], _ = keep.take(3)
                 r['count'] = int(cnt)
-            r['ticker'], *keep = keep
+            r['ticker'], = keep.take(1)
             r['kind'] = r['kind'].rstrip('s')
         # handle options details
-        if keep[0].startswith('$'):
-            r['strike'], r['order'], r['expiration'], *keep = keep
+        if keep.peek().startswith('$'):
+            r['strike'], r['order'], r['expiration'] = keep.take(3)
         return r, keep
 
     def consume_datetime(self, r, keep):
         """Isolate each component of the execution datetime
         and let transformation occur elsewhere.
         """
-        cnt = self.keep_on(keep, kind='month')
-        month, day, r['year'], *keep = keep[cnt:]
+        keep.advance(self.keep_on(keep, kind='month'))
+        month, day, r['year'] = keep.take(3)
         r['month'] = self.months[month]
         r['day'] = int(''.join((c for c in day if c.isnumeric())))
         # found a broken year so..
-        if len(r['year']) != 4 and keep[0].isnumeric():
-            r['year'] = r['year'] + keep[0]
-            keep = keep[1:]
+        if len(r['year']) != 4 and keep.peek().isnumeric():
+            r['year'] = r['year'] + keep.next()
         r['year'] = int(r['year'])
-        if keep[0] == 'at':
-            keep = keep[1:]
+        if keep.peek() == 'at':
+            keep.advance()
         # if time is broken, find the M and combine
         cnt = self.keep_on(keep, kind='meridiem')
-        time = ''.join(keep[:cnt]).strip('at')
+        time = keep.join(cnt).strip('at')
         r['hour'], r['minute'] = (int(t) for t in time.split(':'))
-        m, *keep = keep[cnt:]
+        keep.advance(cnt)
+        m, = keep.take(1)
         r['meridiem'] = m.strip('.')
         return r, keep
 
     def keep_on(self, keep, kind='dollar'):
         """Find the next occurrence of a thing of kind
-        or return the length of keep"""
-        cnt = 0
+        or return the number of tokens left in keep.
+        Same as keep.scan but inlined for the hot kinds."""
+        toks, cnt, end = keep.toks, keep.pos, len(keep.toks)
         if kind == 'dollar':
-            while cnt < len(keep) and not keep[cnt].startswith('$'):
+            while cnt < end and not toks[cnt].startswith('$'):
                 cnt += 1
         elif kind == 'number':
-            while cnt < len(keep) and not keep[cnt].isnumeric():
+            while cnt < end and not toks[cnt].isnumeric():
                 cnt += 1
         elif kind == 'month':
-            while cnt < len(keep) and not keep[cnt] in self.months.keys():
+            while cnt < end and toks[cnt] not in self.months:
                 cnt += 1
         elif kind == 'meridiem':
-            while (cnt < len(keep) and not
-                   any((m in keep[cnt] for m in ('AM', 'PM')))):
+            while (cnt < end and 'AM' not in toks[cnt]
+                   and 'PM' not in toks[cnt]):
                 cnt += 1
-        return cnt
+        return cnt - keep.pos
 
     def consume_partial_order(self, r, keep):
         """Parse the partial execution data"""
         # partial fill crypto
-        if keep[0].startswith('$'):
-            partial, _, unit, *keep = keep
-            cnt = self.keep_on(keep)
-            unfill, *keep = keep[cnt:]
+        if keep.peek().startswith('$'):
+            partial, _, unit = keep.take(3)
+            keep.advance(self.keep_on(keep))
+            unfill, = keep.take(1)
             r['unfilled_amount'] = self.dollar_to_float(unfill)
         else:
-            cnt = self.keep_on(keep, kind='number')
-            partial, unit, *keep = keep[cnt:]
+            keep.advance(self.keep_on(keep, kind='number'))
+            partial, unit = keep.take(2)
             if unit == 'of':
-                unit, *keep = keep[1:]
-            cnt = self.keep_on(keep)
-            amount, *keep = keep[cnt:]
+                keep.advance()
+                unit, = keep.take(1)
+            keep.advance(self.keep_on(keep))
+            amount, = keep.take(1)
             r['partial_price'] = self.dollar_to_float(amount)
-            if keep[0] == 'and':
-                r['unfilled_amount'] = self.dollar_to_float(keep[1])
-                keep = keep[2:]
+            if keep.peek() == 'and':
+                r['unfilled_amount'] = self.dollar_to_float(keep.peek(1))
+                keep.advance(2)
         r['partial_amount'] = self.dollar_to_float(partial)
         r['partial_unit'] = unit.rstrip('s')
         return r, keep
@@ -200,30 +617,53 @@ class EmailParser(Configurable):
         Does not process more than 2 prices.
         """
         # get [average, [total]] prices
-        prices = []
-        while True:
-            try:
-                cnt = self.keep_on(keep)
-                if cnt == len(keep):
-                    break
-                price, *keep = keep[cnt:]
-                prices.append(price)
-            except IndexError:
+        for attr in ['avg_price', 'total_amount']:
+            keep.advance(self.keep_on(keep))
+            if not len(keep):
                 break
-        for price, attr in zip(prices, ['avg_price', 'total_amount']):
-            r[attr] = self.dollar_to_float(price)
+            r[attr] = self.dollar_to_float(keep.next())
         return r
 
-    def parse_order_to_record(self, subject, idx, bod):
+    def split_order(self, tokens):
+        """Token level equivalent of bod.split('order to'),
+        there must be exactly one occurrence.
+
+        Returns:
+            (order_type, keep)
+        """
+        bod = ' '.join(tokens)
+        found = bod.count('order to')
+        if found != 1:
+            raise ValueError(f"found 'order to' {found} times")
+        # tokens have no spaces so count them to get the index of 'to..'
+        i = bod.count(' ', 0, bod.find('order to') + len('order '))
+        order_type = tokens[i - 1][:-len('order')]
+        if not order_type:
+            if i < 2:
+                raise IndexError("nothing before 'order to'")
+            order_type = tokens[i - 2]
+        rest = tokens[i][len('to'):]
+        if rest:
+            return order_type, Tokens([rest] + tokens[i + 1:])
+        return order_type, Tokens(tokens, i + 1)
+
+    def parse_order_to_dict(self, subject, idx, tokens):
         """Assumes a slowly changing format for parsing
-        the data concerning an order execution email."""
-        before_order, after_order = bod.split('order to')
-        r = {'order_type': before_order.split()[-1],
+        the data concerning an order execution email.
+        Accepts the tokens from tokenize or a normalized
+        body string.
+
+        Returns:
+            dict conforming to the Record spec
+        """
+        if isinstance(tokens, str):
+            tokens = tokens.split()
+        order_type, keep = self.split_order(tokens)
+        r = {'order_type': order_type,
              'subject': subject, 'email_id': idx}
-        keep = after_order.split()
-        r['direction'] = keep[0]
-        r, keep = self.determine_order_type(r, keep[1:])
-        r = self.parse_prices(r, keep.copy())
+        r['direction'] = keep.next()
+        r, keep = self.determine_order_type(r, keep)
+        r = self.parse_prices(r, keep.fork())
         r, keep = self.consume_datetime(r, keep)
         try:
             r, keep = self.consume_partial_order(r, keep)
@@ -231,34 +671,185 @@ class EmailParser(Configurable):
         except (ValueError, IndexError):
             r['partial'] = False
         if self.debug:
-            self.banner((r.get('order_type'),
-                         r.get('direction'),
-                         r.get('count'),
-                         r.get('total_amount'),
-                         r.get('kind'),
-                         r.get('ticker'),
-                         r.get('strike'),
-                         r.get('order'),
-                         r.get('expiration'),
-                         r.get('avg_price'),
-                         r.get('month'),
-                         r.get('day'),
-                         r.get('year'),
-                         r.get('hour'),
-                         r.get('minute'),
-                         r.get('meridiem'),
-                         r.get('partial'),
-                         r.get('partial_amount'),
-                         r.get('partial_unit'),
-                         r.get('unfilled_amount'),
-                         r.get('partial_price')))
-        return Record(**r)
+            self.show(r)
+        return r
+
+    def parse_order_to_record(self, subject, idx, tokens):
+        """Returns:
+            CompactRecord, see its to_record for a Record
+        """
+        r = self.parse_order_to_dict(subject, idx, tokens)
+        return CompactRecord(**r)
+
+    def show(self, r):
+        """Print the debug banner of a parsed dict"""
+        self.banner((r.get('order_type'),
+                     r.get('direction'),
+                     r.get('count'),
+                     r.get('total_amount'),
+                     r.get('kind'),
+                     r.get('ticker'),
+                     r.get('strike'),
+                     r.get('order'),
+                     r.get('expiration'),
+                     r.get('avg_price'),
+                     r.get('month'),
+                     r.get('day'),
+                     r.get('year'),
+                     r.get('hour'),
+                     r.get('minute'),
+                     r.get('meridiem'),
+                     r.get('partial'),
+                     r.get('partial_amount'),
+                     r.get('partial_unit'),
+                     r.get('unfilled_amount'),
+                     r.get('partial_price')))
+
+
+# bump when a change to parsing alters its results in a way the
+# source of the parser classes does not show, e.g. a dependency
+PARSER_VERSION = 1
+
+_worker = None
+_fingerprints = {}
+_steps = {}
+
+
+def _source(obj):
+    """Source of a parser class or function, its qualified
+    name where the source cannot be read, e.g. for a class
+    defined in a notebook or the REPL."""
+    try:
+        return inspect.getsource(obj)
+    except (OSError, TypeError):
+        return f'{obj.__module__}.{obj.__qualname__}'
+
+
+def _init_worker(kws):
+    """Build the EmailParser once per worker process."""
+    global _worker
+    _worker = EmailParser(**kws)
+
+
+def _parse_chunk(chunk):
+    """Parse a chunk of (subject, idx, body) in a worker.
+
+    Returns:
+        [(dict, None) or (None, error message), ...]
+    """
+    out = []
+    for subject, idx, bod in chunk:
+        try:
+            tokens = _worker.tokenize(bod)
+            out.append((_worker.parse_order_to_dict(subject, idx, tokens),
+                        None))
+        except Exception as e:
+            out.append((None, _failure(e)))
+    return out
+
+
+def _failure(exc):
+    """Error message of a body that did not parse, led by
+    its failure point: the parser step parse_order_to_dict
+    was in (e.g. consume_datetime), or where the parse
+    began. Frames of code that is not the parser's, like
+    Tokens or the stage timers wrapped around the steps,
+    are skipped."""
+    frames = []
+    tb = exc.__traceback__
+    while tb is not None:
+        frames.append(tb.tb_frame)
+        tb = tb.tb_next
+    cls = next((type(frame.f_locals['self']) for frame in frames
+                if isinstance(frame.f_locals.get('self'), EmailParser)),
+               EmailParser)
+    if cls not in _steps:
+        _steps[cls] = {getattr(func, '__code__', None)
+                       for kls in cls.__mro__
+                       for func in vars(kls).values()}
+    names = [frame.f_code.co_name for frame in frames]
+    start = (names.index('parse_order_to_dict') + 1
+             if 'parse_order_to_dict' in names else 1)
+    point = next((frame.f_code.co_name for frame in frames[start:]
+                  if frame.f_code in _steps[cls]), 'parse_order_to_dict')
+    return f'{point}: {exc}'
+
+
+_date = re.compile(r'\d{1,2}/\d{1,2}/\d{4}$')
+
+
+def _number(tok):
+    try:
+        return float(tok.replace(',', ''))
+    except ValueError:
+        return None
+
+
+def _money(tok):
+    """'$1,234.50' or '($1,234.50)' as a float."""
+    value = float(tok.strip('($)').replace(',', ''))
+    return -value if tok.startswith('(') else value
+
+
+def _iter_pdf_pages(path, pagenos=None):
+    """Yield the text of the pages of a pdf numbered
+    pagenos (all of them if None) one page at a time.
+    """
+    from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfpage import PDFPage
+    resource = PDFResourceManager()
+    ret = StringIO()
+    dev = TextConverter(resource, ret, laparams=LAParams())
+    try:
+        with open(path, 'rb') as f:
+            interp = PDFPageInterpreter(resource, dev)
+            pagenos = set(pagenos or ())
+            for page in PDFPage.get_pages(
+                    f, pagenos, maxpages=0, password='',
+                    caching=True, check_extractable=True):
+                interp.process_page(page)
+                yield ret.getvalue()
+                ret.seek(0)
+                ret.truncate()
+    finally:
+        dev.close()
+        ret.close()
+
+
+def _extract_pdf(path, pagenos=None):
+    """Text of the pages of a pdf, run in workers as well."""
+    return ''.join(_iter_pdf_pages(path, pagenos))
+
+
+def split_pages(pieces, sep='Page '):
+    """Same as ''.join(pieces).split(sep) without joining,
+    so at most one page is held at a time. sep must not
+    straddle two pieces, lines and pdf pages are fine.
+    """
+    buf = []
+    for piece in pieces:
+        head, *rest = piece.split(sep)
+        buf.append(head)
+        if rest:
+            yield ''.join(buf)
+            yield from rest[:-1]
+            buf = [rest[-1]]
+    yield ''.join(buf)
 
 
 class StatementParser(Configurable):
     """A robinhood specific plain text pdf statement parser.
     Attempts a page-by-page determination of the content
     in hopes to be less brittle.
+
+    The pdf layout analysis is by far the slowest step.
+    If workers is more than one, pdfs (or page ranges of
+    pages_per_task pages of them) are extracted in a pool
+    of processes, and if text_cache is set, extracted text
+    is kept by content hash so unchanged statements are
+    not analyzed again.
     """
     debug = Int().tag(config=True)
     portfolio_token = Unicode().tag(config=True)
@@ -266,44 +857,161 @@ class StatementParser(Configurable):
     activity_token = Unicode().tag(config=True)
     activity_tokens = List().tag(config=True)
     statements = List().tag(config=True)
+    workers = Int(0, help='processes to extract pdfs with, 0 or 1 is serial'
+                  ).tag(config=True)
+    pages_per_task = Int(0, help='pages of one pdf per worker task, '
+                                 '0 sends whole files').tag(config=True)
+    text_cache = Unicode('', help='directory of extracted pdf text').tag(
+        config=True)
+    acct_types = List(['Margin', 'Cash'], help='values of ACCT TYPE').tag(
+        config=True)
+    activity_end = Unicode('Total Funds Paid and Received',
+                           help='text following the account activity').tag(
+                               config=True)
+    buy_codes = List(['Buy', 'BTO', 'BTC'],
+                     help='transaction codes that buy').tag(config=True)
+    sell_codes = List(['Sell', 'STO', 'STC'],
+                      help='transaction codes that sell').tag(config=True)
 
     def parse_txt_fmt(self, path):
         with open(path, 'r') as f:
             return f.read()
 
     def parse_pdf_fmt(self, path):
-        resource = PDFResourceManager()
-        ret = StringIO()
-        dev = TextConverter(resource, ret, laparams=LAParams())
+        return _extract_pdf(path)
+
+    def count_pages(self, path):
+        """Page count without any layout analysis."""
+        from pdfminer.pdfpage import PDFPage
         with open(path, 'rb') as f:
-            interp = PDFPageInterpreter(resource, dev)
-            pagenos = set()
-            for page in PDFPage.get_pages(
-                    f, pagenos, maxpages=0, password='',
-                    caching=True, check_extractable=True):
-                interp.process_page(page)
-            text = ret.getvalue()
-        dev.close()
-        ret.close()
-        return text
+            return sum(1 for _ in PDFPage.get_pages(f))
 
-    def parse_orders(self):
-        dumps = defaultdict(dict)
+    def tasks(self, path):
+        """Page ranges of path to hand to workers."""
+        if self.pages_per_task <= 0:
+            return [None]
+        pages = self.count_pages(path)
+        return [range(i, min(i + self.pages_per_task, pages))
+                for i in range(0, pages, self.pages_per_task)] or [None]
+
+    def extract(self, paths):
+        """Text of each pdf, from the text cache when the file
+        is unchanged, otherwise extracted serially or across
+        worker processes.
+
+        Returns:
+            {path: text}
+        """
+        cache = TextCache(self.text_cache) if self.text_cache else None
+        texts, todo = {}, {}
+        for path in paths:
+            digest = cache.digest(path) if cache else None
+            text = cache.get(digest) if cache else None
+            if text is None:
+                todo[path] = digest
+            else:
+                print(f"{path} unchanged, using cached text")
+                texts[path] = text
+        if self.workers > 1 and todo:
+            with ProcessPoolExecutor(self.workers) as pool:
+                futs = {path: [pool.submit(_extract_pdf, path, pagenos)
+                               for pagenos in self.tasks(path)]
+                        for path in todo}
+                for path, parts in futs.items():
+                    texts[path] = ''.join(fut.result() for fut in parts)
+        else:
+            for path in todo:
+                texts[path] = self.parse_pdf_fmt(path)
+        if cache:
+            for path, digest in todo.items():
+                cache.put(digest, texts[path])
+        return texts
+
+    def iter_source(self, path):
+        """Text of a statement in pieces, lines of a text
+        dump or cached text, or one pdf page at a time."""
+        if path.split('.')[-1] == 'txt':
+            with open(path, 'r') as f:
+                yield from f
+            return
+        cache = TextCache(self.text_cache) if self.text_cache else None
+        digest = cache.digest(path) if cache else None
+        cached = cache.find(digest) if cache else None
+        if cached is not None:
+            print(f"{path} unchanged, using cached text")
+            with open(cached, 'r', encoding='utf-8') as f:
+                yield from f
+            return
+        pages = _iter_pdf_pages(path)
+        yield from cache.tee(digest, pages) if cache else pages
+
+    def parse_statements(self):
+        """Parse every statement page by page. Serially only
+        one page is held at a time; with workers the pdfs
+        are extracted whole in parallel first.
+
+        Returns:
+            (records, holdings, not_parsed) with a CompactRecord
+            per buy or sell in the account activity, a dict per
+            portfolio summary line item and (statement, idx,
+            line item) for the rest of the account activity.
+            Records come from source "statement:<file name>"
+            with the email_id of item_id.
+        """
+        texts = {}
+        if self.workers > 1:
+            texts = self.extract([path for path in self.statements
+                                  if path.split('.')[-1] == 'pdf'])
+        dicts, holdings, not_parsed = [], [], []
         for path in self.statements:
             print(f"reading {path}, exists {os.path.isfile(path)}")
-            ext = path.split('.')[-1]
-            raw = {'pdf': self.parse_pdf_fmt,
-                   'txt': self.parse_txt_fmt}[ext](path)
-            dumps[path]['raw'] = raw
-            self.parse_pages(path, dumps, raw)
-        return None, None
-
-    def parse_pages(self, path, dumps, text):
-        """This is not sufficient to parse the pdf"""
-        begin, *pages = text.split('Page ')
-        print(f"statement has {len(pages)} pages")
-        ports, acts = [], []
-        for i, page in enumerate(pages):
+            acts, ports = self.parse_pages(path, texts.pop(path, None))
+            source = f'statement:{os.path.basename(path)}'
+            seen = Counter()
+            for headers, item in acts:
+                idx = self.item_id(source, headers[0], item, seen)
+                try:
+                    r = self.activity_to_dict(path, idx, item)
+                    r['source'] = source
+                    dicts.append(r)
+                except ValueError:
+                    not_parsed.append((path, idx, item))
+            for headers, item in ports:
+                holdings.append(self.holding_to_dict(path, headers, item))
+        records = CompactRecord.from_dicts(dicts)
+        print(f'parsed {len(records)} trades, {len(holdings)} holdings')
+        print(f'skipped {len(not_parsed)} other activity line items')
+        return records, holdings, not_parsed
+
+    @staticmethod
+    def item_id(source, pageno, item, seen):
+        """A record id for an activity line item that stays
+        the same across runs and other statements: a hash of
+        the statement, page and line item, and how many of
+        the same line item came before it on the page.
+        """
+        key = repr((source, pageno, item))
+        seen[key] += 1
+        digest = hashlib.blake2b(f'{key}{seen[key]}'.encode(),
+                                 digest_size=7).digest()
+        return int.from_bytes(digest, 'big')
+
+    def parse_orders(self):
+        """Same as parse_statements without the holdings."""
+        records, holdings, not_parsed = self.parse_statements()
+        return records, not_parsed
+
+    def iter_pages(self, path, text=None):
+        """Split a statement into pages as they are read.
+
+        Yields:
+            (headers, activity, portfolio) per page
+        """
+        pieces = self.iter_source(path) if text is None else [text]
+        pages = split_pages(pieces)
+        # whatever precedes the first page
+        next(pages, None)
+        for page in pages:
             pageno, period, name_acct, addr, *norm = [
                 ln.strip() for ln in page.splitlines() if ln.strip()
             ]
@@ -313,43 +1021,159 @@ class StatementParser(Configurable):
             print(f"parsing page {pageno} {period} user * addr *")
             print(page[:100])
             headers = (pageno, period, name_acct, addr)
-            act = self.parse_activity(page)
-            if act is not None:
-                acts.append((*headers, act))
+            yield (headers, self.parse_activity(page),
+                   self.parse_portfolio(page))
+
+    def parse_pages(self, path, text=None):
+        """Returns:
+            ([(headers, activity line item), ...],
+             [(headers, portfolio line item), ...])
+        """
+        npages, ports, acts = 0, [], []
+        for headers, act, port in self.iter_pages(path, text):
+            npages += 1
+            acts.extend((headers, item) for item in act or ())
+            ports.extend((headers, item) for item in port or ())
+        print(f"statement has {npages} pages")
+        return acts, ports
+
+    def describe(self, desc, symbol):
+        """Instrument of a line item, options are described
+        as 'TICKER MM/DD/YYYY Call $STRIKE'."""
+        if (len(desc) >= 4 and desc[-2] in ('Call', 'Put')
+                and _date.match(desc[-3]) and desc[-1].startswith('$')):
+            month, day, year = desc[-3].split('/')
+            return {'kind': 'contract', 'ticker': desc[-4],
+                    'order': desc[-2], 'strike': desc[-1],
+                    'expiration': f'{month}/{day}/{year[-2:]}'}
+        return {'kind': 'share', 'ticker': symbol}
+
+    def activity_to_dict(self, path, idx, item):
+        """Returns:
+            dict conforming to the Record spec for a buy or
+            sell, raises ValueError for anything else
+        """
+        desc, symbol, acct, code, date, qty, price, amount = item
+        if code in self.buy_codes:
+            direction = 'buy'
+        elif code in self.sell_codes:
+            direction = 'sell'
+        else:
+            raise ValueError(f'not a trade: {code}')
+        if qty is None or amount is None:
+            raise ValueError(f'incomplete trade: {item}')
+        month, day, year = (int(x) for x in date.split('/'))
+        r = {'subject': path, 'email_id': idx, 'direction': direction,
+             'count': qty, 'avg_price': price,
+             'total_amount': abs(amount), 'month': month, 'day': day,
+             'year': year, 'partial': False}
+        r.update(self.describe(desc.split(), symbol))
+        return r
+
+    def holding_to_dict(self, path, headers, item):
+        desc, symbol, acct, qty, price, value = item
+        r = {'statement': path, 'period': headers[1], 'acct_type': acct,
+             'count': qty, 'price': price, 'market_value': value,
+             'ticker': symbol, 'kind': 'share', 'strike': '', 'order': '',
+             'expiration': ''}
+        r.update(self.describe(desc.split(), symbol))
+        return r
+
+    def line_items(self, toks, header, anchor):
+        """Split a table into line items in a single pass.
+
+        Only tokens in acct_types can anchor a line item,
+        anchor(toks, i) returns its fields and the index
+        past them or None. The tokens between the previous
+        line item and the anchor, less any header tokens,
+        are the description and symbol.
+        """
+        accts = frozenset(self.acct_types)
+        keep = Tokens(toks)
+        items = []
+        for i in [i for i, tok in enumerate(toks) if tok in accts]:
+            keep.advance(keep.scan(lambda tok: tok not in header))
+            if i <= keep.pos:
+                continue
+            found = anchor(toks, i)
+            if found is None:
+                continue
+            fields, end = found
+            items.append((keep.join(i - 1 - keep.pos, ' '), toks[i - 1],
+                          *fields))
+            keep.pos = end
+        return items
+
+    def portfolio_anchor(self, toks, i):
+        """ACCT TYPE QTY $PRICE $MKT VALUE [$INCOME] [%]"""
+        if (i + 3 >= len(toks) or _number(toks[i + 1]) is None
+                or not toks[i + 2].startswith('$')):
+            return None
+        fields = (toks[i], _number(toks[i + 1]), _money(toks[i + 2]),
+                  _money(toks[i + 3]))
+        i += 4
+        if i < len(toks) and toks[i].startswith('$'):
+            i += 1
+        if i < len(toks) and toks[i].endswith('%'):
+            i += 1
+        return fields, i
+
+    def activity_anchor(self, toks, i):
+        """ACCT TYPE TRANSACTION DATE [QTY] [$PRICE] [$AMOUNT]"""
+        if i + 2 >= len(toks) or not _date.match(toks[i + 2]):
+            return None
+        acct, code, date = toks[i:i + 3]
+        i += 3
+        qty = _number(toks[i]) if i < len(toks) else None
+        if qty is not None:
+            i += 1
+        dollars = []
+        while (len(dollars) < 2 and i < len(toks)
+               and toks[i].startswith(('$', '($'))):
+            dollars.append(_money(toks[i]))
+            i += 1
+        price = dollars[0] if len(dollars) == 2 else None
+        amount = dollars[-1] if dollars else None
+        return (acct, code, date, qty, price, amount), i
 
     def parse_portfolio(self, page):
         split = page.split(self.portfolio_tokens[0])
         if len(split) == 1: return
         split = ' '.join([self.portfolio_tokens[0], split[1]])
         split = split.split(self.activity_token)[0]
-        split = split.split(self.portfolio_tokens[-1])[1].split()
-        #print("portfolio", len(split), split)
+        # the table header can be cut off by a page break
+        split = split.split(self.portfolio_tokens[-1])
+        if len(split) == 1: return
+        split = split[1].split()
+        header = frozenset(' '.join(self.portfolio_tokens).split())
+        good = self.line_items(split, header, self.portfolio_anchor)
+        if self.debug:
+            print("portfolio", "line items", len(good),
+                  good[0] if len(good) else None)
+        return good
+
+    def section(self, page, head, ends):
+        """Text of page from head up to the first of ends
+        after it, None if head is not on the page."""
+        begin = page.find(head)
+        if begin < 0:
+            return None
+        stops = [page.find(end, begin + len(head)) for end in ends if end]
+        stops = [stop for stop in stops if stop >= 0]
+        return page[begin:min(stops, default=len(page))]
 
     def parse_activity(self, page):
-        split = page.split(self.activity_tokens[0])
-        if len(split) == 1: return
-        split = ' '.join([self.activity_tokens[0], split[1]]).split()
-        good = []
-        # smh
-        while True:
-            try:
-                cnt = 0
-                while cnt < len(split) and split[cnt] in self.activity_tokens:
-                    cnt += 1
-                split = split[cnt:]
-                if '/' in split[1] and split[3].startswith('$'):
-                    good.append(('contract', *split[:4]))
-                    split = split[4:]
-                else:
-                    cnt = 0
-                    while 'CUSIP' not in split[cnt]:
-                        cnt += 1
-                    wordy = ' '.join(split[:cnt + 2])
-                    good.append(('share', wordy))
-                    split = split[cnt + 2:]
-            except IndexError:
-                break
+        # a page can repeat the table header, the activity
+        # only ends at activity_end
+        split = self.section(page, self.activity_tokens[0],
+                             [self.activity_end])
+        if split is None: return
+        split = split.split()
+        header = frozenset(' '.join(
+            [self.activity_token, *self.activity_tokens]).split())
+        good = self.line_items(split, header, self.activity_anchor)
         print("activity", "split", len(split),
               "line items", len(good),
               good[0] if len(good) else None,
               good[-1] if len(good) else None)
+        return good
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 # Copyright 2020, Stonks Development Team
 # Distributed under the terms of the Apache License 2.0
-import datetime as dt
+import os
+import json
+from itertools import islice
+from operator import attrgetter
 
+import numpy as np
 import pandas as pd
 from traitlets.config.configurable import Configurable
-from traitlets import Int, Float, TraitType
+from traitlets import Int, Float, Unicode, Bool, TraitType
+
+from .record import CompactRecord, FIELDS
+from .lots import LotMatcher
 
 
 class Processor(Configurable):
@@ -14,28 +21,96 @@ class Processor(Configurable):
     """
     debug = Int().tag(config=True)
     total_deposit = Float().tag(config=True)
+    chunk_size = Int(10000).tag(config=True)
+    timezone = Unicode('America/New_York',
+                       help='timezone execution times are given in').tag(
+                           config=True)
+    ledger_file = Unicode(help='json file of running position sums and '
+                                'the records applied to them').tag(
+                                    config=True)
+    rebuild = Bool(False, help='recompute the ledger from scratch').tag(
+        config=True)
+    lot_matching = Bool(None, allow_none=True,
+                        help='match lots for realized PnL over the whole '
+                             'history, None does unless the ledger is '
+                             'updated incrementally').tag(config=True)
 
-    def records_to_df(self, records):
-        """Convert a list of Configurable data
-        structures to a dataframe."""
-        rec = records[0].__class__
-        attrs = [
-            key for key, val in vars(rec).items()
+    # the fields analyze looks at
+    columns = ['email_id', 'source', 'direction', 'count', 'kind', 'ticker',
+               'strike', 'order', 'expiration', 'total_amount', 'avg_price',
+               'partial', 'partial_amount', 'partial_price', 'year', 'month',
+               'day', 'hour', 'minute', 'meridiem']
+
+    def record_attrs(self, rec):
+        if isinstance(rec, CompactRecord):
+            return list(FIELDS)
+        return [
+            key for key, val in vars(rec.__class__).items()
             if isinstance(val, TraitType)
         ]
-        df = pd.DataFrame.from_records((
-            {key: getattr(rec, key, None) for key in attrs}
-            for rec in records
-        ))
+
+    def records_frame(self, records):
+        """Build a dataframe from a non-empty list of
+        CompactRecord (as tuples) or Records (as dicts)."""
+        attrs = self.record_attrs(records[0])
+        if isinstance(records[0], CompactRecord):
+            return pd.DataFrame.from_records(
+                list(map(attrgetter(*attrs), records)), columns=attrs)
+        return pd.DataFrame.from_records(
+            [{key: getattr(rec, key, None) for key in attrs}
+             for rec in records], columns=attrs)
+
+    def records_to_df(self, records):
+        """Convert a list of records to a dataframe."""
+        df = self.records_frame(records)
+        print(f'dataframe has shape {df.shape}')
+        return df
+
+    holding_columns = ['statement', 'period', 'acct_type', 'ticker', 'kind',
+                       'strike', 'order', 'expiration', 'count', 'price',
+                       'market_value']
+
+    def holdings_to_df(self, holdings):
+        """Portfolio summary line items of the statements."""
+        df = pd.DataFrame(holdings, columns=self.holding_columns)
+        print(f'holdings dataframe has shape {df.shape}')
+        return df
+
+    def columns_to_df(self, columns):
+        """Hand a RecordColumns accumulator over to a
+        dataframe without building records."""
+        df = columns.to_df()
         print(f'dataframe has shape {df.shape}')
         return df
 
+    def stream_to_df(self, records):
+        """Convert an iterable of records to a dataframe
+        chunk_size records at a time so that only one
+        chunk of record objects is alive at once."""
+        records = iter(records)
+        chunks = []
+        while True:
+            chunk = list(islice(records, self.chunk_size))
+            if not chunk:
+                break
+            chunks.append(self.records_frame(chunk))
+        if not chunks:
+            return pd.DataFrame()
+        df = pd.concat(chunks, ignore_index=True)
+        print(f'dataframe has shape {df.shape} from {len(chunks)} chunks')
+        return df
+
     def add_date_and_fix_expir_year(self, df):
-        # the expiry date is given with no year if
-        # it's unambiguous with the execution date
-        update = df[df['expiration'].str.len() == 5].index
-        df.loc[update, 'expiration'] = df.loc[update, 'expiration'].str.cat(
-            df.loc[update, 'year'].astype(str).str[2:], sep='/')
+        # the expiry date is given with no year if it's
+        # unambiguous with the execution date, take the year
+        # normalize_datetimes settled on in expiration_ts
+        expiration = df['expiration'].astype(object)
+        update = (expiration.fillna('').astype(str).str.count('/').eq(1)
+                  & df['expiration_ts'].notna())
+        if update.any():
+            df['expiration'] = expiration.where(
+                ~update, expiration.str.cat(
+                    df['expiration_ts'].dt.strftime('%y'), sep='/'))
         # compute total_amount from avg_price and count
         update = df[df['total_amount'] == 0].index
         # try to compute partial orders
@@ -44,63 +119,287 @@ class Processor(Configurable):
         upd = df[df['partial_amount'] > 0].index
         df.loc[upd, 'count'] = df.loc[upd, 'partial_amount']
         df.loc[update, 'total_amount'] = df.loc[update, 'count'] * df.loc[update, 'avg_price']
-        #df['execution_date'] = pd.to_datetime(
-        #    df['year'].apply('{:04d}'.format).str.cat(
-        #        df['month'].apply('{:02d}'.format).str.cat(
-        #            df['day'].apply('{:02d}'.format)
-        #        )
-        #    )
-        #)
         return df
 
-    def compute_positions(self, df):
-        inputs = ['ticker', 'strike', 'order', 'expiration']
+    # options stop trading at the close on expiration day
+    expiration_minute = 16 * 60
+
+    @staticmethod
+    def wall_clock(year, month, day, minute=0):
+        """Naive datetime64[m] from integer date components,
+        NaT where they do not form a date."""
+        year, month, day, minute = (
+            np.asarray(x, dtype=np.int64) for x in (year, month, day, minute))
+        valid = ((year > 0) & (month >= 1) & (month <= 12)
+                 & (day >= 1) & (day <= 31))
+        months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+        days = months.astype('datetime64[D]') + day - 1
+        # a day past the end of its month rolls into the next
+        valid &= days.astype('datetime64[M]') == months
+        wall = days.astype('datetime64[m]') + minute
+        wall[~valid] = np.datetime64('NaT')
+        return wall
+
+    def localize(self, wall):
+        """Attach the broker's timezone to wall clock times,
+        times repeated by a DST change are taken as DST."""
+        idx = pd.DatetimeIndex(wall.astype('datetime64[ns]'))
+        return idx.tz_localize(self.timezone,
+                               ambiguous=np.ones(len(idx), dtype=bool),
+                               nonexistent='shift_forward')
+
+    def execution_wall(self, df):
+        hour = df['hour'].fillna(0).to_numpy(np.int64) % 12 + np.where(
+            (df['meridiem'] == 'PM').to_numpy(), 12, 0)
+        return self.wall_clock(
+            df['year'].fillna(0), df['month'].fillna(0),
+            df['day'].fillna(0),
+            hour * 60 + df['minute'].fillna(0).to_numpy(np.int64))
+
+    @staticmethod
+    def split_expirations(expirations):
+        """Integer month, day and year of "mm/dd[/yy]"
+        strings, -1 where missing. Only the few distinct
+        strings are split."""
+        codes, uniq = pd.factorize(expirations.fillna('').astype(str))
+        parts = pd.Series(uniq, dtype=object).str.split('/', expand=True)
+        parts = parts.reindex(columns=range(3))
+        month, day, year = (
+            pd.to_numeric(parts[i], errors='coerce').fillna(-1).to_numpy(
+                np.int64)[codes] if len(uniq) else
+            np.full(len(expirations), -1, dtype=np.int64) for i in range(3))
+        year = np.where((year >= 0) & (year < 100), year + 2000, year)
+        return month, day, year
+
+    def expiration_wall(self, df, executed):
+        """Market close on the expiration date, a missing
+        year is the first one not before the execution."""
+        month, day, year = self.split_expirations(df['expiration'])
+        inferred = year < 0
+        exec_year = df['year'].fillna(0).to_numpy(np.int64)
+        year = np.where(inferred, exec_year, year)
+        wall = self.wall_clock(year, month, day, self.expiration_minute)
+        rolled = inferred & (wall < executed)
+        wall[rolled] = self.wall_clock(year[rolled] + 1, month[rolled],
+                                       day[rolled], self.expiration_minute)
+        return wall
+
+    def normalize_datetimes(self, df):
+        """Add tz-aware execution_ts and expiration_ts (NaT
+        without an expiration) built from the integer date
+        columns, leaving the expiration strings as keys."""
+        executed = self.execution_wall(df)
+        df['execution_ts'] = self.localize(executed)
+        df['expiration_ts'] = self.localize(
+            self.expiration_wall(df, executed))
+        return df
+
+    position_keys = ['ticker', 'strike', 'order', 'expiration']
+
+    def position_sums(self, df):
+        """Sum buy and sell counts and amounts per position
+        in a single groupby.
+
+        Returns:
+            DataFrame of sells, buys, sell_amt, buy_amt
+            indexed by position_keys
+        """
+        # the only way buy doesn't exist is if its mislabeled
+        # smh multi option orders. not sure fix is in parser
+        buy = (df['direction'] == 'buy').to_numpy()
+        sel = (df['direction'] == 'sell').to_numpy()
+        legs = pd.DataFrame({
+            'sells': df['count'].where(sel, 0),
+            'buys': df['count'].where(buy, 0),
+            'sell_amt': df['total_amount'].where(sel, 0),
+            'buy_amt': df['total_amount'].where(buy, 0),
+        })
+        legs[self.position_keys] = df[self.position_keys]
+        return legs.groupby(self.position_keys, observed=True).sum()
+
+    def finalize_positions(self, sums):
+        """Net the sums per position and zero the short
+        counts of expired options."""
+        inputs = self.position_keys
         outputs = ['sells', 'buys', 'count', 'amount']
-        grps = df.groupby(inputs)
-        pos = []
-        print("computing PNL per position")
+        pos = sums.sort_index().reset_index()
+        pos['count'] = pos['sells'] - pos['buys']
+        pos['amount'] = pos['sell_amt'] - pos['buy_amt']
+        # try to handle expired positions..
+        short = pos['count'].lt(0) & pos['expiration'].astype(bool)
+        if short.any():
+            # expired at the close of the expiration day, the
+            # same moment LotMatcher closes them at
+            expirs = pos.loc[short, 'expiration']
+            month, day, year = self.split_expirations(expirs)
+            closes = self.localize(self.wall_clock(
+                year, month, day, self.expiration_minute))
+            expired = closes < pd.Timestamp.now(self.timezone)
+            pos.loc[expirs.index[expired], 'count'] = 0
+        pos = pos[inputs + outputs]
         if self.debug:
             print(('tick', 'strk', 'ord', 'exp', 'sell', 'buy', 'cnt', 'amt'))
-        for tup, grp in grps:
-            sub = grp.groupby('direction')
-            buy, sell = None, None
-            buy_cnt, sel_cnt, buy_amt, sel_amt = 0, 0, 0, 0
-            try:
-                # the only way buy doesn't exist is if its mislabeled
-                # smh multi option orders. not sure fix is in parser
-                buy = sub.get_group('buy')
-                buy_cnt = buy['count'].sum()
-                buy_amt = buy['total_amount'].sum()
-            except KeyError:
-                pass
-            try:
-                # sell might not exist if still holding
-                sel = sub.get_group('sell')
-                sel_cnt = sel['count'].sum()
-                sel_amt = sel['total_amount'].sum()
-            except KeyError:
-                pass
-            count = sel_cnt - buy_cnt
-            amount = sel_amt - buy_amt
-            # try to handle expired positions..
-            # this func getting out of hand
-            if count < 0 and tup[-1]:
-                expir = pd.Timestamp(tup[-1])
-                today = dt.datetime.today()
-                if expir < today:
-                    count = 0
-            pos.append((*tup, *(sel_cnt, buy_cnt, count, amount)))
-            if self.debug:
-                print(pos[-1])
-        return pd.DataFrame(pos, columns=inputs + outputs)
+            for row in pos.itertuples(index=False):
+                print(tuple(row))
+        return pos
+
+    def compute_positions(self, df):
+        """Net sells against buys per position.
+
+        Returns:
+            DataFrame of ticker, strike, order, expiration,
+            sells, buys, count, amount
+        """
+        print("computing PNL per position")
+        return self.finalize_positions(self.position_sums(df))
+
+    def load_ledger(self):
+        """Returns:
+            (position sums, {source: {email_id, ...}} applied),
+            applied is None for a ledger that does not say
+        """
+        cols = ['sells', 'buys', 'sell_amt', 'buy_amt']
+        if not os.path.isfile(self.ledger_file):
+            index = pd.MultiIndex.from_tuples([], names=self.position_keys)
+            return pd.DataFrame(columns=cols, index=index, dtype=float), {}
+        with open(self.ledger_file, 'r') as f:
+            state = json.load(f)
+        rows = state['positions']
+        index = pd.MultiIndex.from_tuples(
+            [tuple(row[:4]) for row in rows], names=self.position_keys)
+        sums = pd.DataFrame([row[4:] for row in rows], columns=cols,
+                            index=index, dtype=float)
+        applied = state.get('applied')
+        if applied is not None:
+            applied = {source: set(ids) for source, ids in applied.items()}
+        return sums, applied
+
+    def save_ledger(self, sums, applied):
+        rows = [[*key, *vals] for key, vals in zip(
+            sums.index.tolist(), sums.itertuples(index=False, name=None))]
+        tmp = self.ledger_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'applied': {source: sorted(ids)
+                                   for source, ids in applied.items()},
+                       'positions': rows}, f)
+        os.replace(tmp, self.ledger_file)
+
+    @staticmethod
+    def record_keys(df):
+        """Returns:
+            (source, email_id) arrays, email ids are only
+            unique within their source
+        """
+        if 'source' in df:
+            sources = df['source'].astype(object).fillna('').to_numpy()
+        else:
+            sources = np.full(len(df), '', dtype=object)
+        return sources, df['email_id'].to_numpy(np.int64)
+
+    def applied_mask(self, df, applied):
+        """Rows of df whose key the ledger already applied."""
+        sources, ids = self.record_keys(df)
+        mask = np.zeros(len(df), dtype=bool)
+        for source, done in applied.items():
+            at = sources == source
+            if at.any():
+                mask[at] = np.isin(ids[at], np.fromiter(
+                    done, dtype=np.int64, count=len(done)))
+        return mask
+
+    def mark_applied(self, applied, df):
+        sources, ids = self.record_keys(df)
+        for source in set(sources):
+            applied.setdefault(source, set()).update(
+                ids[sources == source].tolist())
+        return applied
+
+    @staticmethod
+    def moved(applied, df):
+        """Whether the records come from another folder or
+        uidvalidity than the ledger's, their uids then say
+        nothing about what was applied."""
+        now = {source for source in Processor.record_keys(df)[0]
+               if source.startswith('imap:')}
+        then = {source for source in applied if source.startswith('imap:')}
+        return bool(now and then and now != then)
+
+    def update_ledger(self, df):
+        """Apply only the records whose (source, email_id)
+        the ledger has not applied yet and save it. Only
+        those are prepared, the rest of the history is in
+        the ledger already.
+
+        Returns:
+            the same DataFrame as compute_positions
+        """
+        sums, applied = self.load_ledger()
+        if applied is None or self.moved(applied, df):
+            print("ledger is keyed on another mailbox folder, rebuilding")
+            return self.rebuild_ledger(self.prepare(df))
+        new = df[~self.applied_mask(df, applied)]
+        print(f"applying {len(new)} new records to the ledger")
+        if len(new):
+            new = self.prepare(new.reset_index(drop=True))
+            sums = sums.add(self.position_sums(new), fill_value=0)
+            self.mark_applied(applied, new)
+        self.save_ledger(sums, applied)
+        return self.finalize_positions(sums)
+
+    def rebuild_ledger(self, df):
+        """Recompute the ledger from every prepared record,
+        report whether the incremental ledger agreed and
+        save it.
+
+        Returns:
+            the same DataFrame as compute_positions
+        """
+        sums = self.position_sums(df)
+        old, applied = self.load_ledger()
+        if applied:
+            both = sums.align(old, fill_value=0)
+            agree = np.allclose(both[0].to_numpy(float),
+                                both[1].to_numpy(float))
+            print(f"incremental ledger agrees with rebuild: {agree}")
+        self.save_ledger(sums, self.mark_applied({}, df))
+        return self.finalize_positions(sums)
+
+    def match_lots(self, df):
+        """Returns:
+            (lots, positions) of LotMatcher.match
+        """
+        return LotMatcher(config=self.config).match(df)
+
+    def prepare(self, df):
+        """Timestamps, expiration years and filled counts."""
+        return self.add_date_and_fix_expir_year(self.normalize_datetimes(df))
 
     def analyze(self, df):
-        df = self.add_date_and_fix_expir_year(df)
-        s = df.groupby('direction')['total_amount'].sum()
-        dum = s['sell'] - s['buy'] - self.total_deposit
+        incremental = bool(self.ledger_file) and not self.rebuild
+        if incremental:
+            # the history is in the ledger, only new records go
+            # through update_ledger
+            pos = self.update_ledger(df)
+            dum = pos['amount'].sum() - self.total_deposit
+        else:
+            df = self.prepare(df)
+            s = df.groupby('direction', observed=True)['total_amount'].sum()
+            dum = s['sell'] - s['buy'] - self.total_deposit
+            if self.ledger_file:
+                pos = self.rebuild_ledger(df)
+            else:
+                pos = self.compute_positions(df)
         print(f"Naive: sells - buys - total deposit = {dum}")
-        print("not handling partial orders in computing positions")
-        pos = self.compute_positions(df)
+        lot_matching = self.lot_matching
+        if lot_matching is None:
+            lot_matching = not incremental
+        if lot_matching:
+            # lots are matched over the whole history
+            if 'execution_ts' not in df:
+                df = self.prepare(df)
+            lots, matched = self.match_lots(df)
+            print(f"Realized ({lots['reason'].ne('open').sum()} matched "
+                  f"lots) = {matched['realized'].sum()}")
         print("closed positions")
         print(pos[pos['count'] == 0])
         print("negative of holdings")
@@ -2,7 +2,10 @@
 # Copyright 2020, Stonks Development Team
 # Distributed under the terms of the Apache License 2.0
 
-from traitlets import HasTraits, Unicode, Int, Float, Bool
+from array import array
+
+from traitlets import (HasTraits, Unicode, Int, Float, Bool,
+                       TraitType, TraitError)
 
 
 class Record(HasTraits):
@@ -11,7 +14,9 @@ class Record(HasTraits):
     of a brokerage transaction email confirmation.
     """
     subject = Unicode('', help='subject title of email')
-    email_id = Int(help='id from imap client')
+    email_id = Int(help='uid from imap client, StatementParser.item_id')
+    source = Unicode('', help='where email_id is unique, e.g. '
+                              '"imap:folder:uidvalidity" or "statement:file"')
     order_type = Unicode('', allow_none=True, help='"market", "limit", ..')
     direction = Unicode('', help='"buy" or "sell"')
     count = Float(allow_none=True, help='number of items')
@@ -35,3 +40,207 @@ class Record(HasTraits):
     partial_price = Float(allow_none=True, help='partial_price')
     avg_price = Float(allow_none=True, help='average price per unit')
 
+
+FIELDS = tuple(name for name, trait in vars(Record).items()
+               if isinstance(trait, TraitType))
+
+
+def _checker(name, trait):
+    """Compile the validation a trait would do into a
+    plain function of the value."""
+    kind = type(trait).__name__
+    allow_none = trait.allow_none
+
+    def fail(value):
+        raise TraitError(f"The '{name}' field of a CompactRecord "
+                         f"expected {kind}, not {value!r}")
+
+    if isinstance(trait, Float):
+        def check(value):
+            if type(value) is float:
+                return value
+            if isinstance(value, (int, float)) and type(value) is not bool:
+                return float(value)
+            if value is None and allow_none:
+                return value
+            return fail(value)
+    elif isinstance(trait, Bool):
+        def check(value):
+            if type(value) is bool or (value is None and allow_none):
+                return value
+            if value in (0, 1) and isinstance(value, int):
+                return bool(value)
+            return fail(value)
+    elif isinstance(trait, Int):
+        def check(value):
+            if isinstance(value, int) or (value is None and allow_none):
+                return value
+            return fail(value)
+    else:
+        def check(value):
+            if type(value) is str or (value is None and allow_none):
+                return value
+            if isinstance(value, bytes):
+                return value.decode('ascii')
+            return fail(value)
+    return check
+
+
+class CompactRecord:
+    """The Record schema in a __slots__ class, without
+    the traitlets observer machinery. Values are
+    validated the way the traits would validate them.
+    Use to_record for the traitlets Record.
+
+    Records compare equal field by field and, being mutable,
+    are unhashable like dicts, key them by (source, email_id)
+    instead.
+    """
+    __slots__ = FIELDS
+    _defaults = tuple((name, getattr(Record, name).default_value)
+                      for name in FIELDS)
+    _checks = {name: _checker(name, getattr(Record, name))
+               for name in FIELDS}
+
+    def __init__(self, **kws):
+        for name, default in self._defaults:
+            setattr(self, name, default)
+        checks = self._checks
+        for name, value in kws.items():
+            if name not in checks:
+                raise TraitError(f'CompactRecord has no field {name}')
+            setattr(self, name, checks[name](value))
+
+    @classmethod
+    def from_dicts(cls, dicts, validate=True):
+        """Bulk build from dicts conforming to the Record
+        spec, skipping validation if validate is False."""
+        new = object.__new__
+        defaults = cls._defaults
+        checks = cls._checks
+        out = []
+        for r in dicts:
+            if validate and not r.keys() <= checks.keys():
+                raise TraitError(f'CompactRecord has no fields '
+                                 f'{set(r) - set(checks)}')
+            rec = new(cls)
+            for name, default in defaults:
+                value = r.get(name, default)
+                setattr(rec, name,
+                        checks[name](value) if validate else value)
+            out.append(rec)
+        return out
+
+    @classmethod
+    def from_record(cls, rec):
+        return cls(**{name: getattr(rec, name) for name in FIELDS})
+
+    def to_record(self):
+        return Record(**self.as_dict())
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in FIELDS}
+
+    def trait_names(self):
+        return list(FIELDS)
+
+    def __eq__(self, other):
+        if not isinstance(other, CompactRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name)
+                   for name in FIELDS)
+
+    # a hash of mutable fields would change under a set or dict
+    __hash__ = None
+
+    def __repr__(self):
+        return f'CompactRecord({self.as_dict()!r})'
+
+
+class RecordColumns:
+    """Columnar accumulator of dicts conforming to the
+    Record spec. Numbers and flags go into typed arrays,
+    the low cardinality strings in categorical are stored
+    as integer codes and the rest in lists. to_df hands
+    the buffers to a dataframe without copying them and
+    starts a new set, so keep appending chunks and call
+    it once at the end.
+
+    Missing floats are NaN and missing flags are False.
+    """
+    categorical = ('ticker', 'direction', 'kind', 'order')
+
+    def __init__(self):
+        self.codes = {name: {} for name in self.categorical}
+        self.reset()
+
+    def reset(self):
+        self.columns = {}
+        for name in FIELDS:
+            trait = getattr(Record, name)
+            if name in self.categorical:
+                self.columns[name] = array('i')
+            elif isinstance(trait, Float):
+                self.columns[name] = array('d')
+            elif isinstance(trait, Bool):
+                self.columns[name] = array('b')
+            elif isinstance(trait, Int):
+                self.columns[name] = array('q')
+            else:
+                self.columns[name] = []
+        missing = {'d': float('nan'), 'b': False}
+        self._appends = tuple(
+            (name, default, CompactRecord._checks[name],
+             self.columns[name].append, self.codes.get(name),
+             missing.get(getattr(self.columns[name], 'typecode', None)))
+            for name, default in CompactRecord._defaults)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, r):
+        """Validate and append one dict."""
+        row = []
+        for name, default, check, _, codes, missing in self._appends:
+            value = check(r.get(name, default))
+            if codes is not None:
+                if value is None:
+                    value = -1
+                else:
+                    value = codes.setdefault(value, len(codes))
+            elif value is None:
+                value = missing
+            row.append(value)
+        for value, (_, _, _, add, _, _) in zip(row, self._appends):
+            add(value)
+        self.size += 1
+
+    def extend(self, dicts):
+        for r in dicts:
+            self.append(r)
+
+    def to_df(self):
+        """A dataframe over the accumulated buffers with
+        categorical dtypes for the columns in categorical,
+        whose categories are sorted so groupby orders as
+        it would on strings."""
+        import numpy as np
+        import pandas as pd
+        data = {}
+        for name, col in self.columns.items():
+            if name in self.categorical:
+                data[name] = pd.Categorical.from_codes(
+                    np.frombuffer(col, dtype=np.int32)
+                    if len(col) else np.empty(0, dtype=np.int32),
+                    categories=list(self.codes[name])
+                ).reorder_categories(sorted(self.codes[name]))
+            elif isinstance(col, array):
+                dtype = {'d': np.float64, 'q': np.int64,
+                         'b': np.bool_}[col.typecode]
+                data[name] = (np.frombuffer(col, dtype=dtype)
+                              if len(col) else np.empty(0, dtype=dtype))
+            else:
+                data[name] = col
+        self.reset()
+        return pd.DataFrame(data, copy=False)
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+import os
+import json
+import time
+
+import numpy as np
+import pandas as pd
+from traitlets.config.configurable import Configurable
+from traitlets import Unicode, Float, Int, Bool, validate, observe
+
+from .record import Record, RecordColumns, FIELDS
+
+
+class RecordStore(Configurable):
+    """Records on disk in columnar form, partitioned by
+    execution month or by ticker.
+
+    Every append writes a batch directory per partition
+    with one .npy file per field and a meta.json. Numbers
+    and flags are stored as typed arrays, strings as int32
+    codes into the batch's values, so every column can be
+    memory-mapped and load only touches the columns and
+    partitions asked for. Rows whose (source, email_id) is
+    already stored are dropped on append, the stored keys
+    are indexed in keys.jsonl next to the partitions.
+    """
+    path = Unicode('', help='directory of the store').tag(config=True)
+    partition_by = Unicode('month', help='"month" or "ticker"').tag(
+        config=True)
+
+    _keys = None
+    _offset = 0
+
+    @observe('path')
+    def _reset_keys(self, change):
+        self._keys, self._offset = None, 0
+
+    @validate('partition_by')
+    def _is_valid_partition_by(self, change):
+        if change.value not in ['month', 'ticker']:
+            raise Exception(f"validation error {change.value}")
+        return change.value
+
+    @staticmethod
+    def dtype(name):
+        trait = getattr(Record, name)
+        if isinstance(trait, Float):
+            return np.float64
+        if isinstance(trait, Bool):
+            return np.bool_
+        if isinstance(trait, Int):
+            return np.int64
+        return None
+
+    def partitions(self, df):
+        """Returns:
+            {partition directory: row positions}
+        """
+        if self.partition_by == 'ticker':
+            keys = [df['ticker'].astype(object).fillna('').to_numpy()]
+            names = ['ticker']
+        else:
+            keys = [df['year'].to_numpy(), df['month'].to_numpy()]
+            names = ['year', 'month']
+        groups = pd.DataFrame(dict(zip(names, keys))).groupby(
+            names, sort=True).indices
+        return {os.path.join(*(f'{name}={val}' for name, val in zip(
+                    names, key if isinstance(key, tuple) else (key,)))): idx
+                for key, idx in groups.items()}
+
+    def batches(self, **where):
+        """Batch directories in partitions matching where,
+        e.g. year=2020, month=[1, 2] or ticker='AAPL'."""
+        want = {key: {str(v) for v in (val if isinstance(
+            val, (list, tuple, set)) else [val])}
+            for key, val in where.items()}
+        out = []
+        if not os.path.isdir(self.path):
+            return out
+        for root, dirs, files in os.walk(self.path):
+            dirs.sort()
+            if 'meta.json' not in files or root.endswith('.tmp'):
+                continue
+            dirs.clear()
+            parts = dict(part.split('=', 1) for part in os.path.relpath(
+                root, self.path).split(os.sep)[:-1])
+            if all(parts.get(key) in vals for key, vals in want.items()):
+                out.append(root)
+        return out
+
+    def keys(self):
+        """Read the key index once per instance, afterwards
+        only the lines appended to it since the last call,
+        by this store or another. A store written before the
+        index existed gets one built from its batches.
+
+        Returns:
+            {(source, email_id), ...} of the stored rows, the
+            source is '' in batches written before it was a field
+        """
+        if self._keys is None:
+            self._keys, self._offset = set(), 0
+        index = os.path.join(self.path, 'keys.jsonl')
+        if not os.path.isfile(index):
+            if not self.batches():
+                return self._keys
+            self.build_index(index)
+        with open(index, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        # a line still being written is read next time
+        data = data[:data.rfind(b'\n') + 1]
+        self._offset += len(data)
+        self._keys.update(tuple(json.loads(line))
+                          for line in data.splitlines())
+        return self._keys
+
+    def build_index(self, index):
+        """Write the keys of every stored batch to index."""
+        keys = set()
+        for batch in self.batches():
+            meta = self.meta(batch)
+            values = np.append(np.array(meta['values'].get('source', []),
+                                        dtype=object), '')
+            keys.update(zip(values[self.column(batch, meta, 'source')],
+                            self.column(batch, meta, 'email_id').tolist()))
+        with open(f'{index}.tmp', 'w') as f:
+            f.writelines(f'{json.dumps(key)}\n' for key in sorted(keys))
+        os.replace(f'{index}.tmp', index)
+
+    def append(self, df):
+        """Write the rows of a dataframe conforming to the
+        Record spec whose (source, email_id) is not stored yet.
+
+        Returns:
+            number of rows written
+        """
+        source = (df['source'].astype(object).fillna('') if 'source' in df
+                  else pd.Series('', index=df.index, dtype=object))
+        stored, seen, fresh, new = self.keys(), set(), [], []
+        for key in zip(source, df['email_id'].tolist()):
+            new.append(key not in stored and key not in seen)
+            if new[-1]:
+                fresh.append(key)
+            seen.add(key)
+        df = df[np.array(new, dtype=bool)]
+        if not len(df):
+            return 0
+        batch = f'part-{time.time_ns()}-{os.getpid()}'
+        for part, idx in self.partitions(df).items():
+            self.write(os.path.join(self.path, part, batch), df.iloc[idx])
+        # indexed once the rows are in place, keys reads them back
+        with open(os.path.join(self.path, 'keys.jsonl'), 'a') as f:
+            f.writelines(f'{json.dumps(key)}\n' for key in fresh)
+        print(f'stored {len(df)} records in {self.path}')
+        return len(df)
+
+    def write(self, batch, df):
+        tmp = f'{batch}.tmp'
+        os.makedirs(tmp, exist_ok=True)
+        meta = {'rows': len(df), 'values': {}}
+        for name in FIELDS:
+            col = df[name] if name in df else pd.Series([None] * len(df))
+            dtype = self.dtype(name)
+            if dtype is None:
+                codes, values = pd.factorize(col.astype(object),
+                                             use_na_sentinel=True)
+                meta['values'][name] = list(values)
+                data = codes.astype(np.int32)
+            elif dtype is np.bool_:
+                data = col.astype(object).fillna(False).to_numpy(np.bool_)
+            else:
+                data = col.to_numpy(dtype, na_value=np.nan
+                                    if dtype is np.float64 else 0)
+            np.save(os.path.join(tmp, f'{name}.npy'), data)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, batch)
+
+    def meta(self, batch):
+        with open(os.path.join(batch, 'meta.json'), 'r') as f:
+            return json.load(f)
+
+    def column(self, batch, meta, name):
+        """Memory-mapped column of a batch, a field added
+        after the batch was written reads as missing."""
+        path = os.path.join(batch, f'{name}.npy')
+        if os.path.isfile(path):
+            return np.load(path, mmap_mode='r')
+        dtype = self.dtype(name)
+        if dtype is None:
+            return np.full(meta['rows'], -1, dtype=np.int32)
+        return np.full(meta['rows'], np.nan if dtype is np.float64 else 0,
+                       dtype=dtype)
+
+    def load(self, columns=None, **where):
+        """Read the columns of the batches in the partitions
+        matching where into a dataframe, with the same
+        categorical columns as RecordColumns. Batches are
+        memory-mapped and copied into one writable array
+        per column.
+
+        Returns:
+            DataFrame of columns (every field if None)
+        """
+        columns = list(columns or FIELDS)
+        batches = self.batches(**where)
+        metas = [self.meta(batch) for batch in batches]
+        data = {}
+        for name in columns:
+            arrays = [self.column(batch, meta, name)
+                      for batch, meta in zip(batches, metas)]
+            if self.dtype(name) is not None:
+                data[name] = np.concatenate(arrays) if arrays else np.empty(
+                    0, dtype=self.dtype(name))
+            else:
+                data[name] = self.decode(name, arrays, [
+                    meta['values'].get(name, []) for meta in metas])
+        df = pd.DataFrame(data, columns=columns, copy=False)
+        print(f'loaded {df.shape} from {len(batches)} batches')
+        return df
+
+    def decode(self, name, arrays, values):
+        """Strings of the batches' codes under one set of
+        values, categorical for RecordColumns.categorical."""
+        uniq = {}
+        for vals in values:
+            for val in vals:
+                uniq.setdefault(val, len(uniq))
+        codes = [np.append(np.array([uniq[val] for val in vals],
+                                    dtype=np.int32), -1)[arr]
+                 for arr, vals in zip(arrays, values)]
+        codes = np.concatenate(codes) if codes else np.empty(0, np.int32)
+        if name in RecordColumns.categorical:
+            return pd.Categorical.from_codes(
+                codes, categories=list(uniq)).reorder_categories(
+                    sorted(uniq))
+        return np.append(np.array(list(uniq), dtype=object), None)[codes]
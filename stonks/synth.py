@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+"""Synthetic robinhood style execution emails for
+benchmarking without a real inbox. Bodies look like the
+quoted-printable plain text part, soft line breaks and
+footer included, so they exercise the whole normalization.
+Every shape the parser handles is covered: shares, crypto,
+options, multi-leg option opens, partial fills and dates
+broken across lines.
+
+Statements are generated as the text dumps pdf2txt makes
+of them, page headers, portfolio summary and account
+activity included.
+"""
+import random
+
+
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+          'August', 'September', 'October', 'November', 'December']
+TICKERS = ['AAPL', 'TSLA', 'SPY', 'MSFT', 'AMD', 'NFLX', 'BA', 'DIS']
+COINS = ['BTC', 'ETH', 'DOGE', 'LTC']
+FOOTER = ('If you have any questions, please contact us. '
+          'Your trade confirmation will be available in the app. '
+          '[Robinhood Financial LLC, Member SIPC]')
+
+
+def executed_at(rng):
+    month = rng.choice(MONTHS)
+    day, year = rng.randint(1, 28), rng.choice([2019, 2020])
+    hour, minute = rng.randint(1, 12), rng.randint(0, 59)
+    merid = rng.choice(['AM', 'PM'])
+    return f'on {month} {day}, {year} at {hour}:{minute:02d} {merid} ET.'
+
+
+def dollars(rng, lo, hi):
+    return f'${rng.uniform(lo, hi):,.2f}'
+
+
+def equity(rng):
+    direction = rng.choice(['buy', 'sell'])
+    count, ticker = rng.randint(1, 100), rng.choice(TICKERS)
+    return (f'Your {rng.choice(["market", "limit"])} order to {direction} '
+            f'{count} shares of {ticker} was executed at an average price '
+            f'of {dollars(rng, 1, 999)} {executed_at(rng)}')
+
+
+def crypto(rng):
+    return (f'Your order to {rng.choice(["buy", "sell"])} '
+            f'{dollars(rng, 1, 999)} of {rng.choice(COINS)} was executed '
+            f'at an average price of {dollars(rng, 1, 9999)} '
+            f'{executed_at(rng)}')
+
+
+def option(rng):
+    direction = rng.choice(['buy', 'sell'])
+    strike = f'${rng.randint(5, 400)}.00'
+    expir = f'{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}'
+    return (f'Your limit order to {direction} {rng.randint(1, 10)} '
+            f'contracts of {rng.choice(TICKERS)} {strike} '
+            f'{rng.choice(["Call", "Put"])} {expir} was executed at an '
+            f'average price of {dollars(rng, 1, 50)} per contract, for a '
+            f'total of {dollars(rng, 100, 5000)}, {executed_at(rng)}')
+
+
+def spread(rng):
+    """A multi-leg option open, counted in legs."""
+    count, legs = rng.randint(1, 10), rng.randint(2, 4)
+    ticker, strike = rng.choice(TICKERS), rng.randint(5, 400)
+    return (f'Your limit order to open {count} {ticker} {legs}-${strike}.00 '
+            f'{rng.choice(["Calls", "Puts"])} was executed at an average '
+            f'price of {dollars(rng, 1, 50)} per contract, for a total of '
+            f'{dollars(rng, 100, 5000)}, '
+            f'{executed_at(rng)}')
+
+
+def broken(rng):
+    """A share order whose year and time a soft line break
+    split in two, e.g. '20=' '20' and '1=' '0:30'."""
+    text = equity(rng)
+    year = text.index(', 20') + 2
+    text = f'{text[:year + 2]}= {text[year + 2:]}'
+    time = text.index(' at ', year) + 4
+    return f'{text[:time + 1]}= {text[time + 1:]}'
+
+
+def partial(rng):
+    count = rng.randint(2, 100)
+    filled = rng.randint(1, count - 1)
+    price = rng.uniform(1, 999)
+    return (f'Your market order to buy {count} shares of '
+            f'{rng.choice(TICKERS)} was partially executed at an average '
+            f'price of ${price:,.2f} {executed_at(rng)} {filled} shares '
+            f'of your order were filled at ${price:,.2f} and '
+            f'${(count - filled) * price:,.2f} was unfilled.')
+
+
+SHAPES = [equity, crypto, option, partial, spread, broken]
+
+
+def soft_wrap(text, width=72):
+    """Wrap like a quoted-printable body: '=' at the end
+    of broken lines and '=0D' carriage returns."""
+    lines, line = [], ''
+    for word in text.split():
+        if line and len(line) + len(word) + 1 > width:
+            lines.append(f'{line} =')
+            line = word
+        else:
+            line = f'{line} {word}'.lstrip()
+    lines.append(line)
+    return '\n'.join(lines)
+
+
+def body(rng, shape=None):
+    """A full plain text email body of the given shape."""
+    shape = shape or rng.choice(SHAPES)
+    return ('Hi there,=0D\n\n' + soft_wrap(shape(rng)) +
+            '\n\n' + soft_wrap(FOOTER) + '\n')
+
+
+def corpus(n, seed=0):
+    """n email bodies cycling through every shape.
+
+    Returns:
+        [(subject, idx, body), ...]
+    """
+    rng = random.Random(seed)
+    out = []
+    for idx in range(1, n + 1):
+        shape = SHAPES[idx % len(SHAPES)]
+        subject = f'Your order has been executed ({shape.__name__})'
+        out.append((subject, idx, body(rng, shape)))
+    return out
+
+
+ACTIVITY_HEADER = ('ACCOUNT ACTIVITY\nDESCRIPTION SYMBOL ACCT TYPE '
+                   'TRANSACTION DATE QTY PRICE DEBIT CREDIT')
+ACTIVITY_END = 'Total Funds Paid and Received'
+
+
+def option_description(rng, ticker):
+    """'TICKER MM/DD/2020 Call $STRIKE' as statements
+    describe an option."""
+    expir = f'{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/2020'
+    return (f'{ticker} {expir} {rng.choice(["Call", "Put"])} '
+            f'${rng.randint(5, 400)}.00')
+
+
+def activity_line(rng):
+    """One account activity line item: a share or option
+    trade, or the odd deposit."""
+    date = f'{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}/2020'
+    acct = rng.choice(['Margin', 'Cash'])
+    ticker = rng.choice(TICKERS)
+    shape = rng.random()
+    if shape < 0.1:
+        return f'ACH Deposit {acct} ACH {date} {dollars(rng, 100, 5000)}'
+    qty = rng.randint(1, 100)
+    price = rng.uniform(1, 500)
+    if shape < 0.5:
+        code = rng.choice(['BTO', 'STO', 'BTC', 'STC'])
+        desc = option_description(rng, ticker)
+        total = qty * price * 100
+    else:
+        code = rng.choice(['Buy', 'Sell'])
+        desc = f'{ticker} Inc CUSIP: {rng.randint(0, 10 ** 9):09d}'
+        total = qty * price
+    return (f'{desc} {ticker} {acct} {code} {date} {qty} ${price:,.2f} '
+            f'${total:,.2f}')
+
+
+def activity_section(n, seed=0):
+    """A statement page text with n account activity
+    line items."""
+    rng = random.Random(seed)
+    lines = [activity_line(rng) for _ in range(n)]
+    return '\n'.join([ACTIVITY_HEADER, *lines,
+                      f'{ACTIVITY_END} {dollars(rng, 1, 9999)}'])
+
+
+PORTFOLIO_HEADER = ('PORTFOLIO SUMMARY\nEQUITIES/OPTIONS SYM/CUSIP ACCT TYPE '
+                    'QTY PRICE MKT VALUE EST.ANNUAL INCOME % OF TOTAL '
+                    'PORTFOLIO')
+
+
+def portfolio_line(rng):
+    """One portfolio summary line item, a share or an option
+    holding."""
+    ticker, acct = rng.choice(TICKERS), rng.choice(['Margin', 'Cash'])
+    qty, price = rng.randint(1, 100), rng.uniform(1, 500)
+    if rng.random() < 0.3:
+        desc = option_description(rng, ticker)
+        value = qty * price * 100
+    else:
+        desc = f'{ticker} Inc CUSIP: {rng.randint(0, 10 ** 9):09d}'
+        value = qty * price
+    return (f'{desc} {ticker} {acct} {qty} ${price:,.2f} ${value:,.2f} '
+            f'{rng.uniform(0, 100):.2f}%')
+
+
+def statement(pages, items=40, seed=0):
+    """A statement text dump of pages pages, the first with
+    a portfolio summary, every page with items account
+    activity line items.
+
+    Returns:
+        str, what pdf2txt prints for the statement pdf
+    """
+    rng = random.Random(seed)
+    month = rng.randint(1, 12)
+    period = f'{month:02d}/01/2020 to {month:02d}/28/2020'
+    out = []
+    for page in range(1, pages + 1):
+        out.extend([f'Page {page} of {pages}', period,
+                    'Jane Doe Account #:123456789', '1 Main St, Anytown'])
+        if page == 1:
+            holdings = [portfolio_line(rng) for _ in range(items // 4 or 1)]
+            out.extend([PORTFOLIO_HEADER, *holdings,
+                        f'Total Securities {dollars(rng, 1000, 99999)}'])
+        out.append(ACTIVITY_HEADER)
+        out.extend(activity_line(rng) for _ in range(items))
+        if page == pages:
+            out.append(f'{ACTIVITY_END} {dollars(rng, 1, 9999)} '
+                       f'{dollars(rng, 1, 9999)}')
+    return '\n'.join(out) + '\n'
+
+
+def statements(directory, count, pages=4, items=40, seed=0):
+    """Write count statement text dumps to directory.
+
+    Returns:
+        [path, ...]
+    """
+    import os
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f'statement_{i:04d}.txt')
+        with open(path, 'w') as f:
+            f.write(statement(pages, items, seed + i))
+        paths.append(path)
+    return paths
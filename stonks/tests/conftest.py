@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+import pytest
+
+from stonks.synth import corpus
+from stonks.mailbox import Mailbox
+from stonks.fakeimap import FakeIMAPServer, make_message
+
+
+def fake_messages(n=60, step=3):
+    """FakeMessages of the synthetic corpus under three
+    order subjects, their uids step apart."""
+    return [make_message(1 + i * step, f'Order {i % 3} executed', bod)
+            for i, (_, _, bod) in enumerate(corpus(n))]
+
+
+@pytest.fixture
+def server():
+    with FakeIMAPServer(fake_messages(), user='user', pwd='pwd') as srv:
+        yield srv
+
+
+@pytest.fixture
+def mailbox(server):
+    """Build a mailbox of cls reading the fake server."""
+    def make(cls=Mailbox, **kws):
+        kws = dict(dict(hostname=server.host, port=server.port, ssl=False,
+                        user='user', pwd='pwd', folder='inbox',
+                        broker='robinhood.com', filters=['executed']), **kws)
+        return cls(**kws)
+    return make
+
+
+@pytest.fixture
+def orders():
+    """A frame of the parsed synthetic corpus as read from
+    folder inbox with uidvalidity 1."""
+    from stonks.parser import EmailParser
+    from stonks.processor import Processor
+    parser = EmailParser(stop_chars=['=0D', '='], stop_phrases=[
+        '[', 'If you have any', 'Your trade confirmation'])
+    df = Processor().records_to_df(list(parser.iter_records(corpus(120))))
+    df['source'] = 'imap:inbox:1'
+    return df
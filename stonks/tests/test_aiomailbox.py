@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+import asyncio
+
+import pytest
+
+from stonks.synth import corpus
+from stonks.parser import EmailParser
+from stonks.fakeimap import make_message
+from stonks.aiomailbox import AsyncIMAP, AsyncMailbox
+
+from .test_mailbox import expected_orders
+
+
+def parse(mailbox):
+    parser = EmailParser(mailbox=mailbox, stop_chars=['=0D', '='],
+                         stop_phrases=['[', 'If you have any',
+                                       'Your trade confirmation'])
+    if isinstance(mailbox, AsyncMailbox):
+        records, _ = asyncio.run(parser.parse_orders_async())
+    else:
+        records, _ = parser.parse_orders()
+    return sorted((rec.as_dict() for rec in records),
+                  key=lambda r: r['email_id'])
+
+
+def test_async_records_equal_sync(server, mailbox):
+    expected = parse(mailbox())
+    assert len(expected) == len(server.messages)
+    assert parse(mailbox(AsyncMailbox, batch_size=7,
+                         connections=2)) == expected
+
+
+def test_in_flight_bounds_fetches(server, mailbox, monkeypatch):
+    server.latency = 0.005
+    active, peak = 0, 0
+    fetch = AsyncIMAP.fetch
+
+    async def counted(self, uids, items, handler):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        try:
+            await fetch(self, uids, items, handler)
+        finally:
+            active -= 1
+
+    monkeypatch.setattr(AsyncIMAP, 'fetch', counted)
+    mb = mailbox(AsyncMailbox, batch_size=4, connections=2, in_flight=3)
+    assert asyncio.run(mb.afetch_orders()) == expected_orders(server)
+    assert peak == 3
+
+
+def test_idle_delivers_new_orders(server, mailbox):
+    mb = mailbox(AsyncMailbox, idle_for=1)
+    new = make_message(500, 'Order 0 executed', corpus(1)[0][2])
+
+    async def run():
+        queue = asyncio.Queue()
+        produce = asyncio.create_task(mb.produce(queue))
+        items = [await queue.get() for _ in server.messages]
+        while not server.idlers:
+            await asyncio.sleep(0.01)
+        server.add(new)
+        items.append(await asyncio.wait_for(queue.get(), 5))
+        assert await queue.get() is None
+        await produce
+        return items
+
+    items = asyncio.run(run())
+    assert items[-1] == ('Order 0 executed', 500, new.parts[0][2])
+    assert len({idx for _, idx, _ in items}) == 61
+
+
+class Stop(Exception):
+    pass
+
+
+def test_consumer_stopping_early(server, mailbox, monkeypatch):
+    mb = mailbox(AsyncMailbox, batch_size=4, queue_size=2)
+    parser = EmailParser(mailbox=mb)
+    parse_body = EmailParser.parse_body
+
+    def fail_third(self, subject, idx, bod):
+        if idx == server.messages[2].uid:
+            raise Stop
+        return parse_body(self, subject, idx, bod)
+
+    monkeypatch.setattr(EmailParser, 'parse_body', fail_third)
+
+    async def run():
+        # the fetch is cancelled and logs out instead of waiting on
+        # the full queue forever
+        with pytest.raises(Stop):
+            await asyncio.wait_for(parser.parse_orders_async(), 5)
+        assert server.active == 0
+
+        # a producer cancelled with a full queue still ends it
+        queue = asyncio.Queue(2)
+        produce = asyncio.create_task(mb.produce(queue))
+        while not queue.full():
+            await asyncio.sleep(0.01)
+        produce.cancel()
+        await asyncio.wait_for(
+            asyncio.gather(produce, return_exceptions=True), 5)
+        items = [queue.get_nowait() for _ in range(queue.qsize())]
+        assert items[-1] is None and len(items) == 2
+
+    asyncio.run(run())
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+import stonks
+
+HEAVY = ['pandas', 'numpy', 'imapclient', 'pdfminer', 'stonks.mailbox',
+         'stonks.parser', 'stonks.processor']
+
+
+def test_import_stays_lazy():
+    code = ('import sys, json, stonks; '
+            f'print(json.dumps([m for m in {HEAVY!r} if m in sys.modules]))')
+    root = os.path.dirname(os.path.dirname(stonks.__file__))
+    out = subprocess.run([sys.executable, '-c', code], cwd=root, check=True,
+                         capture_output=True, text=True).stdout
+    assert json.loads(out) == []
+
+
+@pytest.mark.parametrize('name', stonks.__all__)
+def test_lazy_names_resolve(name):
+    cls = getattr(stonks, name)
+    assert cls.__name__ == name
+    assert cls.__module__ == stonks._lazy[name]
+    assert name in dir(stonks)
+
+
+def test_unknown_name():
+    with pytest.raises(AttributeError):
+        stonks.Nonsense
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+import pytest
+
+from stonks.synth import corpus
+from stonks.parser import EmailParser
+from stonks.instrument import Stages
+
+
+def email_parser(**kws):
+    return EmailParser(stop_chars=['=0D', '='], stop_phrases=[
+        '[', 'If you have any', 'Your trade confirmation'], **kws)
+
+
+def stream():
+    """The synthetic corpus with three bodies that fail at
+    known parse steps."""
+    bodies = corpus(60)
+    subject, _, bod = bodies[0]
+    return bodies + [
+        (subject, 101, bod.replace('September 16', 'Septober 16')),
+        (subject, 102, bod.replace('at 5:30 PM', 'at five PM')),
+        (subject, 103, 'Hi there,=0D\n\nThanks for trading.\n')]
+
+
+def errors(parser):
+    return [err for *_, err in parser.iter_dicts(stream())
+            if err is not None]
+
+
+def test_stage_times():
+    stages = Stages()
+    list(stages.wrap(email_parser()).iter_dicts(stream()))
+    report = stages.report()
+    run = report['stages']['EmailParser.iter_dicts']
+    assert run['calls'] == 1 and run['items'] == 63
+    assert run['failures'] == {'consume_datetime': 2, 'split_order': 1}
+    parse = report['stages']['EmailParser.parse_order_to_dict']
+    assert parse['calls'] == 63
+    steps = [stat for name, stat in report['stages'].items()
+             if name != 'EmailParser.iter_dicts']
+    assert all(stat['wall_s'] > 0 for stat in steps)
+    # time is exclusive, so the stages add up to at most the run
+    assert sum(stat['wall_s'] for stat in report['stages'].values()) <= \
+        report['wall_s']
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_failure_points_with_and_without_timers(workers):
+    expected = errors(email_parser())
+    assert [err.split(':')[0] for err in expected] == [
+        'consume_datetime', 'consume_datetime', 'split_order']
+    timed = Stages().wrap(email_parser(workers=workers, chunk_size=8))
+    assert errors(timed) == expected
+
+
+def test_iter_closes_the_generator_on_early_stop(tmp_path):
+    closed = []
+
+    def numbers():
+        try:
+            yield from range(10)
+        finally:
+            closed.append(True)
+
+    stages = Stages()
+    inner = numbers()
+    gen = stages.iter('numbers', inner)
+    assert next(gen) == 0
+    gen.close()
+    # closed right away, not once the last reference goes
+    assert closed == [True]
+    assert stages.report()['stages']['numbers']['items'] == 1
+    # the parse cache of a stopped run is saved and closed
+    parser = stages.wrap(email_parser(
+        parse_cache=str(tmp_path / 'parses.sqlite')))
+    dicts = parser.iter_dicts(stream())
+    next(dicts)
+    dicts.close()
+    assert list(parser.iter_dicts(stream()[:1]))
+    assert parser.cached_misses() == []
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+from stonks.lots import LotMatcher
+from stonks.processor import Processor
+
+
+def test_match_without_fills(orders):
+    df = Processor().prepare(orders.copy())
+    lots, positions = LotMatcher().match(df.iloc[:0])
+    assert lots.empty and positions.empty
+
+
+def test_specific_picks_the_wanted_lot(orders):
+    df = Processor().prepare(orders.copy())
+    lots, _ = LotMatcher().match(df)
+    closed = lots[lots['reason'] == 'closed'].iloc[0]
+    # every lot of that position the closing fill could have taken
+    same = lots[(lots['ticker'] == closed['ticker'])
+                & (lots['open_time'] <= closed['close_time'])
+                & (lots['side'] == closed['side'])]
+    wanted = same['open_id'].iloc[-1]
+    specific = LotMatcher(method='specific', specific={
+        int(closed['close_id']): [-1, int(wanted)]})
+    lots, _ = specific.match(df)
+    took = lots[lots['close_id'] == closed['close_id']]
+    assert took['open_id'].iloc[0] == wanted
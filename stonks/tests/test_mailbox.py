@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+import os
+from collections import defaultdict
+
+from stonks.fakeimap import FakeIMAPServer, make_message
+
+from .conftest import fake_messages
+
+
+def expected_orders(server):
+    orders = defaultdict(list)
+    for msg in server.messages:
+        orders[msg.subject].append((msg.uid, msg.parts[0][2]))
+    return orders
+
+
+def test_plan_fetch(mailbox):
+    mb = mailbox(batch_size=2)
+    plan = mb.plan_fetch({'a': [7, 1], 'b': [4, 10, 13]})
+    assert plan == [[1, 4], [7, 10], [13]]
+
+
+def test_fetch_in_batches(server, mailbox):
+    # batches smaller than the inbox over uids with gaps
+    mb = mailbox(batch_size=7)
+    assert mb.fetch_orders() == expected_orders(server)
+    fetches = [args for cmd, args in server.commands if cmd == 'UID'
+               and args.startswith('FETCH') and 'BODY[' in args]
+    assert len(fetches) == 9
+
+
+def test_pooled_connections(server, mailbox):
+    single = mailbox(batch_size=5).fetch_orders()
+    pooled = mailbox(batch_size=5, connections=3).fetch_orders()
+    assert pooled == single
+    assert all(bods == sorted(bods) for bods in pooled.values())
+    logins = [cmd for cmd, _ in server.commands if cmd == 'LOGIN']
+    assert len(logins) == 1 + 1 + 3
+
+
+def test_cache_follows_search_criteria(server, mailbox, tmp_path):
+    cache = str(tmp_path / 'cache.sqlite')
+    expected = expected_orders(server)
+    first = mailbox(cache_file=cache, filters=['order 0']).fetch_orders()
+    assert list(first) == ['Order 0 executed']
+    # widening the filters backfills the older emails
+    wide = mailbox(cache_file=cache).fetch_orders()
+    assert wide == expected
+    # narrowing them drops what no longer matches
+    narrow = mailbox(cache_file=cache, stop_words=['order 1']).fetch_orders()
+    assert narrow == {key: val for key, val in expected.items()
+                      if key != 'Order 1 executed'}
+    # unchanged criteria only search above the watermark
+    server.commands.clear()
+    again = mailbox(cache_file=cache, stop_words=['order 1']).fetch_orders()
+    assert again == narrow
+    searches = [args for cmd, args in server.commands if cmd == 'UID'
+                and args.startswith('SEARCH')]
+    assert len(searches) == 1 and 'UID 179:*' in searches[0]
+    assert not any('BODY[' in args for _, args in server.commands)
+
+
+def test_stop_words_match_substrings(mailbox):
+    mb = mailbox(stop_words=['account'])
+    found = mb.filter_subjects({'Your accounts executed': [1, 2],
+                                'Order executed': [3, 4]})
+    assert list(found) == ['Order executed']
+
+
+def test_cached_envelopes_keep_their_part(mailbox, tmp_path):
+    # html only emails, their text is in BODY[1] of type html
+    msgs = [make_message(msg.uid, msg.subject, None,
+                         html=f'<p>{msg.parts[0][2]}</p>')
+            for msg in fake_messages(12)]
+    cache = str(tmp_path / 'cache.sqlite')
+    with FakeIMAPServer(msgs, user='user', pwd='pwd') as srv:
+        kws = dict(hostname=srv.host, port=srv.port, cache_file=cache)
+        expected = mailbox(**kws).fetch_orders()
+        # the envelopes are cached, the first run stops before
+        # any body is stored
+        os.remove(cache)
+        orders = mailbox(**kws).iter_orders()
+        next(orders)
+        orders.close()
+        srv.commands.clear()
+        mb = mailbox(**kws)
+        assert mb.fetch_orders() == expected
+        assert not any('BODYSTRUCTURE' in args for _, args in srv.commands)
+        assert mb.parts == {}
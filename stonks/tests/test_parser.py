@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+import re
+import random
+
+import pytest
+
+from stonks import synth
+from stonks.synth import corpus
+from stonks.cache import ParseCache
+from stonks.parser import EmailParser
+
+
+def parse(**kws):
+    parser = EmailParser(stop_chars=['=0D', '='], stop_phrases=[
+        '[', 'If you have any', 'Your trade confirmation'], **kws)
+    not_parsed = []
+    stream = corpus(150)
+    # the same bodies under other ids are cache hits
+    stream += [(subject, idx + 1000, bod) for subject, idx, bod in stream]
+    records = [r.as_dict() for r in parser.iter_records(stream, not_parsed)]
+    return records, not_parsed
+
+
+def test_stop_configs_apply_in_order():
+    parser = EmailParser(stop_chars=['c', 'ab'])
+    assert parser.tokenize('acb') == []
+    # an earlier phrase cuts before a later one is looked for
+    assert EmailParser(stop_phrases=['b', 'ab']).tokenize('xab') == ['xa']
+    assert EmailParser(stop_phrases=['ab', 'b']).tokenize('xab') == ['x']
+
+
+def test_normalizer_follows_config_changes():
+    parser = EmailParser(stop_chars=['='], stop_phrases=['[1]'])
+    assert parser.tokenize('a=b c [1] d') == ['ab', 'c']
+    parser.stop_chars = ['c']
+    parser.stop_phrases = ['b']
+    assert parser.tokenize('a=b c [1] d') == ['a=']
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_parse_cache_keeps_stream_order(tmp_path, workers):
+    expected = parse()
+    cache = str(tmp_path / 'parses.sqlite')
+    assert parse(parse_cache=cache, workers=workers,
+                 chunk_size=16) == expected
+    assert parse(parse_cache=cache, workers=workers,
+                 chunk_size=16) == expected
+
+
+def test_parse_cache_reads_at_most_size(tmp_path):
+    path = str(tmp_path / 'parses.sqlite')
+    with ParseCache(path) as memo:
+        for i in range(10):
+            memo.put(f'key{i}', {'i': i}, None)
+    with ParseCache(path, size=4) as memo:
+        assert list(memo.entries) == ['key6', 'key7', 'key8', 'key9']
+    with ParseCache(path) as memo:
+        assert len(memo) == 4
+
+
+def test_fingerprint_keys_config_version_and_code(monkeypatch):
+    base = EmailParser(stop_chars=['=']).fingerprint()
+    assert EmailParser(stop_chars=['=']).fingerprint() == base
+    assert EmailParser(stop_chars=['=0D']).fingerprint() != base
+    # a subclass from a notebook or the REPL has no source to read
+    ns = {'__name__': '__main__', 'EmailParser': EmailParser}
+    exec('class Mine(EmailParser):\n    pass\n', ns)
+    mine = ns['Mine'](stop_chars=['=']).fingerprint()
+    assert mine not in (base, EmailParser().fingerprint())
+    monkeypatch.setattr('stonks.parser.PARSER_VERSION', 0)
+    assert EmailParser(stop_chars=['=']).fingerprint() != base
+
+
+def test_parse_cache_hits_are_not_tokenized(tmp_path, monkeypatch):
+    parse(parse_cache=str(tmp_path / 'parses.sqlite'))
+    calls = []
+    tokenize = EmailParser.tokenize
+    monkeypatch.setattr(EmailParser, 'tokenize', lambda self, bod: (
+        calls.append(bod), tokenize(self, bod))[1])
+    records, _ = parse(parse_cache=str(tmp_path / 'parses.sqlite'))
+    # every body is a hit, looked up as fetched
+    assert len(records) == 300 and calls == []
+
+
+def parse_shape(shape, seed):
+    """(generated text, parsed dict) of one synthetic body."""
+    parser = EmailParser(stop_chars=['=0D', '='], stop_phrases=[
+        '[', 'If you have any', 'Your trade confirmation'])
+    text = shape(random.Random(seed))
+    body = synth.body(random.Random(seed), shape)
+    return text, parser.parse_order_to_dict('subject', seed, parser.tokenize(
+        body))
+
+
+def executed(text):
+    month, day, year, hour, minute, merid = re.search(
+        r'on (\w+) (\d+), (\d+) at (\d+):(\d+) (AM|PM)', text).groups()
+    return {'month': synth.MONTHS.index(month) + 1, 'day': int(day),
+            'year': int(year), 'hour': int(hour), 'minute': int(minute),
+            'meridiem': merid}
+
+
+def money(text):
+    return float(text.strip('$').replace(',', ''))
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_synthetic_shapes_parse(seed):
+    text, r = parse_shape(synth.equity, seed)
+    direction, count, ticker, price = re.search(
+        r'to (buy|sell) (\d+) shares of (\w+) .* price of (\S+) on',
+        text).groups()
+    assert r == dict(r, direction=direction, count=int(count),
+                     ticker=ticker, avg_price=money(price), kind='share',
+                     **executed(text))
+    # the same order with its year and time broken across lines
+    assert parse_shape(synth.broken, seed)[1] == r
+
+    text, r = parse_shape(synth.crypto, seed)
+    amount, coin = re.search(r'(\S+) of (\w+) was', text).groups()
+    assert r == dict(r, kind='crypto', ticker=coin,
+                     total_amount=money(amount), **executed(text))
+
+    text, r = parse_shape(synth.option, seed)
+    count, ticker, strike, order, expir = re.search(
+        r'(\d+) contracts of (\w+) (\S+) (Call|Put) (\S+) was', text).groups()
+    assert r == dict(r, kind='contract', count=int(count), ticker=ticker,
+                     strike=strike, order=order, expiration=expir,
+                     **executed(text))
+
+    text, r = parse_shape(synth.spread, seed)
+    count, ticker, legs, strike = re.search(
+        r'open (\d+) (\w+) (\d)-(\S+) ', text).groups()
+    assert r == dict(r, kind='contract', ticker=ticker, strike=strike,
+                     count=int(count) * int(legs), **executed(text))
+
+    text, r = parse_shape(synth.partial, seed)
+    count, filled, unfilled = re.search(
+        r'buy (\d+) shares.* (\d+) shares of your .* and (\S+) was', text
+    ).groups()
+    assert r == dict(r, partial=True, count=int(count),
+                     partial_amount=float(filled),
+                     unfilled_amount=money(unfilled), **executed(text))
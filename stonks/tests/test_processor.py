@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+import json
+
+import numpy as np
+import pandas as pd
+
+from pandas.testing import assert_frame_equal
+
+from stonks.processor import Processor
+
+
+def positions(df):
+    proc = Processor()
+    return proc.compute_positions(proc.prepare(df.copy()))
+
+
+def test_ledger_applies_each_record_once(orders, tmp_path):
+    proc = Processor(ledger_file=str(tmp_path / 'ledger.json'))
+    # the lowest uid only parses on the second run
+    late = orders['email_id'] == orders['email_id'].min()
+    proc.update_ledger(orders[~late].reset_index(drop=True))
+    assert_frame_equal(proc.update_ledger(orders.copy()), positions(orders))
+    assert_frame_equal(proc.update_ledger(orders.copy()), positions(orders))
+    with open(proc.ledger_file) as f:
+        applied = json.load(f)['applied']
+    assert applied == {'imap:inbox:1': sorted(orders['email_id'].tolist())}
+
+
+def test_ledger_rebuilds_for_another_uidvalidity(orders, tmp_path):
+    proc = Processor(ledger_file=str(tmp_path / 'ledger.json'))
+    proc.update_ledger(orders.copy())
+    moved = orders.assign(source='imap:inbox:2',
+                          email_id=orders['email_id'] + 1000)
+    assert_frame_equal(proc.update_ledger(moved.copy()), positions(orders))
+
+
+def test_ledger_without_applied_records_rebuilds(orders, tmp_path):
+    path = tmp_path / 'ledger.json'
+    path.write_text(json.dumps({'last_email_id': 10 ** 6, 'positions': []}))
+    proc = Processor(ledger_file=str(path))
+    assert_frame_equal(proc.update_ledger(orders.copy()), positions(orders))
+
+
+def test_wall_clock_rejects_days_past_month_end():
+    wall = Processor.wall_clock([2019, 2020, 2019], [2, 2, 4], [31, 29, 31])
+    assert np.isnat(wall).tolist() == [True, False, True]
+
+
+def test_expiration_year_follows_expiration_ts():
+    df = pd.DataFrame({
+        'year': [2019, 2019], 'month': [12, 12], 'day': [27, 27],
+        'hour': [10, 10], 'minute': [0, 0], 'meridiem': ['AM', 'AM'],
+        'expiration': ['01/03', '12/27'], 'count': [1., 1.],
+        'total_amount': [10., 10.], 'avg_price': [.1, .1],
+        'partial_amount': [0., 0.]})
+    df = Processor().prepare(df)
+    # january rolls into the next year, string and timestamp alike
+    assert df['expiration'].tolist() == ['01/03/20', '12/27/19']
+    assert df['expiration_ts'].dt.year.tolist() == [2020, 2019]
+
+
+def test_short_options_expire_at_the_close():
+    proc = Processor()
+    sums = pd.DataFrame(
+        {'sells': [0., 0.], 'buys': [1., 1.], 'sell_amt': [0., 0.],
+         'buy_amt': [10., 10.]},
+        index=pd.MultiIndex.from_tuples(
+            [('SPY', 300., 'call', '01/03/20'),
+             ('SPY', 300., 'call', '01/03/99')],
+            names=proc.position_keys))
+    pos = proc.finalize_positions(sums)
+    assert pos['count'].tolist() == [0., -1.]
+
+
+def test_positions_match_legacy_loop(orders):
+    from stonks.bench import legacy_positions, position_frame
+    proc = Processor()
+    for df in (position_frame(500), proc.prepare(orders.copy())):
+        want = legacy_positions(df)
+        assert_frame_equal(proc.compute_positions(df), want,
+                           check_dtype=False)
+        # summed in slices and finalized once, as the ledger does
+        half = len(df) // 2
+        sums = proc.position_sums(df[:half]).add(
+            proc.position_sums(df[half:]), fill_value=0)
+        assert_frame_equal(proc.finalize_positions(sums), want,
+                           check_dtype=False)
+
+
+def prepared_lengths(monkeypatch):
+    """The length of every frame Processor.prepare sees."""
+    seen, prepare = [], Processor.prepare
+
+    def spy(self, df):
+        seen.append(len(df))
+        return prepare(self, df)
+    monkeypatch.setattr(Processor, 'prepare', spy)
+    return seen
+
+
+def test_ledger_path_only_prepares_new_records(orders, tmp_path,
+                                               monkeypatch):
+    proc = Processor(ledger_file=str(tmp_path / 'ledger.json'))
+    proc.update_ledger(orders[5:].reset_index(drop=True))
+    seen = prepared_lengths(monkeypatch)
+    proc.analyze(orders.copy())
+    assert seen == [5]
+    proc.analyze(orders.copy())
+    assert seen == [5]
+    # unless lots are asked for, they need the whole history
+    proc.lot_matching = True
+    proc.analyze(orders.copy())
+    assert seen == [5, len(orders)]
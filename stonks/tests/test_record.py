@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+import numpy as np
+import pandas as pd
+import pytest
+from traitlets import TraitError
+
+from stonks.synth import corpus
+from stonks.parser import EmailParser
+from stonks.processor import Processor
+from stonks.record import Record, CompactRecord, RecordColumns, FIELDS
+
+
+def email_parser(**kws):
+    return EmailParser(stop_chars=['=0D', '='], stop_phrases=[
+        '[', 'If you have any', 'Your trade confirmation'], **kws)
+
+
+def test_parse_orders_returns_compact_records(mailbox):
+    parser = email_parser(mailbox=mailbox())
+    records, _ = parser.parse_orders()
+    assert records
+    for rec in records:
+        assert type(rec) is CompactRecord
+        # what a Record used to give, by field and by value
+        assert rec.trait_names() == list(FIELDS)
+        full = rec.to_record()
+        assert isinstance(full, Record)
+        assert {name: getattr(full, name) for name in FIELDS} == \
+            rec.as_dict()
+        assert CompactRecord.from_record(full) == rec
+
+
+def test_compact_record_validates_like_record():
+    rec = CompactRecord(count=3, ticker='AAPL')
+    assert rec.count == 3.0 and isinstance(rec.count, float)
+    assert rec.as_dict() == {name: getattr(Record(count=3, ticker='AAPL'),
+                                           name) for name in FIELDS}
+    with pytest.raises(TraitError):
+        CompactRecord(count='three')
+    with pytest.raises(TraitError):
+        CompactRecord(nonsense=1)
+    with pytest.raises(TypeError):
+        hash(rec)
+
+
+def as_strings(df):
+    """df with its categorical columns back as strings."""
+    return df.astype({name: 'str' for name in RecordColumns.categorical})
+
+
+def test_columns_dtypes():
+    cols = RecordColumns()
+    cols.extend([{'ticker': 'AAPL', 'count': 2, 'email_id': 7,
+                  'partial': True, 'subject': 'a'}, {'count': None}])
+    df = cols.to_df()
+    assert list(df.columns) == list(FIELDS)
+    for name in RecordColumns.categorical:
+        assert isinstance(df[name].dtype, pd.CategoricalDtype)
+    assert df['count'].dtype == np.float64
+    assert df['email_id'].dtype == np.int64
+    assert df['partial'].dtype == np.bool_
+    # None floats are NaN, absent fields take the Record default
+    assert df['count'].tolist()[0] == 2.0 and np.isnan(df['count'][1])
+    assert df['partial'].tolist() == [True, False]
+    assert df['subject'].tolist() == ['a', '']
+
+
+def test_columns_codes_round_trip():
+    cols = RecordColumns()
+    tickers = ['TSLA', 'AAPL', 'TSLA', 'BA', None, 'AAPL']
+    cols.extend({'ticker': t} for t in tickers)
+    assert cols.codes['ticker'] == {'TSLA': 0, 'AAPL': 1, 'BA': 2}
+    df = cols.to_df()
+    # categories sorted like strings, missing values NaN
+    assert list(df['ticker'].cat.categories) == ['AAPL', 'BA', 'TSLA']
+    assert df['ticker'].astype(object).where(
+        df['ticker'].notna(), None).tolist() == tickers
+
+
+def test_columns_frame_equals_records_frame():
+    stream = corpus(200)
+    parser = email_parser()
+    records = list(parser.iter_records(stream))
+    df = Processor().records_frame(records)
+    got = parser.parse_columns(stream).to_df()
+    pd.testing.assert_frame_equal(as_strings(got), df)
+
+
+def test_columns_append_across_chunks():
+    stream = corpus(300)
+    parser = email_parser()
+    df = Processor().records_frame(list(parser.iter_records(stream)))
+    cols, frames = RecordColumns(), []
+    for start in range(0, len(stream), 64):
+        parser.parse_columns(stream[start:start + 64], cols)
+        if start % 128:
+            frames.append(cols.to_df())
+    frames.append(cols.to_df())
+    assert len(cols) == 0
+    # a frame still holds its buffers once the next chunk is appended
+    got = pd.concat([as_strings(f) for f in frames], ignore_index=True)
+    pd.testing.assert_frame_equal(got, df)
+    # codes carry over chunks, so every frame reads the same categories
+    assert {tuple(f['ticker'].cat.categories) for f in frames[1:]} == \
+        {tuple(sorted(cols.codes['ticker']))}
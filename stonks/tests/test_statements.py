@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+import os
+
+from stonks import synth
+from stonks.bench import shipped_config
+from stonks.cache import TextCache
+from stonks.parser import StatementParser
+
+
+def parser(**kws):
+    return StatementParser(config=shipped_config(), **kws)
+
+
+def write_pdf(path, text):
+    """A minimal pdf of a statement text dump, a pdf page per
+    "Page " of the dump and a text line per line."""
+    pages = ['Page ' + page for page in text.split('Page ')[1:]]
+    objs = [b'<< /Type /Catalog /Pages 2 0 R >>',
+            b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(
+                b'%d 0 R' % (4 + 2 * i) for i in range(len(pages))),
+                len(pages)),
+            b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    for i, page in enumerate(pages):
+        lines = (line.replace('\\', '\\\\').replace('(', '\\(')
+                 .replace(')', '\\)') for line in page.splitlines())
+        stream = b'BT /F1 6 Tf 20 1500 Td %s ET' % b' '.join(
+            b'(%s) Tj 0 -8 Td' % line.encode() for line in lines)
+        objs.append(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 1200 '
+                    b'1520] /Resources << /Font << /F1 3 0 R >> >> '
+                    b'/Contents %d 0 R >>' % (5 + 2 * i))
+        objs.append(b'<< /Length %d >>\nstream\n%s\nendstream'
+                    % (len(stream), stream))
+    out, offsets = [b'%PDF-1.4\n'], []
+    for num, obj in enumerate(objs, 1):
+        offsets.append(sum(map(len, out)))
+        out.append(b'%d 0 obj\n%s\nendobj\n' % (num, obj))
+    xref = sum(map(len, out))
+    out.append(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objs) + 1))
+    out.extend(b'%010d 00000 n \n' % offset for offset in offsets)
+    out.append(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n'
+               b'%%%%EOF\n' % (len(objs) + 1, xref))
+    with open(path, 'wb') as f:
+        f.write(b''.join(out))
+
+
+def test_portfolio_without_its_last_header_token():
+    page = ' '.join(synth.statement(1, items=8).splitlines())
+    cut = page.replace('% OF TOTAL PORTFOLIO', '')
+    assert parser().parse_portfolio(page)
+    assert parser().parse_portfolio(cut) is None
+
+
+def test_text_cache_tee_stopped_early(tmp_path):
+    cache = TextCache(str(tmp_path))
+    pieces = cache.tee('abc', iter(['one', 'two', 'three']))
+    assert next(pieces) == 'one'
+    pieces.close()
+    assert os.listdir(tmp_path) == []
+    assert ''.join(cache.tee('abc', ['one', 'two'])) == 'onetwo'
+    assert cache.get('abc') == 'onetwo'
+    assert os.listdir(tmp_path) == ['abc.txt']
+
+
+def test_statement_record_ids_are_stable(tmp_path):
+    first, second = synth.statements(str(tmp_path), 2, pages=2, items=12)
+    records, _, _ = parser(statements=[second]).parse_statements()
+    again, _, _ = parser(statements=[first, second]).parse_statements()
+    keys = [(r.source, r.email_id) for r in records]
+    assert {r.source for r in records} == {'statement:statement_0001.txt'}
+    assert len(set(keys)) == len(keys)
+    assert keys == [(r.source, r.email_id) for r in again
+                    if r.source == records[0].source]
+
+
+def test_activity_continues_after_a_repeated_header():
+    lines = synth.statement(1, items=10).splitlines()
+    at = lines.index(synth.ACTIVITY_HEADER.splitlines()[-1]) + 5
+    repeated = lines[:at] + synth.ACTIVITY_HEADER.splitlines() + lines[at:]
+    page = ' '.join(lines)
+    items = parser().parse_activity(page)
+    assert len(items) == 10
+    assert parser().parse_activity(' '.join(repeated)) == items
+
+
+def test_pooled_extraction_equals_serial(tmp_path):
+    paths = []
+    for seed in range(3):
+        path = str(tmp_path / f'statement_{seed}.pdf')
+        write_pdf(path, synth.statement(5, items=6, seed=seed))
+        paths.append(path)
+    serial = parser().extract(paths)
+    assert all(text.count('Page ') == 5 for text in serial.values())
+    assert parser(workers=2).extract(paths) == serial
+    assert parser(workers=2, pages_per_task=2).extract(paths) == serial
+    records, holdings, _ = parser(statements=paths).parse_statements()
+    assert records
+    assert parser(statements=paths, workers=2,
+                  pages_per_task=2).parse_statements()[:2] == \
+        (records, holdings)
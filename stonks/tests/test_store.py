@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Copyright 2020, Stonks Development Team
+# Distributed under the terms of the Apache License 2.0
+from stonks.store import RecordStore
+from stonks.processor import Processor
+
+
+def test_store_keys_on_source_and_email_id(orders, tmp_path):
+    store = RecordStore(path=str(tmp_path))
+    assert store.append(orders) == len(orders)
+    assert store.append(orders) == 0
+    # the same uids in another folder are other emails
+    assert store.append(orders.assign(source='imap:archive:1')) == len(orders)
+    assert len(store.load(columns=['email_id'])) == 2 * len(orders)
+
+
+def test_analyze_from_store(orders, tmp_path):
+    store = RecordStore(path=str(tmp_path), partition_by='ticker')
+    store.append(orders)
+    # a single batch, analyze fills in the counts of partial orders
+    ticker = orders.loc[orders['partial_amount'] > 0, 'ticker'].iloc[0]
+    proc = Processor()
+    df = store.load(columns=proc.columns, ticker=ticker)
+    proc.analyze(df)
+    assert (df['count'] > 0).all()
+
+
+def test_store_appends_do_not_rescan_batches(orders, tmp_path, monkeypatch):
+    store = RecordStore(path=str(tmp_path))
+    reads = []
+    monkeypatch.setattr(RecordStore, 'meta',
+                        lambda self, batch: reads.append(batch))
+    for start in range(0, len(orders), 20):
+        assert store.append(orders[start:start + 20]) == len(
+            orders[start:start + 20])
+    assert store.append(orders) == 0
+    assert reads == []
+    # another store over the same path reads the index, not the batches
+    other = RecordStore(path=str(tmp_path))
+    assert other.append(orders.assign(email_id=orders['email_id'] + 1000)
+                        ) == len(orders)
+    assert reads == []
+    # and the first one sees what the other appended
+    assert store.append(orders.assign(email_id=orders['email_id'] + 1000)
+                        ) == 0
+
+
+def test_store_without_key_index(orders, tmp_path):
+    store = RecordStore(path=str(tmp_path))
+    store.append(orders[:50])
+    (tmp_path / 'keys.jsonl').unlink()
+    store = RecordStore(path=str(tmp_path))
+    assert store.append(orders) == len(orders) - 50
+    assert len(store.keys()) == len(orders)
+    assert len(store.load(columns=['email_id'])) == len(orders)